@@ -0,0 +1,85 @@
+# Response Format Benchmark
+
+"""
+Compares JSON, MessagePack and CBOR for a GET /pats sized payload
+
+For a list of patients shaped like Pprofile.serialize(), it prints the
+encode and decode time and the payload size (raw and gzip) of every
+format whose package is installed.
+
+Run it with:
+  python benchmarks/formats.py [--patients 1000] [--runs 20]
+"""
+import os
+import sys
+import copy
+import gzip
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from service.negotiation import msgpack, cbor2  # pylint: disable=wrong-import-position
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "tests", "fhir-patient-post.json")
+
+
+def sample_patients(count):
+    """ Returns count patients shaped like the service serializes them """
+    with open(SAMPLE) as jsonfile:
+        sample = json.load(jsonfile)
+    patients = []
+    for pat_id in range(1, count + 1):
+        patient = copy.deepcopy(sample)
+        patient["id"] = pat_id
+        for position, name in enumerate(patient["name"]):
+            name.update(id=pat_id * 10 + position, pat_id=pat_id)
+        for position, address in enumerate(patient["address"]):
+            address.update(id=pat_id * 10 + position, pat_id=pat_id)
+        patients.append(patient)
+    return patients
+
+
+def formats():
+    """ Returns (name, encode, decode) of the available formats """
+    available = [("json", lambda data: json.dumps(data).encode("utf-8"),
+                  lambda body: json.loads(body.decode("utf-8")))]
+    if msgpack is not None:
+        available.append(("msgpack", lambda data: msgpack.packb(data, use_bin_type=True),
+                          lambda body: msgpack.unpackb(body, raw=False)))
+    if cbor2 is not None:
+        available.append(("cbor", cbor2.dumps, cbor2.loads))
+    return available
+
+
+def timed(func, arg, runs):
+    """ Returns the median milliseconds of func(arg) and its last result """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(arg)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), result
+
+
+def main():
+    """ Times every format and prints the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--patients", type=int, default=1000, help="patients in the payload")
+    parser.add_argument("--runs", type=int, default=20, help="runs per measurement")
+    args = parser.parse_args()
+    patients = sample_patients(args.patients)
+
+    print("{:<8} {:>10} {:>10} {:>10} {:>10}".format("format", "encode ms", "decode ms", "bytes", "gzip bytes"))
+    for name, encode, decode in formats():
+        encode_ms, body = timed(encode, patients, args.runs)
+        decode_ms, decoded = timed(decode, body, args.runs)
+        assert decoded == patients, name
+        print("{:<8} {:>10.2f} {:>10.2f} {:>10} {:>10}".format(
+            name, encode_ms, decode_ms, len(body), len(gzip.compress(body))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Worker Startup Benchmark
+
+"""
+Measures how long a worker takes to start
+
+Each measurement runs in a fresh Python process, like a new gunicorn
+worker without --preload:
+  import     - importing the service (create_app), which must not touch the database
+  first GET  - importing the service and serving its first GET /pats
+  bootstrap  - bringing the schema up to date, which workers used to do at import
+
+Run it with:
+  python benchmarks/startup.py [--runs 10]
+
+The database is DATABASE_URI, a temporary SQLite file by default.
+"""
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEPS = {
+    "import": "import service",
+    "first GET": "import service; service.app.test_client().get('/pats')",
+    "bootstrap": "import service; from service.models import Pprofile; Pprofile.bootstrap_db(service.app)",
+}
+
+TIMER = """
+import time
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+"""
+
+
+def measure(code, env):
+    """ Returns the seconds taken by code in a fresh interpreter """
+    output = subprocess.check_output([sys.executable, "-c", TIMER.format(code)], cwd=ROOT, env=env)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    """ Runs every step several times and prints the timings """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10, help="runs per step")
+    runs = parser.parse_args().runs
+
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URI", "sqlite:///" + os.path.join(tempfile.gettempdir(), "pats-startup.db"))
+    measure(STEPS["bootstrap"], env)  # the GET needs the tables
+
+    print("{:<10} {:>10} {:>10} {:>10}".format("step", "median ms", "min ms", "max ms"))
+    for step, code in STEPS.items():
+        timings = [measure(code, env) * 1000 for _ in range(runs)]
+        print("{:<10} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            step, statistics.median(timings), min(timings), max(timings)))
+
+
+if __name__ == "__main__":
+    main()
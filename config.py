@@ -21,3 +21,132 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Secret for session management
 #SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Keep a pre-rendered JSON copy of every patient on the pprofile row so that
+# reads can return it without assembling the names and addresses
+STORE_RESOURCE_JSON = os.getenv("STORE_RESOURCE_JSON", "True").lower() in ("true", "1", "yes")
+
+# Read replicas serving the GET requests, as a comma separated list of URIs;
+# writes always go to DATABASE_URI
+SQLALCHEMY_REPLICA_URIS = [
+    uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()
+]
+
+# Seconds a client keeps reading from the primary after one of its writes
+READ_YOUR_WRITES_SECONDS = int(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Databases the patients are sharded across, as a comma separated list of
+# URIs; when set, each patient lives on one of them chosen from its id
+SQLALCHEMY_SHARD_URIS = [
+    uri.strip() for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri.strip()
+]
+
+# Node id (0-1023) mixed into the patient ids generated by this process;
+# random when unset, give every process its own to rule out collisions
+SHARD_NODE_ID = int(os.getenv("SHARD_NODE_ID")) if os.getenv("SHARD_NODE_ID") else None
+
+# Responses smaller than this many bytes are not compressed
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+# gzip level (1-9) and brotli quality (0-11) of the compressed responses
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+# Largest request body accepted once a gzip Content-Encoding is decompressed
+MAX_DECOMPRESSED_SIZE = int(os.getenv("MAX_DECOMPRESSED_SIZE", str(16 * 1024 * 1024)))
+
+# Most distinct ids an _id search parameter may list
+MAX_ID_LIST = int(os.getenv("MAX_ID_LIST", "1000"))
+
+# Seconds an Idempotency-Key and its response are kept
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+
+# Seconds after which a claimed Idempotency-Key still without a response, left
+# by a worker that died, goes to a retry; longer than a write may run
+IDEMPOTENCY_CLAIM_SECONDS = int(os.getenv("IDEMPOTENCY_CLAIM_SECONDS", "60"))
+
+# Duplicate patient detection: lowest score kept, largest block compared,
+# pairs per scoring task, scoring processes (the number of cores if unset),
+# how they start and the seconds after which a running job is abandoned
+DEDUP_MIN_SCORE = float(os.getenv("DEDUP_MIN_SCORE", "0.75"))
+DEDUP_MAX_BLOCK_SIZE = int(os.getenv("DEDUP_MAX_BLOCK_SIZE", "1000"))
+DEDUP_CHUNK_PAIRS = int(os.getenv("DEDUP_CHUNK_PAIRS", "100000"))
+DEDUP_WORKERS = int(os.getenv("DEDUP_WORKERS")) if os.getenv("DEDUP_WORKERS") else None
+DEDUP_START_METHOD = os.getenv("DEDUP_START_METHOD", "spawn")
+DEDUP_JOB_TIMEOUT = int(os.getenv("DEDUP_JOB_TIMEOUT", "3600"))
+
+# Change history: entries per page, and how old a change must be before the
+# feed of all patients shows it (so that a commit in flight is not skipped)
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "100"))
+HISTORY_SETTLE_SECONDS = float(os.getenv("HISTORY_SETTLE_SECONDS", "2"))
+
+# Subscriptions: how often the change history is read for the event streams,
+# how often an idle stream is kept alive and how far a stream may fall behind
+SUBSCRIPTION_POLL_SECONDS = float(os.getenv("SUBSCRIPTION_POLL_SECONDS", "1"))
+SUBSCRIPTION_HEARTBEAT_SECONDS = float(os.getenv("SUBSCRIPTION_HEARTBEAT_SECONDS", "15"))
+SUBSCRIPTION_QUEUE_SIZE = int(os.getenv("SUBSCRIPTION_QUEUE_SIZE", "1000"))
+
+# Patient statistics: the ages starting an age band, and how many results
+# are cached and for how long at most (they are dropped on the next write)
+STATS_AGE_BANDS = [int(age) for age in os.getenv("STATS_AGE_BANDS", "18,35,50,65").split(",") if age.strip()]
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", "256"))
+STATS_CACHE_SECONDS = float(os.getenv("STATS_CACHE_SECONDS", "300"))
+
+# Analytics: keep an in-memory snapshot of the patients for GET /pats/$analytics,
+# and how often it reads the changes made since
+ANALYTICS_SNAPSHOT = os.getenv("ANALYTICS_SNAPSHOT", "false").lower() == "true"
+ANALYTICS_REFRESH_SECONDS = float(os.getenv("ANALYTICS_REFRESH_SECONDS", "1"))
+
+# Admin routes (/admin/*): the X-Admin-Token header value they need; the
+# routes are off when it is empty
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Request coalescing: identical concurrent reads share one response, waiting
+# at most COALESCE_WAIT_SECONDS for it; larger streamed responses are not shared
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+COALESCE_WAIT_SECONDS = float(os.getenv("COALESCE_WAIT_SECONDS", "30"))
+COALESCE_MAX_BYTES = int(os.getenv("COALESCE_MAX_BYTES", str(1024 * 1024)))
+
+# Admission control: the most requests of each class of routes running at once
+# (point reads, searches, writes and bulk operations), how many may wait for a
+# slot and for how long, and the slowdown taken as overload
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+ADMISSION_LIMITS = dict((name.strip(), int(limit)) for name, limit in (
+    item.split("=") for item in os.getenv("ADMISSION_LIMITS", "point=64,search=8,write=16,bulk=2").split(",")
+    if item.strip()))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "16"))
+ADMISSION_QUEUE_SECONDS = float(os.getenv("ADMISSION_QUEUE_SECONDS", "1"))
+ADMISSION_LATENCY_TOLERANCE = float(os.getenv("ADMISSION_LATENCY_TOLERANCE", "2"))
+
+# Request deadlines: the seconds a request may run, by endpoint name or class
+# of route (point, search, write, bulk); clients may ask for less
+REQUEST_DEADLINES = dict((name.strip(), float(seconds)) for name, seconds in (
+    item.split("=") for item in os.getenv("REQUEST_DEADLINES", "point=5,search=30,write=15,bulk=300").split(",")
+    if item.strip()))
+
+# Profiling: the X-Profile header value asking for a CPU profile (none when
+# empty), the share of requests profiled at random, the sampling interval,
+# the files written (collapsed and/or pstats), where and how many are kept
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_FORMATS = [name.strip() for name in os.getenv("PROFILE_FORMATS", "collapsed").split(",") if name.strip()]
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+# Allocation tracing: start tracemalloc with the worker, the share of the
+# requests sampled, the frames of an allocation site and the sites reported
+TRACEMALLOC = os.getenv("TRACEMALLOC", "false").lower() == "true"
+TRACEMALLOC_SAMPLE_RATE = float(os.getenv("TRACEMALLOC_SAMPLE_RATE", "0.1"))
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "10"))
+TRACEMALLOC_TOP = int(os.getenv("TRACEMALLOC_TOP", "20"))
+
+# Request tracing: trace the requests, the share of those without a
+# traceparent traced, the exporters (memory and/or file), the traces kept in
+# memory, the file of the traces and the most spans of one trace
+TRACING = os.getenv("TRACING", "false").lower() == "true"
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1"))
+TRACING_EXPORTERS = [name.strip() for name in os.getenv("TRACING_EXPORTERS", "memory").split(",") if name.strip()]
+TRACING_MEMORY_TRACES = int(os.getenv("TRACING_MEMORY_TRACES", "100"))
+TRACING_FILE = os.getenv("TRACING_FILE", "/tmp/traces.jsonl")
+TRACING_MAX_SPANS = int(os.getenv("TRACING_MAX_SPANS", "1000"))
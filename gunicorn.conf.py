@@ -0,0 +1,27 @@
+# Gunicorn Configuration
+
+"""
+Gunicorn settings of the service, read from the working directory
+
+The workers are gevent workers so that each long-lived subscription event
+stream (GET /subscriptions/{id}/$events) costs a greenlet rather than a
+worker. psycopg2 is made to wait cooperatively, so that a query only
+blocks its own greenlet.
+
+The app is preloaded in the master (--preload) before the workers are
+forked, so the standard library is patched for gevent here, before the
+app is imported: otherwise the locks, events and threads the modules of
+the service create when imported would stay native, and a greenlet
+waiting on one of them would block its whole worker.
+"""
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "2000"))
+
+if worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    # lets psycopg2 yield to the other greenlets while waiting for the database
+    patch_psycopg()
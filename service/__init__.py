@@ -16,29 +16,75 @@ app = Flask(__name__)
 app.config.from_object('config')
 
 # Import the rutes After the Flask app is created
-from service import service, models
-
-# Set up logging for production
-if __name__ != '__main__':
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
-    app.logger.info('Logging handler established')
-
-app.logger.info(70 * "*")
-app.logger.info(" Patient Membership Data Set ".center(70, "*"))
-app.logger.info(70 * "*")
+from service import service, models, routing, sharding, compression, admission, deadlines, profiling, \
+    allocations, tracing
+
+
+def create_app():
+    """
+    Sets up the Flask app and returns it
+
+    Nothing here connects to the database: the engines are only created
+    on first use, after gunicorn has forked its workers, so the app can
+    be preloaded (gunicorn --preload) and workers start without any DDL.
+    The schema is created by the "flask bootstrap-db" command.
+    """
+    if "sqlalchemy" in app.extensions:
+        return app
+
+    # Trace the requests from the HTTP layer down to SQL; registered before the
+    # other modules so that the span of the request covers their hooks
+    tracing.init_app(app)
+
+    # Shed the requests over the concurrency limit of their class of routes,
+    # before any other hook does work for them
+    admission.init_app(app)
+
+    # Give every request a time budget, enforced as a statement timeout
+    deadlines.init_app(app)
+
+    # Profile the requests asked for with X-Profile, or sampled at random
+    profiling.init_app(app)
+
+    # Trace the memory allocations of sampled requests, when turned on
+    allocations.init_app(app)
+
+    # Compress responses and decompress request bodies. Flask runs the
+    # after_request hooks in the reverse order of registration, so the body is
+    # compressed after routing set its cookie and before profiling and tracing
+    # add their headers, which leave the body as it is
+    compression.init_app(app)
+
+    # Send the reads of GET requests to the read replicas, if configured
+    routing.init_app(app)
+
+    # Spread the patients across the shard databases, if configured
+    sharding.init_app(app)
+
+    # Set up logging for production
+    if __name__ != '__main__':
+        gunicorn_logger = logging.getLogger('gunicorn.error')
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+        app.logger.propagate = False
+        # Make all log formats consistent
+        formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
+        for handler in app.logger.handlers:
+            handler.setFormatter(formatter)
+        app.logger.info('Logging handler established')
+
+    app.logger.info(70 * "*")
+    app.logger.info(" Patient Membership Data Set ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    service.init_db()  # set up sqlalchemy, without connecting yet
+    app.logger.info("Service inititalized!")
+    return app
+
 
 try:
-    service.init_db()  # make our sqlalchemy tables
+    create_app()
 except Exception as error:
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
-
-app.logger.info("Service inititalized!")
@@ -0,0 +1,224 @@
+# Admission Control
+
+"""
+Admission control and load shedding per class of route
+
+Every route belongs to a class, each with its own concurrency limit, so
+that heavy searches filling up their slots never delay point reads:
+  point  - reads of one patient, name, address, subscription or job
+  search - listings, searches, history feeds and statistics
+  write  - creates, updates and deletes of one resource
+  bulk   - conditional deletes and duplicate searches
+A request over the limit of its class waits for a slot, for at most
+ADMISSION_QUEUE_SECONDS and behind at most ADMISSION_QUEUE_SIZE others;
+past that it is shed with 503 Service Unavailable and a Retry-After
+estimated from the queue and the latency of the class.
+
+The limits adapt to the latency: each class tracks the lowest latency of
+its recent requests (the latency without load) and their average. While
+the average stays within ADMISSION_LATENCY_TOLERANCE times the lowest the
+limit grows back towards its ADMISSION_LIMITS maximum; when requests slow
+down because too many run at once, the limit shrinks in proportion.
+
+Streamed responses, like GET /pats, hold their slot until the last byte
+is sent. Event streams and the admin routes are not limited.
+
+Configuration
+-------------
+ADMISSION_CONTROL - limit the requests running at once
+ADMISSION_LIMITS - the most requests of each class running at once
+ADMISSION_QUEUE_SIZE - the most requests of a class waiting for a slot
+ADMISSION_QUEUE_SECONDS - the longest a request waits for a slot
+ADMISSION_LATENCY_TOLERANCE - the slowdown over the unloaded latency taken as overload
+"""
+import math
+import time
+import logging
+import threading
+from flask import g, request, current_app
+from werkzeug.exceptions import ServiceUnavailable
+
+logger = logging.getLogger("gunicorn.error")
+
+CLASSES = ("point", "search", "write", "bulk")
+
+# The class of each endpoint; the other reads are searches and the other writes are writes
+ROUTE_CLASSES = {
+    "get_pats": "point",
+    "get_history": "point",
+    "get_dedup": "point",
+    "get_subscription": "point",
+    "list_address": "point",
+    "get_address": "point",
+    "list_name": "point",
+    "get_name": "point",
+    "search_pats": "search",
+    "delete_matching_pats": "bulk",
+    "start_dedup": "bulk",
+}
+
+# Endpoints that are never limited, besides the admin routes
+EXEMPT_ENDPOINTS = ("index", "static", "stream_subscription")
+
+# Requests between two resets of the lowest latency of a class
+LATENCY_WINDOW = 500
+
+# Weight of the newest latency in the average, and of the newest limit
+LATENCY_SMOOTHING = 0.1
+LIMIT_SMOOTHING = 0.2
+
+
+class Overloaded(ServiceUnavailable):
+    """ A request shed because its class of routes is at its limit """
+
+    def __init__(self, description, retry_after):
+        ServiceUnavailable.__init__(self, description)
+        self.retry_after = retry_after
+
+
+class Limiter():
+    """ The adaptive concurrency limit of one class of routes, and the requests waiting for it """
+
+    def __init__(self, name, max_limit):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.min_latency = None
+        self.window_min = None
+        self.window_count = 0
+        self.latency = None
+        self.admitted = 0
+        self.shed = 0
+
+    def acquire(self, queue_size, timeout):
+        """ Takes a slot, waiting for one when needed; returns False when the request is shed """
+        with self.condition:
+            if self.running < int(self.limit):
+                self.running += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= queue_size:
+                self.shed += 1
+                return False
+            self.waiting += 1
+            deadline = time.time() + timeout
+            try:
+                while self.running >= int(self.limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+            self.admitted += 1
+            return True
+
+    def release(self, latency, tolerance):
+        """ Gives a slot back and adapts the limit to the latency of the request """
+        with self.condition:
+            self.running -= 1
+            self.observe(latency, tolerance)
+            self.condition.notify()
+
+    def observe(self, latency, tolerance):
+        """ Updates the latencies and the limit """
+        self.latency = latency if self.latency is None \
+            else (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+        self.window_min = latency if self.window_min is None else min(self.window_min, latency)
+        self.window_count += 1
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if self.window_count >= LATENCY_WINDOW:
+            #the data grows and the latency without load with it
+            self.min_latency, self.window_min, self.window_count = self.window_min, None, 0
+        if self.latency <= 0:
+            return
+        gradient = max(0.5, min(1.0, tolerance * self.min_latency / self.latency))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = max(1.0, min(float(self.max_limit),
+                                  (1 - LIMIT_SMOOTHING) * self.limit + LIMIT_SMOOTHING * target))
+
+    def retry_after(self):
+        """ Returns the seconds after which a shed request may find a slot """
+        latency = self.latency or 0
+        return max(1, int(math.ceil((self.waiting + 1) * latency / max(self.limit, 1))))
+
+    def metrics(self):
+        """ Returns the state of the limit """
+        with self.condition:
+            return {
+                "limit": round(self.limit, 2),
+                "maxLimit": self.max_limit,
+                "running": self.running,
+                "waiting": self.waiting,
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "latency": round(self.latency, 4) if self.latency is not None else None,
+                "minLatency": round(self.min_latency, 4) if self.min_latency is not None else None,
+            }
+
+
+def route_class():
+    """ Returns the class of the route of the request, or None when it is not limited """
+    endpoint = request.endpoint
+    if endpoint is None or endpoint in EXEMPT_ENDPOINTS or request.url_rule.rule.startswith("/admin/"):
+        return None
+    if endpoint in ROUTE_CLASSES:
+        return ROUTE_CLASSES[endpoint]
+    return "search" if request.method in ("GET", "HEAD") else "write"
+
+
+def limiters(app):
+    """ Returns the limiters of an app, created from ADMISSION_LIMITS on first use """
+    found = app.extensions.get("admission")
+    if found is None:
+        limits = app.config.get("ADMISSION_LIMITS") or {}
+        found = app.extensions["admission"] = dict(
+            (name, Limiter(name, int(limits.get(name, 16)))) for name in CLASSES)
+    return found
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+def admit_request():
+    """ Waits for a slot of the class of the request, or sheds it """
+    config = current_app.config
+    if not config.get("ADMISSION_CONTROL", True):
+        return
+    name = route_class()
+    if name is None:
+        return
+    limiter = limiters(current_app)[name]
+    if not limiter.acquire(config.get("ADMISSION_QUEUE_SIZE", 16), config.get("ADMISSION_QUEUE_SECONDS", 1)):
+        retry_after = limiter.retry_after()
+        logger.warning("Shedding %s %s: %d %s requests running, %d waiting",
+                       request.method, request.path, limiter.running, name, limiter.waiting)
+        raise Overloaded("Too many {} requests are running, retry in {} seconds".format(name, retry_after),
+                         retry_after)
+    g.admission = (limiter, time.time())
+
+
+def release_request(exception=None):
+    """ Gives the slot of the request back once its response is sent """
+    admission = g.pop("admission", None)
+    if admission is not None:
+        limiter, started = admission
+        limiter.release(time.time() - started, current_app.config.get("ADMISSION_LATENCY_TOLERANCE", 2.0))
+
+
+def metrics(app):
+    """ Returns the limit, running and waiting requests of every class """
+    return dict((name, limiter.metrics()) for name, limiter in limiters(app).items())
+
+
+def init_app(app):
+    """ Registers the admission hooks """
+    app.before_request(admit_request)
+    app.teardown_request(release_request)
@@ -0,0 +1,175 @@
+# Allocation Tracing
+
+"""
+Memory allocation tracing per route, with tracemalloc snapshots
+
+When tracing is on (POST /admin/tracemalloc, or TRACEMALLOC at start up)
+Python records where every block of memory is allocated. A share of the
+requests, TRACEMALLOC_SAMPLE_RATE, is then sampled: a snapshot of the
+allocations is taken before the request and another once its response is
+sent, both after a garbage collection, so that their difference is the
+memory the request left behind. The differences are added up per route
+template (i.e. "GET /pats/<int:pat_id>") and allocation site, the
+traceback of TRACEMALLOC_FRAMES frames leading to the allocation, and
+GET /admin/tracemalloc returns the sites growing the most per route. A
+site that keeps growing with the number of requests, i.e. objects kept in
+the session identity map or serialization buffers, is a leak.
+
+Snapshots cover the whole process, so only one request at a time is
+sampled; the memory allocated meanwhile by other requests still shows up,
+which averages out over many samples. Each worker traces on its own: the
+admin routes reach the worker that happens to take the request.
+
+Configuration
+-------------
+TRACEMALLOC - start tracing with the worker
+TRACEMALLOC_SAMPLE_RATE - the share of the requests sampled
+TRACEMALLOC_FRAMES - the frames of the tracebacks of the allocation sites
+TRACEMALLOC_TOP - the sites returned per route
+"""
+import gc
+import random
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from flask import g, request, current_app
+from service.models import DataValidationError
+
+logger = logging.getLogger("gunicorn.error")
+
+# Endpoints never sampled
+EXEMPT_ENDPOINTS = ("static", "stream_subscription", "get_tracemalloc", "start_tracemalloc", "stop_tracemalloc")
+
+# Sites kept per route, as a multiple of the sites returned
+KEPT_SITES = 5
+
+# Allocations of the tracing itself and of imports
+IGNORED = (tracemalloc.Filter(False, tracemalloc.__file__),
+           tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+           tracemalloc.Filter(False, "<unknown>"))
+
+
+class Tracer():
+    """ The allocation differences of the sampled requests, per route and site """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sampling = threading.Lock()
+        self.sample_rate = 0
+        self.routes = {}        # route -> [requests, Counter of size, Counter of count]
+
+    def start(self, sample_rate, frames):
+        """ Starts tracing, forgetting the earlier differences """
+        if not 0 < sample_rate <= 1:
+            raise DataValidationError("Invalid sampleRate: must be in (0, 1]")
+        if not 1 <= frames <= 100:
+            raise DataValidationError("Invalid frames: must be from 1 to 100")
+        with self.lock:
+            if tracemalloc.is_tracing() and tracemalloc.get_traceback_limit() != frames:
+                tracemalloc.stop()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.sample_rate = sample_rate
+            self.routes = {}
+        logger.info("Tracing allocations of %s of the requests", sample_rate)
+
+    def stop(self):
+        """ Stops tracing and forgets the differences """
+        with self.lock:
+            self.sample_rate = 0
+            self.routes = {}
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def add(self, route, before, after, top):
+        """ Adds the differences between two snapshots to the route """
+        differences = after.filter_traces(IGNORED).compare_to(before.filter_traces(IGNORED), "traceback")
+        with self.lock:
+            totals = self.routes.setdefault(route, [0, Counter(), Counter()])
+            totals[0] += 1
+            for difference in differences:
+                if difference.size_diff or difference.count_diff:
+                    site = tuple(str(frame) for frame in difference.traceback)
+                    totals[1][site] += difference.size_diff
+                    totals[2][site] += difference.count_diff
+            #the sites that grew the least are forgotten
+            if len(totals[1]) > top * KEPT_SITES:
+                kept = set(site for site, _ in totals[1].most_common(top * KEPT_SITES))
+                for site in list(totals[1]):
+                    if site not in kept:
+                        del totals[1][site]
+                        del totals[2][site]
+
+    def report(self, top, route=None):
+        """ Returns the sites that grew the most per route """
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            routes = []
+            for name, (requests, sizes, counts) in sorted(self.routes.items()):
+                if route is not None and name != route:
+                    continue
+                routes.append({
+                    "route": name,
+                    "requests": requests,
+                    "sizeDiff": sum(sizes.values()),
+                    "top": [{"site": site[-1] if site else "?",
+                             "traceback": list(site),
+                             "sizeDiff": size,
+                             "countDiff": counts[site],
+                             "sizePerRequest": size // requests}
+                            for site, size in sizes.most_common(top)],
+                })
+            return {
+                "tracing": tracemalloc.is_tracing(),
+                "sampleRate": self.sample_rate,
+                "traced": {"current": current, "peak": peak},
+                "routes": routes,
+            }
+
+
+def route_template():
+    """ Returns the method and URL rule of the request, i.e. "GET /pats/<int:pat_id>" """
+    return "{} {}".format(request.method, request.url_rule.rule)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+def snapshot_before():
+    """ Snapshots the allocations before a sampled request """
+    if not tracer.sample_rate or not tracemalloc.is_tracing() or request.url_rule is None \
+            or request.endpoint in EXEMPT_ENDPOINTS or random.random() >= tracer.sample_rate:
+        return
+    #one sampled request at a time, so that they do not count each other's memory
+    if not tracer.sampling.acquire(False):
+        return
+    gc.collect()
+    g.allocations = (route_template(), tracemalloc.take_snapshot())
+
+
+def snapshot_after(exception=None):
+    """ Adds up what a sampled request left allocated once its response is sent """
+    sample = g.pop("allocations", None)
+    if sample is None:
+        return
+    try:
+        route, before = sample
+        if tracemalloc.is_tracing():
+            gc.collect()
+            tracer.add(route, before, tracemalloc.take_snapshot(), current_app.config.get("TRACEMALLOC_TOP", 20))
+    finally:
+        tracer.sampling.release()
+
+
+def init_app(app):
+    """ Registers the sampling hooks, and starts tracing when configured """
+    app.before_request(snapshot_before)
+    app.teardown_request(snapshot_after)
+    if app.config.get("TRACEMALLOC"):
+        tracer.start(app.config.get("TRACEMALLOC_SAMPLE_RATE", 0.1), app.config.get("TRACEMALLOC_FRAMES", 10))
+
+
+# the tracer of this process
+tracer = Tracer()
@@ -0,0 +1,392 @@
+# Patient Analytics
+
+"""
+In-memory columnar snapshot of the patients, for population counts
+
+GET /pats/$analytics?age=ge65&gender=female,unknown&zip=902&groupBy=ageBand
+counts the patients matching filters over the whole population without a
+database query. The process keeps one NumPy array per attribute, in id
+order:
+  ids      - Pprofile.id
+  dob      - Pprofile.DOB as a day number
+  gender   - Pprofile.gender as its enum value, 0 when unknown
+  active   - Pprofile.active
+  zip      - the first 5 digits of the first postal code, -1 when none
+  family   - the family name of the first name, as a vocabulary code
+  given    - the first given name of the first name, as a vocabulary code
+  alive    - False for a deleted patient, until the arrays are compacted
+and a filter is one comparison per array, which NumPy runs in microseconds.
+
+The snapshot is built on the first request by one ordered pass over the
+pprofile, pname and paddress tables (on every shard when sharded), then
+kept up to date from the change history that the writes record (see
+PatientHistory), at most every ANALYTICS_REFRESH_SECONDS. Like the change
+feed it lags the writes by HISTORY_SETTLE_SECONDS.
+
+Configuration
+-------------
+ANALYTICS_SNAPSHOT - keep the snapshot and serve GET /pats/$analytics
+ANALYTICS_REFRESH_SECONDS - how often the snapshot reads the change history
+STATS_AGE_BANDS - the ages starting an age band, as for GET /pats/$stats
+"""
+import re
+import json
+import time
+import logging
+import threading
+from array import array
+from datetime import date, datetime
+import numpy as np
+from service import sharding
+from service.models import db, Pprofile, Pname, Paddress, PatientHistory, Gender, DataValidationError, \
+    birthdate_bounds
+from service.stats import age_bands, born_before, parse_dimensions
+
+logger = logging.getLogger("gunicorn.error")
+
+ANALYTICS_PARAMS = ("gender", "active", "family", "given", "zip", "birthdate", "age", "groupBy")
+DIMENSIONS = ("gender", "active", "ageBand")
+
+# Rows read at a time by the scan, and change history entries per refresh page
+BATCH_SIZE = 5000
+
+# An age search value, i.e. "ge65"
+ageParam = re.compile(r"^(eq|ne|lt|le|gt|ge)?(\d{1,3})$")
+
+
+######################################################################
+#  S C A N
+######################################################################
+
+def first_rows(rows):
+    """ Yields the first of the rows of each patient, from rows ordered by patient """
+    last = None
+    for row in rows:
+        if row[0] != last:
+            last = row[0]
+            yield row
+
+
+def scan():
+    """
+    Returns the columns of the patients of the current database, as lists
+
+    The profiles, names and addresses are each streamed in patient order and
+    merged as they are read, keeping the first name and address of each.
+    """
+    def stream(query):
+        return iter(query.execution_options(stream_results=True).yield_per(BATCH_SIZE))
+
+    profiles = stream(db.session.query(Pprofile.id, Pprofile.DOB, Pprofile.gender, Pprofile.active)
+                      .order_by(Pprofile.id))
+    names = first_rows(stream(db.session.query(Pname.pprofile_id, Pname.family, Pname.given_1)
+                              .order_by(Pname.pprofile_id, Pname.id)))
+    addresses = first_rows(stream(db.session.query(Paddress.pprofile_id, Paddress.postalCode)
+                                  .order_by(Paddress.pprofile_id, Paddress.id)))
+    columns = {"ids": array("q"), "dob": array("l"), "gender": array("b"), "active": array("b"),
+               "zip": array("l"), "family": [], "given": []}
+    name = next(names, None)
+    address = next(addresses, None)
+    for pat_id, birth, gender, active in profiles:
+        while name is not None and name[0] < pat_id:
+            name = next(names, None)
+        while address is not None and address[0] < pat_id:
+            address = next(addresses, None)
+        columns["ids"].append(pat_id)
+        columns["dob"].append(birth.toordinal())
+        columns["gender"].append(gender.value if gender is not None else 0)
+        columns["active"].append(bool(active))
+        columns["zip"].append(zip_number(address[1] if address is not None and address[0] == pat_id else None))
+        has_name = name is not None and name[0] == pat_id
+        columns["family"].append(name[1] if has_name else None)
+        columns["given"].append(name[2] if has_name else None)
+    return columns
+
+
+def zip_number(postal_code):
+    """ Returns the first 5 digits of a postal code as a number, -1 when there are none """
+    digits = (postal_code or "")[:5]
+    return int(digits) if len(digits) == 5 and digits.isdigit() else -1
+
+
+def resource_row(document):
+    """ Returns the (dob, gender, active, zip, family, given) of a serialized patient """
+    names = document.get("name") or [{}]
+    addresses = document.get("address") or [{}]
+    gender = Gender.__members__.get(document.get("gender"))
+    return (datetime.strptime(document["birthDate"], "%Y-%m-%d").toordinal(),
+            gender.value if gender is not None else 0,
+            bool(document.get("active")),
+            zip_number(addresses[0].get("postalCode")),
+            names[0].get("family"),
+            (names[0].get("given") or [None])[0])
+
+
+######################################################################
+#  S N A P S H O T
+######################################################################
+
+class Snapshot():
+    """
+    The columns of every patient, and the cursor of the changes they include
+
+    The names are kept as codes into one vocabulary shared by the family and
+    given names, -1 standing for no name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = threading.Event()
+        self.columns = None
+        self.vocabulary = {}
+        self.cursor = None
+        self.refreshed = 0
+        self.refreshing = False
+        self.deleted = 0
+
+    def clear(self):
+        """ Drops the snapshot, which is built again on the next query """
+        with self.lock:
+            self.built.clear()
+            self.columns = None
+            self.vocabulary = {}
+            self.cursor = None
+            self.deleted = 0
+
+    def encode(self, name):
+        """ Returns the vocabulary code of a name """
+        if name is None:
+            return -1
+        return self.vocabulary.setdefault(name, len(self.vocabulary))
+
+    @staticmethod
+    def read():
+        """ Returns the cursor of the changes to apply after a scan, and the scanned patients """
+        #the changes from the settled position on are applied again after the scan, so that a
+        #write still committing when the scan starts is not missed by both
+        cursor = PatientHistory.settled()
+        return cursor, sharding.scatter(scan) if sharding.needs_scatter() else [scan()]
+
+    @staticmethod
+    def changes(cursor):
+        """ Returns the changes after a cursor and the cursor after them """
+        changes = []
+        while True:
+            versions, cursor = PatientHistory.feed(None, cursor, BATCH_SIZE)
+            changes.extend(versions)
+            if len(versions) < BATCH_SIZE:
+                return changes, cursor
+
+    def build(self, parts):
+        """ Puts the scanned patients into new columns """
+        self.vocabulary = {}
+        columns = {
+            "ids": np.concatenate([np.array(part["ids"], dtype=np.int64) for part in parts]),
+            "dob": np.concatenate([np.array(part["dob"], dtype=np.int32) for part in parts]),
+            "gender": np.concatenate([np.array(part["gender"], dtype=np.int8) for part in parts]),
+            "active": np.concatenate([np.array(part["active"], dtype=np.bool_) for part in parts]),
+            "zip": np.concatenate([np.array(part["zip"], dtype=np.int32) for part in parts]),
+            "family": np.array([self.encode(name) for part in parts for name in part["family"]], dtype=np.int32),
+            "given": np.array([self.encode(name) for part in parts for name in part["given"]], dtype=np.int32),
+        }
+        order = np.argsort(columns["ids"], kind="mergesort")
+        self.columns = dict((key, values[order]) for key, values in columns.items())
+        self.columns["alive"] = np.ones(len(order), dtype=np.bool_)
+        self.deleted = 0
+
+    def apply(self, versions):
+        """ Updates the columns with changes
+
+        Args:
+            versions (list): (pat_id, version_id, method, lastUpdated, resource) tuples, oldest first
+        """
+        #only the last change of a patient counts
+        latest = dict((version[0], version[4] if version[2] != "delete" else None) for version in versions)
+        ids = np.array(sorted(latest), dtype=np.int64)
+        columns = self.columns
+        positions = np.searchsorted(columns["ids"], ids)
+        known = positions < len(columns["ids"])
+        known[known] = columns["ids"][positions[known]] == ids[known]
+        added = []
+        for pat_id, position, found in zip(ids.tolist(), positions.tolist(), known.tolist()):
+            resource = latest[pat_id]
+            if resource is None:
+                if found and columns["alive"][position]:
+                    columns["alive"][position] = False
+                    self.deleted += 1
+                continue
+            dob, gender, active, zip_code, family, given = resource_row(json.loads(resource))
+            row = (dob, gender, active, zip_code, self.encode(family), self.encode(given))
+            if not found:
+                added.append((pat_id,) + row)
+                continue
+            if not columns["alive"][position]:
+                columns["alive"][position] = True
+                self.deleted -= 1
+            for key, value in zip(("dob", "gender", "active", "zip", "family", "given"), row):
+                columns[key][position] = value
+        if added:
+            new = dict((key, np.array([row[index] for row in added], dtype=columns[key].dtype))
+                       for index, key in enumerate(("ids", "dob", "gender", "active", "zip", "family", "given")))
+            new["alive"] = np.ones(len(added), dtype=np.bool_)
+            merged = dict((key, np.concatenate([columns[key], new[key]])) for key in columns)
+            order = np.argsort(merged["ids"], kind="mergesort")
+            self.columns = columns = dict((key, values[order]) for key, values in merged.items())
+        #the deleted patients are dropped once they are half of the rows
+        if self.deleted and self.deleted * 2 >= len(columns["ids"]):
+            alive = columns["alive"]
+            self.columns = dict((key, values[alive]) for key, values in columns.items())
+            self.deleted = 0
+
+    def refresh(self, config):
+        """
+        Builds the snapshot, or applies the changes since the last refresh when it is due
+
+        One request at a time reads the database, without holding the lock;
+        the others go on with the snapshot as it is, or wait for the first
+        build of the process.
+        """
+        while True:
+            with self.lock:
+                building = self.columns is None
+                if not building and time.time() - self.refreshed < config.get("ANALYTICS_REFRESH_SECONDS", 1):
+                    return
+                if not self.refreshing:
+                    self.refreshing = True
+                    cursor = self.cursor
+                    break
+            if not building:
+                return
+            self.built.wait(1)
+        try:
+            started = time.time()
+            parts = None
+            if building:
+                cursor, parts = self.read()
+            versions, cursor = self.changes(cursor)
+            with self.lock:
+                if parts is None and self.columns is None:
+                    return      # cleared meanwhile, the next query builds it again
+                if parts is not None:
+                    self.build(parts)
+                    logger.info("Built the analytics snapshot of %d patients in %.2fs",
+                                len(self.columns["ids"]), time.time() - started)
+                if versions:
+                    self.apply(versions)
+                self.cursor = cursor
+                self.refreshed = time.time()
+                self.built.set()
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def select(self, args, today):
+        """ Returns the mask of the patients matching the filters
+
+        Args:
+            args (MultiDict): the filters, see ANALYTICS_PARAMS
+            today (date): the day the ages are computed on
+        """
+        columns = self.columns
+        selected = columns["alive"].copy()
+        if args.get("gender"):
+            codes = []
+            for name in args.get("gender").split(","):
+                if name.strip() not in Gender.__members__:
+                    raise DataValidationError("Invalid gender: " + name)
+                codes.append(Gender[name.strip()].value)
+            selected &= np.isin(columns["gender"], codes)
+        if args.get("active"):
+            active_str = args.get("active").lower()
+            if active_str not in ("true", "false"):
+                raise DataValidationError("Invalid active value: " + active_str)
+            selected &= columns["active"] == (active_str == "true")
+        for name in ("family", "given"):
+            if args.get(name):
+                selected &= columns[name] == self.vocabulary.get(args.get(name), -2)
+        if args.get("zip"):
+            prefix = args.get("zip")
+            if not prefix.isdigit() or len(prefix) > 5:
+                raise DataValidationError("Invalid zip prefix: " + prefix)
+            selected &= (columns["zip"] >= 0) & (columns["zip"] // 10 ** (5 - len(prefix)) == int(prefix))
+        for value in args.getlist("birthdate"):
+            prefix, lower, upper = birthdate_bounds(value)
+            selected &= date_mask(columns["dob"], prefix, lower.toordinal(), upper.toordinal())
+        for value in args.getlist("age"):
+            match = ageParam.match(value)
+            if not match:
+                raise DataValidationError("Invalid age search value: " + value)
+            prefix, age = match.group(1) or "eq", int(match.group(2))
+            #the people of an age were born in [born_before(age + 1), born_before(age))
+            selected &= date_mask(columns["dob"], {"gt": "lt", "ge": "le", "lt": "gt", "le": "ge"}.get(prefix, prefix),
+                                  born_before(today, age + 1).toordinal(), born_before(today, age).toordinal())
+        return selected
+
+    def count(self, args, dimensions, today, bands):
+        """ Returns (total, {group values: count}) of the patients matching the filters """
+        columns = self.columns
+        selected = self.select(args, today)
+        total = int(np.count_nonzero(selected))
+        if not dimensions:
+            return total, {}
+
+        labels = age_bands(bands)
+        #the births after the start of a band are those younger than it
+        starts = np.array(sorted(born_before(today, age).toordinal() for age in bands), dtype=np.int32)
+        codes = {
+            "gender": (columns["gender"].astype(np.int64), [None] + [gender.name for gender in Gender]),
+            "active": (columns["active"].astype(np.int64), [False, True]),
+            "ageBand": (len(bands) - np.searchsorted(starts, columns["dob"], side="right"), labels),
+        }
+        keys = np.zeros(len(columns["ids"]), dtype=np.int64)
+        for name in dimensions:
+            keys = keys * len(codes[name][1]) + codes[name][0]
+        values, counts = np.unique(keys[selected], return_counts=True)
+        groups = {}
+        for value, count in zip(values.tolist(), counts.tolist()):
+            group = []
+            for name in reversed(dimensions):
+                value, code = divmod(value, len(codes[name][1]))
+                group.insert(0, codes[name][1][code])
+            groups[tuple(group)] = count
+        return total, groups
+
+
+def date_mask(days, prefix, lower, upper):
+    """ Returns the mask of the day numbers matching a FHIR date prefix and range """
+    if prefix == "eq":
+        return (days >= lower) & (days < upper)
+    if prefix == "ne":
+        return (days < lower) | (days >= upper)
+    if prefix in ("lt", "eb"):
+        return days < lower
+    if prefix == "le":
+        return days < upper
+    if prefix in ("gt", "sa"):
+        return days >= upper
+    return days >= lower      # ge
+
+
+def analytics(args, config):
+    """
+    Returns the patient counts per group of the groupBy dimensions, from the snapshot
+
+    Args:
+        args (MultiDict): the request parameters, see ANALYTICS_PARAMS
+        config (dict): the app configuration
+    """
+    for name in args:
+        if name not in ANALYTICS_PARAMS:
+            raise DataValidationError("Invalid analytics parameter: " + name)
+    dimensions = parse_dimensions(args, DIMENSIONS)
+    bands = list(config.get("STATS_AGE_BANDS") or [])
+    snapshot.refresh(config)
+    with snapshot.lock:
+        total, counts = snapshot.count(args, dimensions, date.today(), bands)
+    groups = [dict(zip(dimensions, values), count=count)
+              for values, count in sorted(counts.items(), key=lambda item: [str(value) for value in item[0]])]
+    return {"total": total, "groupBy": dimensions, "groups": groups}
+
+
+# the snapshot of this process
+snapshot = Snapshot()
@@ -0,0 +1,175 @@
+# Request Coalescing
+
+"""
+Single-flight coalescing of identical concurrent reads
+
+When many clients ask for the same patient or search at once, only the
+first request (the leader) runs the query and renders the response; the
+identical requests arriving while it runs wait for it and get a copy of
+its response. Two requests are identical when they go to the same route
+with the same path values, the same query parameters (in any order), the
+same negotiated media type and the same database (the primary or a read
+replica).
+
+A client that has just written (see routing, READ_YOUR_WRITES_SECONDS)
+only waits for a read that started after its write, so that it always
+sees its own changes; it runs the read itself otherwise.
+
+A streamed response is shared when it holds at most COALESCE_MAX_BYTES;
+a larger one, a failed leader or a leader running for longer than
+COALESCE_WAIT_SECONDS leaves the waiting requests to run on their own.
+
+The requests waiting on each key in flight, and the totals since the
+process started, are returned by metrics() (GET /admin/coalescing).
+
+Configuration
+-------------
+COALESCE_REQUESTS - coalesce the identical reads
+COALESCE_WAIT_SECONDS - the longest a request waits for the leader
+COALESCE_MAX_BYTES - largest streamed response shared
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, g, request, current_app, make_response
+from service.negotiation import response_type
+
+logger = logging.getLogger("gunicorn.error")
+
+# Number of keys whose waiter counts are kept, most recent first
+METRICS_KEYS = 100
+
+_lock = threading.Lock()
+_flights = {}
+_totals = {"leaders": 0, "coalesced": 0, "unshared": 0, "timeouts": 0, "after_write": 0}
+_waiters = OrderedDict()
+
+
+class Flight():
+    """ A read in flight, and the response it shares once done """
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.done = threading.Event()
+        self.waiters = 0
+        self.shared = None
+
+
+def request_key(view_args):
+    """ Returns the key of the requests answered the same way as this one """
+    args = tuple(sorted((name, tuple(request.args.getlist(name))) for name in request.args))
+    #a client reading its own writes from the primary must not get a replica's answer
+    return (request.method, request.endpoint, tuple(sorted(view_args.items())), args, response_type(),
+            g.get("replica_bind") is None)
+
+
+def shareable(response, max_bytes):
+    """ Returns the (status, headers, body) of a response, reading a small streamed body, or None """
+    if response.is_streamed:
+        body = iter(response.response)
+        head, size = [], 0
+        for chunk in body:
+            chunk = chunk.encode(response.charset) if isinstance(chunk, str) else chunk
+            head.append(chunk)
+            size += len(chunk)
+            if size > max_bytes:
+                break
+        #the leader still streams its response, the rest of it when too large to keep
+        response.response = chain(head, body)
+        if size > max_bytes:
+            return None
+        return response.status_code, list(response.headers), b"".join(head)
+    return response.status_code, list(response.headers), response.get_data()
+
+
+def chain(head, body):
+    """ Yields the chunks already read and then the rest of a body """
+    try:
+        for chunk in head:
+            yield chunk
+        for chunk in body:
+            yield chunk
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+def coalesced(view):
+    """ Makes the identical concurrent requests of a read route share one response """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        if not config.get("COALESCE_REQUESTS", True):
+            return view(*args, **kwargs)
+        key = request_key(kwargs)
+        written_at = g.get("written_at")
+        with _lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = Flight(request.method + " " + request.full_path.rstrip("?"))
+                _totals["leaders"] += 1
+            elif written_at is not None and flight.started < written_at:
+                #the leader may have read before the write of the client, which it must see
+                _totals["after_write"] += 1
+                flight = None
+            else:
+                flight.waiters += 1
+        if flight is None:
+            return view(*args, **kwargs)
+        if not leader:
+            return follow(flight, view, args, kwargs, config.get("COALESCE_WAIT_SECONDS", 30))
+
+        try:
+            response = make_response(view(*args, **kwargs))
+            flight.shared = shareable(response, config.get("COALESCE_MAX_BYTES", 1024 * 1024))
+        finally:
+            with _lock:
+                del _flights[key]
+                if flight.waiters:
+                    _waiters[flight.label] = _waiters.pop(flight.label, 0) + flight.waiters
+                    while len(_waiters) > METRICS_KEYS:
+                        _waiters.popitem(last=False)
+            flight.done.set()
+        return response
+    return wrapper
+
+
+def follow(flight, view, args, kwargs, timeout):
+    """ Returns a copy of the response of the leader, or runs the view when there is none """
+    if not flight.done.wait(timeout):
+        logger.warning("Gave up waiting for %s after %ss", flight.label, timeout)
+        with _lock:
+            _totals["timeouts"] += 1
+        return view(*args, **kwargs)
+    if flight.shared is None:
+        with _lock:
+            _totals["unshared"] += 1
+        return view(*args, **kwargs)
+    with _lock:
+        _totals["coalesced"] += 1
+    status_code, headers, body = flight.shared
+    return Response(body, status_code, headers)
+
+
+def metrics():
+    """ Returns the requests waiting per key in flight, and the totals of this process """
+    now = time.time()
+    with _lock:
+        return {
+            "inflight": [{"key": flight.label, "waiters": flight.waiters, "seconds": round(now - flight.started, 3)}
+                         for flight in _flights.values()],
+            "waiters": [{"key": label, "waiters": count} for label, count in reversed(_waiters.items())],
+            "totals": dict(_totals),
+        }
+
+
+def reset_metrics():
+    """ Forgets the totals and waiter counts """
+    with _lock:
+        _waiters.clear()
+        for name in _totals:
+            _totals[name] = 0
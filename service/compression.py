@@ -0,0 +1,169 @@
+# HTTP Compression
+
+"""
+Compression of responses and request bodies
+
+Responses are compressed with brotli (when the brotli package is
+installed) or gzip, as negotiated with Accept-Encoding. Streamed
+responses, like GET /pats, are compressed chunk by chunk as they are
+generated. Bodies smaller than COMPRESSION_MIN_SIZE are sent as is.
+
+Request bodies sent with Content-Encoding: gzip are decompressed before
+the routes read them, up to MAX_DECOMPRESSED_SIZE bytes.
+
+Configuration
+-------------
+COMPRESSION_MIN_SIZE - smallest body, in bytes, worth compressing
+COMPRESSION_LEVEL - gzip level, 1 (fast) to 9 (small)
+BROTLI_QUALITY - brotli quality, 0 (fast) to 11 (small)
+MAX_DECOMPRESSED_SIZE - largest request body accepted once decompressed
+"""
+import io
+import zlib
+import logging
+from flask import request, current_app, abort
+from flask_api import status  # HTTP Status Codes
+from werkzeug.wsgi import get_input_stream
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+logger = logging.getLogger("gunicorn.error")
+
+# zlib window bits producing and reading a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Media types worth compressing, either exactly or as a prefix
+COMPRESSIBLE_TYPES = ("application/json", "application/fhir+json", "application/json-patch+json",
+                      "application/msgpack", "application/cbor", "text/")
+
+
+def available_encodings():
+    """ Returns the content codings this service can produce, preferred first """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def choose_encoding():
+    """ Returns the preferred encoding accepted by the client, or None """
+    best, best_quality = None, 0
+    for encoding in available_encodings():
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compressor(encoding):
+    """ Returns (compress, finish) functions of a new compression stream """
+    if encoding == "br":
+        stream = brotli.Compressor(quality=current_app.config.get("BROTLI_QUALITY", 4))
+        return stream.process, stream.finish
+    stream = zlib.compressobj(current_app.config.get("COMPRESSION_LEVEL", 6), zlib.DEFLATED, GZIP_WBITS)
+    return stream.compress, stream.flush
+
+
+def is_compressible(response):
+    """ Returns True when the response body may be compressed """
+    mimetype = response.mimetype or ""
+    #server-sent events must reach the client as they come
+    if mimetype == "text/event-stream":
+        return False
+    return 200 <= response.status_code < 300 and response.status_code != status.HTTP_204_NO_CONTENT \
+        and request.method != "HEAD" and not response.direct_passthrough \
+        and "Content-Encoding" not in response.headers \
+        and any(mimetype == kind or (kind.endswith("/") and mimetype.startswith(kind))
+                for kind in COMPRESSIBLE_TYPES)
+
+
+def compressed_stream(head, body, encoding, charset):
+    """ Compresses the buffered head and then the rest of a streamed body """
+    compress, finish = compressor(encoding)
+    try:
+        for chunk in head:
+            data = compress(chunk)
+            if data:
+                yield data
+        for chunk in body:
+            data = compress(chunk.encode(charset) if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+def compress_response(response):
+    """ Compresses the response body when the client accepts it """
+    if not is_compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    min_size = current_app.config.get("COMPRESSION_MIN_SIZE", 0)
+
+    if not response.is_streamed:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        compress, finish = compressor(encoding)
+        response.set_data(compress(data) + finish())
+    else:
+        #read the start of the stream to know if it is worth compressing
+        body = iter(response.response)
+        head, size = [], 0
+        for chunk in body:
+            chunk = chunk.encode(response.charset) if isinstance(chunk, str) else chunk
+            head.append(chunk)
+            size += len(chunk)
+            if size >= min_size:
+                break
+        else:
+            response.set_data(b"".join(head))
+            return response
+        response.response = compressed_stream(head, body, encoding, response.charset)
+        response.headers.pop("Content-Length", None)
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def decompress_request():
+    """ Replaces a gzip request body by its decompressed content """
+    encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    if encoding in ("", "identity"):
+        return
+    if encoding not in ("gzip", "x-gzip"):
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              "Content-Encoding must be gzip or identity, not {}".format(encoding))
+    limit = current_app.config.get("MAX_DECOMPRESSED_SIZE", 16 * 1024 * 1024)
+    #the environ is swapped before anything reads the body, so that
+    #request.get_json() and request.form see the decompressed data
+    environ = request.environ
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    try:
+        body = decompressor.decompress(get_input_stream(environ).read(), limit + 1)
+    except zlib.error as error:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid gzip request body: {}".format(error))
+    if len(body) > limit:
+        abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+              "The decompressed request body is larger than {} bytes".format(limit))
+    if not decompressor.eof:
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid gzip request body: truncated")
+    logger.debug("Decompressed a %s request body of %d bytes", encoding, len(body))
+    environ["wsgi.input"] = io.BytesIO(body)
+    environ["CONTENT_LENGTH"] = str(len(body))
+    environ.pop("wsgi.input_terminated", None)
+
+
+def init_app(app):
+    """ Registers the compression hooks """
+    app.before_request(decompress_request)
+    app.after_request(compress_response)
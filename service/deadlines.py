@@ -0,0 +1,179 @@
+# Request Deadlines
+
+"""
+Per-request deadlines, enforced by the database as statement timeouts
+
+Every request gets a time budget: the deadline of its route, from
+REQUEST_DEADLINES (by endpoint name, i.e. "list_pats", or by class of
+route, see admission.route_class()), shortened by the client with an
+X-Request-Timeout header in seconds. The database statements of the
+request, including those run on the shards by sharding.scatter(), are
+then limited to the budget left:
+  PostgreSQL - SET LOCAL statement_timeout, which counts from the start of
+               each statement, so it is sent again before a statement once
+               the time left is TIMEOUT_SLACK_SECONDS below the last one
+  SQLite     - a progress handler interrupting the statement
+so that a search matching most of the table stops when the budget runs
+out, and its worker and connection are freed. The request then ends with
+503 and an OperationOutcome (see service.deadline_exceeded()). A streamed
+response runs its query up to the first row under the deadline (see
+until_first()), so that a query out of time still gets its 503; the budget
+ends there, and a client reading the rest slowly gets it whole.
+
+Configuration
+-------------
+REQUEST_DEADLINES - the budget in seconds per endpoint or class of route
+"""
+import time
+import sqlite3
+import logging
+import itertools
+from flask import g, request, current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from service.models import db, DataValidationError
+from service.admission import route_class
+
+logger = logging.getLogger("gunicorn.error")
+
+DEADLINE_HEADER = "X-Request-Timeout"
+
+# SQLite virtual machine instructions between two checks of the deadline
+SQLITE_CHECK_STEPS = 1000
+
+# Seconds a PostgreSQL statement may outlast the deadline rather than cost
+# another SET LOCAL round trip
+TIMEOUT_SLACK_SECONDS = 0.1
+
+# PostgreSQL error code of a statement canceled by statement_timeout
+QUERY_CANCELED = "57014"
+
+
+class DeadlineExceeded(Exception):
+    """ Used when a request runs out of time """
+
+
+def remaining():
+    """ Returns the seconds left to the request, or None when it has no deadline """
+    deadline = g.get("request_deadline") if has_app_context() else None
+    return None if deadline is None else deadline - time.time()
+
+
+def is_timeout(error):
+    """ Returns True when a database error is a statement stopped by the deadline """
+    orig = getattr(error, "orig", None)
+    if getattr(orig, "pgcode", None) == QUERY_CANCELED:
+        return True
+    return isinstance(orig, sqlite3.OperationalError) and "interrupted" in str(orig)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+def start_deadline():
+    """ Sets the deadline of the request from its route and the client header """
+    deadlines = current_app.config.get("REQUEST_DEADLINES") or {}
+    budget = deadlines.get(request.endpoint)
+    if budget is None:
+        name = route_class()
+        budget = deadlines.get(name) if name is not None else None
+    header = request.headers.get(DEADLINE_HEADER)
+    if header is not None:
+        try:
+            asked = float(header)
+        except ValueError:
+            raise DataValidationError("Invalid {}: {}".format(DEADLINE_HEADER, header))
+        if asked <= 0:
+            raise DeadlineExceeded("The request arrived after its deadline")
+        budget = asked if budget is None else min(budget, asked)
+    if budget is not None:
+        g.request_deadline = time.time() + budget
+
+
+def until_first(items):
+    """
+    Returns the items of a streamed response, the first one read under the deadline
+
+    The deadline of the request ends once it is read, as the response can
+    then only be cut short; a statement still running on PostgreSQL keeps
+    the last timeout sent, which does not count the time the client takes.
+    """
+    items = iter(items)
+    first = list(itertools.islice(items, 1))
+    g.pop("request_deadline", None)
+    return itertools.chain(first, items)
+
+
+def out_of_time():
+    """ Returns 1, stopping the running SQLite statement, once the request is out of time """
+    left = remaining()
+    return 1 if left is not None and left <= 0 else 0
+
+
+def forget_deadline(exception=None):
+    """ Drops the deadline once the request is over """
+    g.pop("request_deadline", None)
+
+
+def limit_statements(session, transaction, connection):
+    """ Limits the statements of a new transaction to the time left to the request """
+    left = remaining()
+    raw = connection.connection
+    if isinstance(getattr(raw, "connection", raw), sqlite3.Connection):
+        #the handler stays with the pooled connection, so it is reset every time; it reads
+        #the deadline of the request, which ends once a streamed response starts
+        if left is None:
+            raw.set_progress_handler(None, 0)
+        else:
+            raw.set_progress_handler(out_of_time, SQLITE_CHECK_STEPS)
+    if left is None:
+        return
+    if left <= 0:
+        raise DeadlineExceeded("The request ran out of time before its query")
+
+
+def limit_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Limits a PostgreSQL statement to the time left to the request """
+    if conn.dialect.name != "postgresql":
+        return
+    left = remaining()
+    if left is None:
+        return
+    if left <= 0:
+        raise DeadlineExceeded("The request ran out of time before its query")
+    deadline = g.request_deadline
+    sent = conn.info.get("statement_timeout")
+    if sent is not None and sent[0] == deadline and left >= sent[1] - TIMEOUT_SLACK_SECONDS:
+        return
+    #on a cursor of its own: the cursor of the statement may be a named (server side)
+    #cursor, which runs a single query; the DBAPI cursor runs no listener again
+    raw = conn.connection.cursor()
+    try:
+        raw.execute("SET LOCAL statement_timeout = {:d}".format(max(1, int(left * 1000))))
+    finally:
+        raw.close()
+    conn.info["statement_timeout"] = (deadline, left)
+
+
+def forget_timeout(conn, *args):
+    """ Forgets the statement timeout sent, which ends with its transaction or savepoint """
+    conn.info.pop("statement_timeout", None)
+
+
+def forget_pooled_timeout(dbapi_connection, connection_record):
+    """ Forgets the statement timeout sent on a connection given back to the pool """
+    if connection_record is not None:
+        connection_record.info.pop("statement_timeout", None)
+
+
+def init_app(app):
+    """ Registers the deadline hooks """
+    app.before_request(start_deadline)
+    app.teardown_request(forget_deadline)
+    event.listen(db.session, "after_begin", limit_statements)
+    event.listen(Engine, "before_cursor_execute", limit_statement)
+    for name in ("begin", "commit", "rollback", "rollback_savepoint"):
+        event.listen(Engine, name, forget_timeout)
+    event.listen(Pool, "checkin", forget_pooled_timeout)
@@ -0,0 +1,337 @@
+# Duplicate Patient Detection
+
+"""
+Record linkage job finding probable duplicate patients
+
+Comparing every pair of patients does not scale, so the patients are first
+grouped into blocks sharing a blocking key, and only the pairs within a
+block are compared:
+  f:<first 4 letters of a family name>:<birth year>
+  d:<birth date>:<first letter of a given name>
+  z:<postal code>:<first 2 letters of a family name>
+
+The candidate pairs are then scored with NumPy, many pairs at a time, in
+a pool of processes: names by the Jaccard similarity of their character
+bigram sets (kept as 128 bit signatures), birth dates by their distance
+(transposed month and day count as close) and postal codes by their
+prefix. The pairs scoring at least DEDUP_MIN_SCORE are written to the
+match_candidate table, ranked by score.
+
+The scoring processes are started fresh (DEDUP_START_METHOD, "spawn" by
+default) rather than forked from a web worker and its threads or
+greenlets, and receive the features once, when they start. Only one job
+runs at a time: another one is refused until it is over, or until it has
+been running for DEDUP_JOB_TIMEOUT seconds and is taken for abandoned.
+
+Configuration
+-------------
+DEDUP_MIN_SCORE - lowest score of a match candidate
+DEDUP_MAX_BLOCK_SIZE - blocks with more patients are skipped (too common a key)
+DEDUP_CHUNK_PAIRS - pairs scored per task
+DEDUP_WORKERS - scoring processes, the number of cores when unset
+DEDUP_START_METHOD - how the scoring processes start, "spawn" or "forkserver"
+DEDUP_JOB_TIMEOUT - seconds after which a job still running is taken for abandoned
+"""
+import os
+import re
+import zlib
+import logging
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from flask import current_app
+from sqlalchemy import text
+from service import sharding
+from service.models import db, Pprofile, Pname, Paddress, DedupJob, MatchCandidate, DataConflictError, lock_id
+
+logger = logging.getLogger("gunicorn.error")
+
+# Weights of the similarities in the score
+WEIGHTS = {"family": 0.3, "given": 0.25, "birthdate": 0.3, "postal": 0.1, "gender": 0.05}
+
+# Bytes of the character bigram signature of a name
+SIGNATURE_BYTES = 16
+
+# Number of bits set in every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint16)
+
+# Features of the patients being scored, set once per scoring process by
+# load_features() instead of being sent with every task
+_features = {}
+
+
+######################################################################
+#  F E A T U R E S
+######################################################################
+
+def normalize(text):
+    """ Returns the letters of a name, lower cased """
+    return re.sub(r"[^a-z]", "", (text or "").lower())
+
+
+def signature(name):
+    """ Returns the set of hashed character bigrams of a name as 128 bits """
+    bits = bytearray(SIGNATURE_BYTES)
+    padded = " {} ".format(name)
+    for first, second in zip(padded, padded[1:]):
+        position = zlib.crc32((first + second).encode("utf-8")) % (SIGNATURE_BYTES * 8)
+        bits[position >> 3] |= 1 << (position & 7)
+    return bytes(bits)
+
+
+def load_records():
+    """ Returns the profile, name and postal code rows of the current database """
+    profiles = db.session.query(Pprofile.id, Pprofile.DOB, Pprofile.gender).order_by(Pprofile.id).all()
+    names = db.session.query(Pname.pprofile_id, Pname.family, Pname.given_1) \
+        .order_by(Pname.pprofile_id, Pname.id).all()
+    postal_codes = db.session.query(Paddress.pprofile_id, Paddress.postalCode) \
+        .order_by(Paddress.pprofile_id, Paddress.id).all()
+    return profiles, names, postal_codes
+
+
+def build_features(parts):
+    """
+    Returns the feature arrays of the patients and their blocks
+
+    Args:
+        parts (list): (profiles, names, postal_codes) rows, one per database
+    """
+    profiles = [row for part in parts for row in part[0]]
+    index = dict((row[0], position) for position, row in enumerate(profiles))
+    count = len(profiles)
+
+    names = {}
+    for part in parts:
+        for pat_id, family, given in part[1]:
+            names.setdefault(pat_id, []).append((normalize(family), normalize(given)))
+    postal_codes = {}
+    for part in parts:
+        for pat_id, postal_code in part[2]:
+            digits = (postal_code or "")[:5]
+            if digits.isdigit():
+                postal_codes.setdefault(pat_id, []).append(digits)
+
+    features = {
+        "ids": np.array([row[0] for row in profiles], dtype=np.int64),
+        "year": np.zeros(count, dtype=np.int32),
+        "month": np.zeros(count, dtype=np.int32),
+        "day": np.zeros(count, dtype=np.int32),
+        "days": np.zeros(count, dtype=np.int64),
+        "gender": np.zeros(count, dtype=np.int8),
+        "postal": np.zeros(count, dtype=np.int32),
+        "family": np.zeros((count, SIGNATURE_BYTES), dtype=np.uint8),
+        "given": np.zeros((count, SIGNATURE_BYTES), dtype=np.uint8),
+    }
+    blocks = {}
+    for pat_id, birth, gender in profiles:
+        position = index[pat_id]
+        features["year"][position] = birth.year
+        features["month"][position] = birth.month
+        features["day"][position] = birth.day
+        features["days"][position] = birth.toordinal()
+        features["gender"][position] = gender.value if gender is not None else 0
+        pat_names = names.get(pat_id) or [("", "")]
+        pat_postal_codes = postal_codes.get(pat_id) or []
+        # the first name and address are the ones scored
+        features["family"][position] = np.frombuffer(signature(pat_names[0][0]), dtype=np.uint8)
+        features["given"][position] = np.frombuffer(signature(pat_names[0][1]), dtype=np.uint8)
+        if pat_postal_codes:
+            features["postal"][position] = int(pat_postal_codes[0])
+        # every name and address makes blocking keys
+        keys = set()
+        for family, given in pat_names:
+            if family:
+                keys.add("f:{}:{}".format(family[:4], birth.year))
+            keys.add("d:{}:{}".format(birth.date().isoformat(), given[:1]))
+            for postal_code in pat_postal_codes:
+                keys.add("z:{}:{}".format(postal_code, family[:2]))
+        for key in keys:
+            blocks.setdefault(key, []).append(position)
+    return features, blocks
+
+
+def candidate_pairs(blocks, count, max_block_size):
+    """ Returns the (left, right) positions of the distinct pairs sharing a block """
+    lefts, rights = [], []
+    skipped = 0
+    for members in blocks.values():
+        if len(members) < 2:
+            continue
+        if len(members) > max_block_size:
+            skipped += 1
+            continue
+        members = np.array(sorted(members), dtype=np.int64)
+        left, right = np.triu_indices(len(members), 1)
+        lefts.append(members[left])
+        rights.append(members[right])
+    if skipped:
+        logger.warning("Skipped %d blocks of more than %d patients", skipped, max_block_size)
+    if not lefts:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    # a pair sharing several blocks is scored once
+    keys = np.unique(np.concatenate(lefts) * count + np.concatenate(rights))
+    return keys // count, keys % count
+
+
+######################################################################
+#  S C O R I N G
+######################################################################
+
+def jaccard(signatures, left, right):
+    """ Returns the Jaccard similarities of the bigram sets of the pairs """
+    first, second = signatures[left], signatures[right]
+    common = POPCOUNT[first & second].sum(axis=1)
+    total = POPCOUNT[first | second].sum(axis=1)
+    return np.where(total > 0, common / np.maximum(total, 1), 0.0)
+
+
+def birthdate_similarity(features, left, right):
+    """ Returns 1 for equal birth dates, 0.8 for a transposed month and day, less when apart """
+    distance = np.abs(features["days"][left] - features["days"][right])
+    transposed = (features["year"][left] == features["year"][right]) \
+        & (features["month"][left] == features["day"][right]) \
+        & (features["day"][left] == features["month"][right])
+    return np.where(distance == 0, 1.0, np.where(transposed, 0.8, np.clip(0.6 - distance / 365.0, 0.0, 0.6)))
+
+
+def postal_similarity(features, left, right):
+    """ Returns 1 for equal postal codes, 0.5 when only the first 3 digits match """
+    first, second = features["postal"][left], features["postal"][right]
+    known = (first > 0) & (second > 0)
+    return np.where(known & (first == second), 1.0, np.where(known & (first // 100 == second // 100), 0.5, 0.0))
+
+
+def load_features(features):
+    """ Sets the features of the patients scored by this process """
+    _features.clear()
+    _features.update(features)
+
+
+def score_pairs(left, right, min_score):
+    """
+    Scores candidate pairs and returns those reaching min_score
+
+    Returns:
+        (left, right, score, name_score, birthdate_score, postal_score) arrays
+    """
+    features = _features
+    family = jaccard(features["family"], left, right)
+    given = jaccard(features["given"], left, right)
+    birthdate = birthdate_similarity(features, left, right)
+    postal = postal_similarity(features, left, right)
+    gender = (features["gender"][left] == features["gender"][right]).astype(np.float64)
+    score = WEIGHTS["family"] * family + WEIGHTS["given"] * given + WEIGHTS["birthdate"] * birthdate \
+        + WEIGHTS["postal"] * postal + WEIGHTS["gender"] * gender
+    kept = score >= min_score
+    return (left[kept], right[kept], score[kept], ((family + given) / 2)[kept], birthdate[kept], postal[kept])
+
+
+######################################################################
+#  J O B S
+######################################################################
+
+def run_job(job_id):
+    """ Runs a duplicate detection job, in an app context """
+    config = current_app.config
+    job = DedupJob.query.get(job_id)
+    job.status = "running"
+    job.started = datetime.utcnow()
+    db.session.commit()
+    logger.info("Starting duplicate detection job %s", job_id)
+    try:
+        if sharding.needs_scatter():
+            parts = sharding.scatter(load_records)
+        else:
+            parts = [load_records()]
+        features, blocks = build_features(parts)
+        count = len(features["ids"])
+        left, right = candidate_pairs(blocks, max(count, 1), config.get("DEDUP_MAX_BLOCK_SIZE", 1000))
+        chunk_size = config.get("DEDUP_CHUNK_PAIRS", 100000)
+        chunks = [(left[start:start + chunk_size], right[start:start + chunk_size])
+                  for start in range(0, len(left), chunk_size)]
+        job.patients, job.pairs, job.chunks_total = count, len(left), len(chunks)
+        db.session.commit()
+
+        min_score = config.get("DEDUP_MIN_SCORE", 0.75)
+        workers = config.get("DEDUP_WORKERS") or os.cpu_count() or 1
+        if workers > 1 and len(chunks) > 1:
+            context = multiprocessing.get_context(config.get("DEDUP_START_METHOD") or "spawn")
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context,
+                                     initializer=load_features, initargs=(features,)) as pool:
+                results = pool.map(score_pairs, [chunk[0] for chunk in chunks], [chunk[1] for chunk in chunks],
+                                   [min_score] * len(chunks))
+                for result in results:
+                    save_candidates(job, features["ids"], result)
+        else:
+            load_features(features)
+            for chunk_left, chunk_right in chunks:
+                save_candidates(job, features["ids"], score_pairs(chunk_left, chunk_right, min_score))
+
+        job.status = "done"
+        logger.info("Duplicate detection job %s found %d candidates", job_id, job.candidate_count)
+    except Exception as error:  # the job must end up failed rather than running forever
+        logger.exception("Duplicate detection job %s failed", job_id)
+        db.session.rollback()
+        job = DedupJob.query.get(job_id)
+        job.status = "failed"
+        job.error = str(error)
+    finally:
+        _features.clear()
+    job.finished = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def save_candidates(job, ids, result):
+    """ Writes the match candidates of one scored chunk and counts it as done """
+    left, right, score, name_score, birthdate_score, postal_score = result
+    db.session.bulk_insert_mappings(MatchCandidate, [
+        {"job_id": job.id, "pat_id_1": int(ids[left[row]]), "pat_id_2": int(ids[right[row]]),
+         "score": float(score[row]), "name_score": float(name_score[row]),
+         "birthdate_score": float(birthdate_score[row]), "postal_score": float(postal_score[row])}
+        for row in range(len(left))])
+    job.chunks_done += 1
+    job.candidate_count += len(left)
+    db.session.commit()
+
+
+def start_job(app, background=True):
+    """ Queues a duplicate detection job, runs it in a background thread and returns it
+
+    Raises DataConflictError while another job is running.
+
+    Args:
+        app (Flask): the app whose database is searched
+        background (boolean): run the job in this thread instead and return when done
+    """
+    connection = db.session.connection(mapper=DedupJob.__mapper__)
+    if connection.dialect.name == "postgresql":
+        #the processes starting a job take turns until the new job is stored
+        connection.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), lock_id=lock_id("dedup"))
+    abandoned = datetime.utcnow() - timedelta(seconds=app.config.get("DEDUP_JOB_TIMEOUT", 3600))
+    for running in DedupJob.query.filter(DedupJob.status.in_(["queued", "running"])).all():
+        if running.created > abandoned:
+            db.session.rollback()
+            raise DataConflictError("Duplicate search {} is still running".format(running.id))
+        logger.warning("Duplicate detection job %s was abandoned", running.id)
+        running.status = "failed"
+        running.error = "abandoned"
+        running.finished = datetime.utcnow()
+    job = DedupJob()
+    db.session.add(job)
+    db.session.commit()
+    if not background:
+        return run_job(job.id)
+
+    def run(job_id):
+        with app.app_context():
+            try:
+                run_job(job_id)
+            finally:
+                db.session.remove()
+
+    threading.Thread(target=run, args=(job.id,), name="dedup-{}".format(job.id), daemon=True).start()
+    return job
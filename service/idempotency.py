@@ -0,0 +1,89 @@
+# Idempotency Keys
+
+"""
+Idempotency-Key support for the POST routes
+
+A client that may retry a POST sends the same Idempotency-Key header with
+every attempt. The first attempt runs and its response is kept; the later
+ones get the kept response back, marked with an Idempotent-Replayed header,
+without running again. A key reused for a different request, or a retry
+arriving while the first attempt still runs, is rejected with 409.
+
+The response is kept in the same transaction as the changes of the route,
+so a worker dying in between cannot leave changes without their response.
+A worker dying while the route runs leaves a claim without a response,
+which a retry takes over once it is IDEMPOTENCY_CLAIM_SECONDS old.
+
+Configuration
+-------------
+IDEMPOTENCY_KEY_TTL       - seconds a key and its response are kept
+IDEMPOTENCY_CLAIM_SECONDS - seconds after which a claim without a response
+                            is given to a retry, longer than the routes run
+"""
+import json
+import logging
+from functools import wraps
+from flask import Response, request, current_app, make_response, abort
+from flask_api import status  # HTTP Status Codes
+from service.models import IdempotencyKey, DataValidationError, db
+
+logger = logging.getLogger("gunicorn.error")
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# Response headers kept along with the body
+KEPT_HEADERS = ("Content-Type", "Location", "ETag", "Vary")
+
+
+def idempotent(view):
+    """ Makes a route run once per Idempotency-Key """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return view(*args, **kwargs)
+        key = key.strip()
+        if not key or len(key) > 255:
+            raise DataValidationError("Invalid Idempotency-Key: must have 1 to 255 characters")
+        fingerprint = IdempotencyKey.fingerprint_of(
+            request.method, request.full_path, request.mimetype, request.get_data())
+        config = current_app.config
+        claimed = IdempotencyKey.claim(key, fingerprint, config.get("IDEMPOTENCY_KEY_TTL", 86400),
+                                       config.get("IDEMPOTENCY_CLAIM_SECONDS", 60))
+        if claimed is not None:
+            return replay(claimed, fingerprint)
+
+        #the commit of the route only ends a subtransaction, the response is
+        #kept before the whole of it commits
+        transaction = db.session.begin(subtransactions=True)
+        try:
+            response = make_response(view(*args, **kwargs))
+            if transaction.is_active:
+                #the route left the subtransaction open
+                transaction.commit()
+            if db.session().transaction is not transaction.parent:
+                logger.warning("A route committed more than once, Idempotency-Key %s is kept apart", key)
+            IdempotencyKey.query.get(key).record(
+                response.status_code,
+                [(name, value) for name, value in response.headers if name in KEPT_HEADERS],
+                response.get_data())
+        except Exception:
+            IdempotencyKey.release(key)
+            raise
+        return response
+    return wrapper
+
+
+def replay(claimed, fingerprint):
+    """ Returns the kept response of an earlier request with the same key """
+    if claimed.fingerprint != fingerprint:
+        abort(status.HTTP_409_CONFLICT,
+              "Idempotency-Key {} was used for a different request".format(claimed.key))
+    if claimed.status_code is None:
+        abort(status.HTTP_409_CONFLICT,
+              "A request with Idempotency-Key {} is still running".format(claimed.key))
+    logger.info("Replaying the response of Idempotency-Key %s", claimed.key)
+    response = Response(claimed.body, claimed.status_code, json.loads(claimed.headers))
+    response.headers[REPLAYED_HEADER] = "true"
+    return response
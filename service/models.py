@@ -45,35 +45,98 @@ Profile = a top-level model injerated from base model
         country - country
 
 """
+import os
 import logging
+import sqlite3
 from enum import Enum
 import re
-from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
+import json
+import copy
+import heapq
+import hashlib
+import itertools
+from datetime import datetime, timedelta
+from flask import g, current_app
+from service import sharding
+from service.routing import RoutingSQLAlchemy
+from service.tracing import span, traced
+from sqlalchemy import and_, or_, event, inspect, exc, literal, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import selectinload
 #pip install email_validator
 from email_validator import validate_email, EmailNotValidError
 
 
 logger = logging.getLogger("gunicorn.error")
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_db(), its
+# sessions send the reads of GET requests to the read replicas if any
+db = RoutingSQLAlchemy()
 
 # Zip code mapping with regular expression
 zipCode = re.compile(r"^[0-9]{5}(?:-[0-9]{4})?$")
 phoneNumb = re.compile(r"^[0-9]{10}$")
 
+# FHIR date search value: optional prefix + year, year-month or full date
+dateParam = re.compile(r"^(eq|ne|lt|le|gt|ge|sa|eb)?([0-9]{4})(?:-([0-9]{2})(?:-([0-9]{2}))?)?$")
+
+# Most ids in one IN list of the statements of a delete of matching patients
+RECORD_BATCH_SIZE = 500
+
+# Patient ids are 64 bit so that sharded ids fit; SQLite only numbers rows
+# itself for a column declared exactly INTEGER PRIMARY KEY
+PatientId = db.BigInteger().with_variant(db.Integer(), "sqlite")
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """ SQLite only enforces foreign keys, and so ON DELETE CASCADE, when asked to """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+@event.listens_for(Pool, "connect")
+def remember_connection_pid(dbapi_connection, connection_record):
+    """ Records the process that opened a pooled connection """
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(Pool, "checkout")
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    """ Never hands a connection opened before a fork to a forked worker """
+    pid = os.getpid()
+    if connection_record.info.get("pid", pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid %s, attempting to check out in pid %s"
+            % (connection_record.info["pid"], pid))
+
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
+class DataConflictError(Exception):
+    """ Used when a change does not apply to the current state of the data """
+    pass
+
 class Gender(Enum):
     """ Enumeration of valid Genders """
     male = 1
     female = 2
     unknown = 3
 
+
+def normalize_email(value):
+    """ Returns the normalized form of an email address, raises EmailNotValidError when invalid """
+    with span("email.validate"):
+        return validate_email(value).email
+
 ######################################################################
 # BASE MODEL
 ######################################################################
@@ -90,7 +153,9 @@ class PatBase():
         Creates a new Pat to the database
         """
         logger.info("Creating %s %s %s", self.name[0].given_1, self.name[0].family, self.name[0].pprofile_id)
-        self.id = None  # id must be none to generate next primary key
+        # id must be none to generate next primary key, unless the patients are
+        # sharded: then it is globally unique and also picks the shard
+        self.id = sharding.assign_patient_id() if isinstance(self, Pprofile) else None
         db.session.add(self)
         db.session.commit()
 
@@ -103,19 +168,51 @@ class PatBase():
 
     def delete(self):
         """ Removes a Pat from the data store """
-        logger.info("Deleting %s %s with pid=%s and pprofile_id=%s", self.name[0].given_1, self.name[0].family, self.id, self.name[0].pprofile_id)
+        logger.info("Deleting %s with id=%s", self.__class__.__name__, self.id)
         db.session.delete(self)
         db.session.commit()
 
+    def content(self):
+        """ Returns the values of the data columns listed in fields """
+        return tuple(getattr(self, field) for field in self.fields)
+
+    def patch(self, operations):
+        """
+        Applies a JSON Patch (RFC 6902) to a name or an address
+
+        The patch is applied to the serialized form, which is then
+        deserialized back so that the usual validation applies
+
+        Args:
+            operations (list): the JSON Patch operations
+        """
+        patched = apply_json_patch(self.serialize(), operations)
+        if patched.get("id") != self.id:
+            raise DataValidationError("The id cannot be changed")
+        return self.deserialize(patched)
+
     @classmethod
     def init_db(cls, app):
-        """ Initializes the database session """
+        """ Initializes the database session
+
+        Nothing connects to the database here: the engines are created on
+        first use, i.e. in the worker processes, and the tables are created
+        by bootstrap_db() instead of at startup
+        """
         logger.info("Initializing database")
         cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
-        app.app_context().push() #push application context to enable dbase creation
-        db.create_all()  # make our sqlalchemy tables
+        app.app_context().push() #push application context to use the models outside of requests
+
+    @classmethod
+    def bootstrap_db(cls, app):
+        """ Creates or migrates the schema of the database and of every shard """
+        engines = [db.get_engine(app)]
+        engines.extend(db.get_engine(app, bind=bind_key) for bind_key in sharding.shard_binds(app))
+        for engine in engines:
+            logger.info("Bootstrapping schema on %s", engine.url.__repr__())
+            migrate_schema(engine)
 
     @classmethod
     def all(cls):
@@ -158,28 +255,40 @@ class Pprofile(db.Model, PatBase):
     app = None
 
     # Table Schema
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(PatientId, primary_key=True)
     resourceType = db.Column(db.String(20), nullable=True)
     active = db.Column(db.Boolean(), nullable=False, default=False)
 
-    name = db.relationship('Pname', backref='pprofile', cascade="all, delete-orphan", lazy=True)
+    # the rows of removed names and addresses are deleted by the database
+    # (ON DELETE CASCADE), so deleting a profile does not load them first
+    name = db.relationship('Pname', backref='pprofile', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
     
     # based on telecom contents
-    phone_home = db.Column(db.String(10), nullable=True)
+    phone_home = db.Column(db.String(10), nullable=True, index=True)
     phone_office = db.Column(db.String(10), nullable=True)
     phone_cell = db.Column(db.String(10), nullable=True)
-    email = db.Column(db.String(60), nullable=True)
+    email = db.Column(db.String(60), nullable=True, index=True)
     
-    address = db.relationship('Paddress', backref='pprofile', cascade="all, delete-orphan", lazy=True)
+    address = db.relationship('Paddress', backref='pprofile', cascade="all, delete-orphan", passive_deletes=True, lazy=True)
 
-    DOB = db.Column(db.DateTime, nullable=False)
+    DOB = db.Column(db.DateTime, nullable=False, index=True)
     #DOB = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     gender = db.Column(db.Enum(Gender), nullable=False, server_default=(Gender.unknown.name))
 
+    # pre-rendered serialize() output, kept in sync on every commit (see
+    # sync_resource_json below); NULL until rendered or when disabled
+    resource_json = db.deferred(db.Column(db.Text, nullable=True))
+
+    # optimistic concurrency: every UPDATE checks and raises the version, which
+    # track_changed_profiles also raises when a name or address changes
+    version_id = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    __mapper_args__ = {"version_id_col": version_id, "version_id_generator": False}
+
     def __repr__(self):
         return "<Pat fname=%r lname=%r id=[%s] pprofile_id=[%s]>" % (self.name[0].given_1, self.name[0].family, self.id, self.name[0].pprofile_id)
 
 
+    @traced("Pprofile.serialize")
     def serialize(self):
         """ Serializes a profile into a dictionary """
         pprofile = {
@@ -206,6 +315,7 @@ class Pprofile(db.Model, PatBase):
 
         return pprofile
 
+    @traced("Pprofile.deserialize")
     def deserialize(self, data):
         """
         Deserializes a Pat from a dictionary
@@ -222,14 +332,13 @@ class Pprofile(db.Model, PatBase):
 
             self.gender = getattr(Gender, data["gender"])   # create enum from
 
-            #parse name
+            #parse name, the stored names are replaced by the posted ones
             name_list = data["name"]
-            for json_name in name_list:
-                _name = Pname()
-                _name.deserialize(json_name)
-                self.name.append(_name)
+            names = [Pname().deserialize(json_name) for json_name in name_list]
 
-            #assign phone number and email address by parsing telecom jason
+            #assign phone number and email address by parsing telecom jason,
+            #a contact missing from the telecom list is cleared
+            self.phone_home = self.phone_office = self.phone_cell = self.email = None
             telecom_list = data["telecom"]
             for json_telecom in telecom_list:
                 ptcom = PTelecom()
@@ -252,14 +361,15 @@ class Pprofile(db.Model, PatBase):
                     #validate the email address
                     self.email = None
                     if _telecom.value:
-                        self.email = validate_email(_telecom.value).email
+                        self.email = normalize_email(_telecom.value)
 
-            #parse address
+            #parse address, the stored addresses are replaced by the posted ones
             addr_list = data["address"]
-            for json_addr in addr_list:
-                _addr = Paddress()
-                _addr.deserialize(json_addr)
-                self.address.append(_addr)
+            addresses = [Paddress().deserialize(json_addr) for json_addr in addr_list]
+
+            #only apply the differences so that unchanged rows are left alone
+            merge_children(self.name, names, name_list)
+            merge_children(self.address, addresses, addr_list)
 
         except KeyError as error:
             raise DataValidationError("Invalid patient: missing " + error.args[0])
@@ -271,6 +381,80 @@ class Pprofile(db.Model, PatBase):
             raise DataValidationError("Invalid date value or format")
         return self
 
+    def patch(self, operations):
+        """
+        Applies a JSON Patch (RFC 6902) to a Pat
+
+        Paths follow the serialized form, i.e. "/phone_cell" or
+        "/address/0/line/1". Only the fields the patch changes are validated
+        and written, and the names and addresses are only loaded when a path
+        refers to them; changed ones are merged like in deserialize().
+
+        Args:
+            operations (list): the JSON Patch operations
+        """
+        document = {
+            "id": self.id,
+            "resourceType": self.resourceType,
+            "active": self.active,
+            "birthDate": self.DOB.strftime("%Y-%m-%d"),
+            "gender": self.gender.name,
+            "phone_home": self.phone_home,
+            "phone_office": self.phone_office,
+            "phone_cell": self.phone_cell,
+            "email": self.email,
+        }
+        paths = [op.get("path", "") + " " + op.get("from", "") for op in operations if isinstance(op, dict)] \
+            if isinstance(operations, list) else []
+        children = [key for key in ("name", "address")
+                    if any(re.search(r"(^|\s)/" + key + r"(/|\s|$)", path) for path in paths)]
+        for key in children:
+            document[key] = [child.serialize() for child in getattr(self, key)]
+
+        patched = apply_json_patch(document, operations)
+        unknown = set(patched) - set(document)
+        if unknown:
+            raise DataValidationError("Invalid patient: unknown field " + sorted(unknown)[0])
+        if patched.get("id") != self.id:
+            raise DataValidationError("The id cannot be changed")
+
+        try:
+            for key in document:
+                value = patched.get(key)
+                if key in children or value == document[key]:
+                    continue
+                if key == "active":
+                    if not isinstance(value, bool):
+                        raise DataValidationError("Invalid active value")
+                    self.active = value
+                elif key == "birthDate":
+                    self.DOB = datetime.strptime(value, "%Y-%m-%d")
+                elif key == "gender":
+                    self.gender = Gender[value]
+                elif key == "email":
+                    self.email = normalize_email(value) if value else None
+                elif key.startswith("phone_"):
+                    if value is not None and not phoneNumb.match(value):
+                        raise DataValidationError("Invalid phone number")
+                    setattr(self, key, value)
+                else:
+                    self.resourceType = value
+
+            for key, child_class in (("name", Pname), ("address", Paddress)):
+                if key in children:
+                    child_list = patched[key]
+                    merge_children(getattr(self, key), [child_class().deserialize(data) for data in child_list],
+                                   child_list)
+
+        except KeyError as error:
+            raise DataValidationError("Invalid patient: missing or bad " + str(error.args[0]))
+        except TypeError as error:
+            raise DataValidationError("Invalid patient: patch contained bad or no data")
+        except EmailNotValidError as error:
+            raise DataValidationError("Invalid email address")
+        except ValueError as error:
+            raise DataValidationError("Invalid date value or format")
+        return self
 
 
     @classmethod
@@ -324,7 +508,7 @@ class Pprofile(db.Model, PatBase):
         """
         logger.info("Processing family name query for %s ...", family)
         #return cls.query.filter(cls.family == family)
-        return cls.query.join(Pname).filter(Pname.family == family).all()
+        return cls.find_by_ids(PatientSearch.find_ids(PatientSearch.family == family))
 
 
     @classmethod
@@ -336,7 +520,7 @@ class Pprofile(db.Model, PatBase):
         """
         logger.info("Processing first name query for %s ...", given_1)
         #return cls.query.filter(cls.given_1 == given_1)
-        return cls.query.join(Pname).filter(Pname.given_1 == given_1).all()
+        return cls.find_by_ids(PatientSearch.find_ids(PatientSearch.given == given_1))
 
     @classmethod
     def find_by_name(cls, given_1, family):
@@ -347,7 +531,7 @@ class Pprofile(db.Model, PatBase):
             family (string): the last name of Pats you want to match
         """
         logger.info("Processing first name query for %s ...", given_1)
-        return cls.query.join(Pname).filter(Pname.given_1 == given_1, Pname.family==family).all()
+        return cls.find_by_ids(PatientSearch.find_ids(PatientSearch.given == given_1, PatientSearch.family == family))
 
 
     @classmethod
@@ -360,9 +544,680 @@ class Pprofile(db.Model, PatBase):
         logger.info("Processing zip code query for %s ...", postalCode)
         #return cls.query.filter(cls.postalCode == postalCode)
         #return Paddress.query.filter( Paddress.postalCode == postalCode, Paddress.pat_id == cls.id ).all()
-        return cls.query.join(Paddress).filter(Paddress.postalCode == postalCode).all()
+        return cls.find_by_ids(PatientSearch.find_ids(PatientSearch.postalCode == postalCode))
+
+    @classmethod
+    def find_by_birthdate(cls, *birthdates):
+        """ Returns all Pats whose birth date matches every FHIR date criterion
+
+        Args:
+            birthdates (string): FHIR date search values, i.e. "ge1980", "lt1990-06"
+        """
+        logger.info("Processing birth date query for %s ...", birthdates)
+        return cls.query.filter(*[birthdate_clause(cls.DOB, value) for value in birthdates])
 
+    @classmethod
+    def find_by_ids(cls, pat_ids):
+        """ Returns all of the Pats having one of the ids
 
+        The profiles are fetched with a single IN query and their names and
+        addresses with one select-in query each, instead of one lookup per id.
+
+        Args:
+            pat_ids (list): the ids of the Pats you want to fetch
+        """
+        logger.info("Processing lookup for ids %s ...", pat_ids)
+        return cls.query.options(selectinload(cls.name), selectinload(cls.address)) \
+            .filter(cls.id.in_(pat_ids)).order_by(cls.id).all()
+
+    @classmethod
+    def search_clauses(cls, args, pat_ids=None):
+        """ Returns the filter clauses for the Pats matching all of the search parameters
+
+        Args:
+            args (dict): search parameters as sent on the query string. Supported
+                keys are _id (a comma separated id list), phone_home, email, active,
+                gender, given, family, postalCode and birthdate (which may repeat).
+                Unknown keys are ignored.
+            pat_ids (list): the ids of _id when already parsed by parse_id_list()
+        """
+        clauses = []
+
+        if pat_ids is None:
+            pat_ids = parse_id_list(args)
+        if pat_ids is not None:
+            clauses.append(cls.id.in_(pat_ids))
+
+        #a search on names or addresses runs entirely on the search projection,
+        #with a sub-select so that a patient with several matching rows is
+        #still returned once; the other searches only need pprofile
+        projected = any(args.get(name) for name in ("family", "given", "postalCode"))
+        table = PatientSearch if projected else cls
+        row_clauses = []
+
+        if args.get("phone_home"):
+            row_clauses.append(table.phone_home == args.get("phone_home"))
+        if args.get("email"):
+            row_clauses.append(table.email == args.get("email"))
+        if args.get("active"):
+            active_str = args.get("active").lower()
+            if active_str not in ("true", "false"):
+                raise DataValidationError("Invalid active value: " + active_str)
+            row_clauses.append(table.active == (active_str == "true"))
+        if args.get("gender"):
+            if args.get("gender") not in Gender.__members__:
+                raise DataValidationError("Invalid gender: " + args.get("gender"))
+            row_clauses.append(table.gender == Gender[args.get("gender")])
+
+        if args.get("family"):
+            row_clauses.append(PatientSearch.family == args.get("family"))
+        if args.get("given"):
+            row_clauses.append(PatientSearch.given == args.get("given"))
+        if args.get("postalCode"):
+            row_clauses.append(PatientSearch.postalCode == args.get("postalCode"))
+
+        birthdates = args.getlist("birthdate") if hasattr(args, "getlist") else args.get("birthdate")
+        if isinstance(birthdates, str):
+            birthdates = [birthdates]
+        for value in birthdates or []:
+            row_clauses.append(birthdate_clause(table.DOB, value))
+
+        if projected:
+            clauses.append(cls.id.in_(db.session.query(PatientSearch.pprofile_id).filter(*row_clauses)))
+        else:
+            clauses.extend(row_clauses)
+        return clauses
+
+    @classmethod
+    def search(cls, args):
+        """ Returns a query of the Pats matching all of the search parameters
+
+        Args:
+            args (dict): search parameters, see search_clauses()
+        """
+        logger.info("Processing search for %s ...", dict(args))
+        offset, count = page_params(args)
+        return cls.query.options(selectinload(cls.name), selectinload(cls.address)) \
+            .filter(*cls.search_clauses(args)).order_by(cls.id).offset(offset).limit(count)
+
+    @classmethod
+    def search_json(cls, args, pat_ids=None):
+        """ Returns (id, JSON text) of the Pats matching all of the search parameters
+
+        The stored resource_json is read straight from pprofile, so the names
+        and addresses are only loaded for rows that have not been rendered yet.
+        When the patients are sharded, every shard is searched in parallel and
+        the results are merged in id order.
+
+        Args:
+            args (dict): search parameters, see search_clauses(), and the page
+                parameters _offset and _count
+            pat_ids (list): the ids of _id when already parsed by parse_id_list()
+        """
+        logger.info("Processing JSON search for %s ...", dict(args))
+        if pat_ids is None:
+            pat_ids = parse_id_list(args)
+        #the clauses are built here so that bad parameters fail before streaming
+        clauses = cls.search_clauses(args, pat_ids)
+        offset, count = page_params(args)
+        if sharding.needs_scatter():
+            return cls.scatter_search_json(args, offset, count, pat_ids)
+        if not resource_json_enabled():
+            pats = cls.query.options(selectinload(cls.name), selectinload(cls.address)) \
+                .filter(*clauses).order_by(cls.id).offset(offset).limit(count)
+            return ((pat.id, dump_resource(pat.serialize())) for pat in pats)
+        rows = db.session.query(cls.id, cls.resource_json).filter(*clauses) \
+            .order_by(cls.id).offset(offset).limit(count) \
+            .execution_options(stream_results=True).yield_per(500)
+        return ((pat_id, resource if resource is not None else dump_resource(cls.find(pat_id).serialize()))
+                for pat_id, resource in rows)
+
+    @classmethod
+    def scatter_search_json(cls, args, offset, count, pat_ids):
+        """ Searches every shard in parallel and merges the (id, JSON text) results
+
+        Each shard returns its first offset + count matches in id order, which
+        is enough to cut the requested page out of the merged results. An _id
+        search only goes to the shards holding those ids.
+        """
+        shard_args = args.copy()
+        shard_args.pop("_offset", None)
+        if count is not None:
+            shard_args["_count"] = str(offset + count)
+        binds = None if pat_ids is None else sorted(set(sharding.shard_for(pat_id) for pat_id in pat_ids))
+        results = sharding.scatter(lambda: list(cls.search_json(shard_args, pat_ids)), binds)
+        merged = heapq.merge(*results, key=lambda row: row[0])
+        return itertools.islice(merged, offset, None if count is None else offset + count)
+
+    @classmethod
+    def find_json(cls, pat_id, with_version=False):
+        """ Returns the JSON text of a Pat by the ID, or None if not found
+
+        Args:
+            pat_id (int): the id of the Pat
+            with_version (boolean): return a (JSON text, version_id) tuple instead
+        """
+        logger.info("Processing JSON lookup for id %s ...", pat_id)
+        routed = sharding.is_sharded() and g.get("shard_bind") is None
+        if routed:
+            sharding.use_shard(pat_id)
+        try:
+            if not resource_json_enabled():
+                pat = cls.find(pat_id)
+                if not pat:
+                    return None
+                resource, version_id = dump_resource(pat.serialize()), pat.version_id
+            else:
+                row = db.session.query(cls.resource_json, cls.version_id).filter(cls.id == pat_id).first()
+                if row is None:
+                    return None
+                resource, version_id = row
+                if resource is None:
+                    resource = dump_resource(cls.find(pat_id).serialize())
+        finally:
+            if routed:
+                g.pop("shard_bind", None)
+        return (resource, version_id) if with_version else resource
+
+    @classmethod
+    def find_existing(cls, args):
+        """ Returns (id, JSON text) of at most two Pats matching a conditional create
+
+        The search values are locked until the end of the transaction, so
+        that concurrent conditional creates cannot both insert, then one
+        indexed query looks for matches.
+
+        Args:
+            args (dict): the search parameters of the If-None-Exist header
+        """
+        if not cls.search_clauses(args):
+            raise DataValidationError("If-None-Exist needs at least one search parameter")
+        lock_search_values(args)
+        args = args.copy()
+        args.pop("_offset", None)
+        args["_count"] = "2"
+        return list(cls.search_json(args))
+
+    @classmethod
+    def delete_matching(cls, clauses):
+        """ Deletes every Pat matching the clauses, RECORD_BATCH_SIZE per statement, and returns the count
+
+        Names and addresses go with their profile through ON DELETE CASCADE.
+        A version_id clause makes the delete conditional on the version. The
+        deletes are first recorded in the change history by the database
+        itself, and only the recorded rows are then deleted.
+
+        Args:
+            clauses (list): filter clauses, i.e. from search_clauses()
+        """
+        logger.info("Processing delete of matching patients ...")
+        if sharding.needs_scatter():
+            #each shard commits its own delete
+            return sum(sharding.scatter(lambda: cls.delete_matching(clauses)))
+        recorded = PatientHistory.record_deletes(clauses)
+        count = 0
+        for start in range(0, len(recorded), RECORD_BATCH_SIZE):
+            count += cls.query.filter(cls.id.in_(recorded[start:start + RECORD_BATCH_SIZE]), *clauses) \
+                .delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def rebuild_resources(cls, batch_size=500):
+        """ Re-renders the stored JSON and search projection of every Pat and returns the number of rows
+
+        Args:
+            batch_size (int): the number of Pats loaded and committed at a time
+        """
+        logger.info("Rebuilding stored patient JSON ...")
+        if sharding.needs_scatter():
+            return sum(sharding.scatter(lambda: cls.rebuild_resources(batch_size)))
+        count = 0
+        last_id = 0
+        while True:
+            pat_ids = [row.id for row in db.session.query(cls.id).filter(cls.id > last_id)
+                       .order_by(cls.id).limit(batch_size)]
+            if not pat_ids:
+                break
+            pats = cls.find_by_ids(pat_ids)
+            for pat in pats:
+                pat.resource_json = dump_resource(pat.serialize()) if resource_json_enabled() else None
+            PatientSearch.refresh(pats)
+            db.session.commit()
+            count += len(pat_ids)
+            last_id = pat_ids[-1]
+        return count
+
+
+
+
+
+def apply_json_patch(document, operations):
+    """
+    Applies JSON Patch (RFC 6902) operations to a copy of a document
+
+    Args:
+        document (dict): the serialized resource
+        operations (list): the add, remove, replace, move, copy and test operations
+    """
+    if not isinstance(operations, list):
+        raise DataValidationError("Invalid patch: body must be a list of operations")
+    document = copy.deepcopy(document)
+    for operation in operations:
+        try:
+            op = operation["op"]
+            path = operation["path"]
+            if op == "test":
+                if json_pointer(document, path, "get") != operation["value"]:
+                    raise DataConflictError("Patch test failed at " + path)
+            elif op == "remove":
+                json_pointer(document, path, "remove")
+            elif op == "add":
+                json_pointer(document, path, "add", copy.deepcopy(operation["value"]))
+            elif op == "replace":
+                json_pointer(document, path, "get")
+                json_pointer(document, path, "replace", copy.deepcopy(operation["value"]))
+            elif op == "move":
+                value = json_pointer(document, operation["from"], "remove")
+                json_pointer(document, path, "add", value)
+            elif op == "copy":
+                value = json_pointer(document, operation["from"], "get")
+                json_pointer(document, path, "add", copy.deepcopy(value))
+            else:
+                raise DataValidationError("Invalid patch: unknown op " + str(op))
+        except KeyError as error:
+            raise DataValidationError("Invalid patch: operation missing " + str(error.args[0]))
+        except TypeError as error:
+            raise DataValidationError("Invalid patch: operations must be objects")
+    return document
+
+
+def json_pointer(document, path, action, value=None):
+    """
+    Gets, adds, replaces or removes the value a JSON Pointer (RFC 6901) refers to
+
+    Args:
+        document (dict): the document, changed in place
+        path (string): the pointer, i.e. "/name/0/given/1"
+        action (string): one of "get", "add", "replace" or "remove"
+        value: the value to add or replace
+    """
+    if not isinstance(path, str) or not path.startswith("/"):
+        raise DataValidationError("Invalid patch path: " + str(path))
+    tokens = [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+    parent = document
+    try:
+        for token in tokens[:-1]:
+            parent = parent[int(token) if isinstance(parent, list) else token]
+        key = tokens[-1]
+        if isinstance(parent, list):
+            if key == "-" and action == "add":
+                parent.append(value)
+                return value
+            if not key.isdigit() or int(key) > len(parent) or (action != "add" and int(key) == len(parent)):
+                raise DataValidationError("Invalid patch path: " + path)
+            key = int(key)
+            if action == "add":
+                parent.insert(key, value)
+                return value
+        elif not isinstance(parent, dict) or (action != "add" and key not in parent):
+            raise DataValidationError("Invalid patch path: " + path)
+        if action == "get":
+            return parent[key]
+        if action == "remove":
+            return parent.pop(key)
+        parent[key] = value
+        return value
+    except (KeyError, IndexError, ValueError, TypeError):
+        raise DataValidationError("Invalid patch path: " + path)
+
+
+def merge_children(stored, posted, posted_json):
+    """
+    Replaces the names or addresses of a profile with the posted ones in place
+
+    Rows are paired by the "id" the client sent back, then by identical
+    contents and finally by position. Paired rows only get the columns that
+    differ, so an unchanged row issues no UPDATE; unpaired stored rows are
+    removed (and deleted as orphans) and unpaired posted rows are inserted.
+
+    Args:
+        stored (list): the relationship collection of the profile
+        posted (list): the deserialized Pname or Paddress objects
+        posted_json (list): the dictionaries they were deserialized from
+    """
+    pairs = []
+    unpaired = list(posted)
+    remaining = list(stored)
+
+    by_id = dict((child.id, child) for child in remaining if child.id is not None)
+    for child, data in zip(posted, posted_json):
+        match = by_id.pop(data.get("id"), None) if isinstance(data, dict) else None
+        if match is not None:
+            pairs.append((match, child))
+            unpaired.remove(child)
+            remaining.remove(match)
+
+    for child in list(unpaired):
+        match = next((row for row in remaining if row.content() == child.content()), None)
+        if match is not None:
+            pairs.append((match, child))
+            unpaired.remove(child)
+            remaining.remove(match)
+
+    pairs.extend(zip(remaining, unpaired))
+    for match, child in pairs:
+        for field in child.fields:
+            if getattr(match, field) != getattr(child, field):
+                setattr(match, field, getattr(child, field))
+
+    for row in remaining[len(unpaired):]:
+        stored.remove(row)
+    for child in unpaired[len(remaining):]:
+        stored.append(child)
+
+
+def migrate_schema(engine):
+    """
+    Brings the schema of a database up to date with the models
+
+    Missing tables are created, then missing columns are added to existing
+    tables (they are all nullable or have a server default) along with their
+    missing indexes, and foreign keys missing their ON DELETE are recreated
+    (see cascade_foreign_keys()). Nothing else is ever dropped or altered.
+    """
+    db.Model.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    for table in db.Model.metadata.sorted_tables:
+        columns = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                logger.info("Adding column %s.%s", table.name, column.name)
+                engine.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                    table.name, CreateColumn(column).compile(dialect=engine.dialect)))
+        indexes = set(index["name"] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                logger.info("Adding index %s", index.name)
+                index.create(bind=engine)
+        cascade_foreign_keys(engine, inspector, table)
+
+
+def cascade_foreign_keys(engine, inspector, table):
+    """
+    Recreates the foreign keys of a table created without their ON DELETE
+
+    The names and addresses of a patient go with it through ON DELETE
+    CASCADE, which older schemas do not have, so deleting a patient fails
+    there. Each such foreign key is dropped and added again in one
+    transaction. Only PostgreSQL reflects ON DELETE and alters constraints,
+    a SQLite database from before has to be created again.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    reflected = inspector.get_foreign_keys(table.name)
+    for constraint in table.foreign_key_constraints:
+        if constraint.ondelete is None:
+            continue
+        columns = [column.name for column in constraint.columns]
+        for key in reflected:
+            if key["constrained_columns"] != columns or key["referred_table"] != constraint.referred_table.name:
+                continue
+            if (key["options"].get("ondelete") or "").upper() == constraint.ondelete.upper():
+                continue
+            logger.info("Recreating foreign key %s with ON DELETE %s", key["name"], constraint.ondelete)
+            #spelled out, as AddConstraint() would leave the constraint out of the
+            #CREATE TABLE of the next shards
+            quote = engine.dialect.identifier_preparer.quote
+            with engine.begin() as connection:
+                connection.execute("ALTER TABLE {} DROP CONSTRAINT {}".format(table.name, quote(key["name"])))
+                connection.execute("ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {} ({}) "
+                                   "ON DELETE {}".format(
+                                       table.name, quote(key["name"]), ", ".join(map(quote, columns)),
+                                       constraint.referred_table.name,
+                                       ", ".join(quote(element.column.name) for element in constraint.elements),
+                                       constraint.ondelete))
+
+
+def resource_json_enabled():
+    """ Returns True when the pre-rendered patient JSON is maintained """
+    return current_app.config.get("STORE_RESOURCE_JSON", True)
+
+
+def dump_resource(data):
+    """ Renders a serialized Pat the same way every time it is stored """
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+######################################################################
+# PRE-RENDERED JSON AND VERSION SYNCHRONIZATION
+######################################################################
+
+@event.listens_for(db.session, "before_flush")
+def track_changed_profiles(session, flush_context, instances):
+    """
+    Remembers every profile whose own row or names/addresses are changing
+
+    The version of such a profile goes up once per transaction, so a
+    change to one of its names or addresses is also a new patient version
+    """
+    touched = session.info.setdefault("touched_profiles", {})
+    changed = [obj for obj in session.dirty if session.is_modified(obj)]
+    for obj in list(session.new) + changed + list(session.deleted):
+        if isinstance(obj, Pprofile):
+            touched[obj] = touched.get(obj, False)
+        elif isinstance(obj, (Pname, Paddress)) and obj.pprofile is not None:
+            #a removed child may still sit in an already loaded collection
+            touched[obj.pprofile] = touched.get(obj.pprofile, False) or obj in session.deleted
+
+    versioned = session.info.setdefault("versioned_profiles", set())
+    created = session.info.setdefault("created_profiles", set())
+    for profile in touched:
+        if profile in versioned or profile in session.deleted:
+            continue
+        versioned.add(profile)
+        if inspect(profile).pending:
+            created.add(profile)
+        else:
+            profile.version_id = profile.version_id + 1
+
+
+@event.listens_for(db.session, "before_commit")
+def sync_resource_json(session):
+    """ Re-renders the stored JSON of the changed profiles in the same transaction """
+    session.flush()     # collect the changes and assign the ids that appear in the JSON
+    touched = session.info.get("touched_profiles")
+    if not touched:
+        return
+    profiles = [profile for profile in touched if inspect(profile).persistent]
+    if not resource_json_enabled():
+        #never leave a stale copy behind while the feature is switched off
+        if profiles:
+            session.query(Pprofile).filter(Pprofile.id.in_([profile.id for profile in profiles])) \
+                .update({Pprofile.resource_json: None}, synchronize_session=False)
+        return
+    for profile in profiles:
+        if touched[profile]:
+            session.expire(profile, ["name", "address"])
+        resource = dump_resource(profile.serialize())
+        if inspect(profile).dict.get("resource_json") != resource:
+            profile.resource_json = resource
+
+
+@event.listens_for(db.session, "before_commit")
+def sync_search_projection(session):
+    """ Brings the search projection rows of the changed profiles up to date """
+    touched = session.info.get("touched_profiles")
+    if not touched:
+        return
+    profiles = [profile for profile in touched if inspect(profile).persistent]
+    for profile in profiles:
+        if touched[profile] and not resource_json_enabled():
+            #sync_resource_json has not reloaded the names and addresses
+            session.expire(profile, ["name", "address"])
+    if profiles:
+        PatientSearch.refresh(profiles)
+
+
+@event.listens_for(db.session, "before_commit")
+def record_history(session):
+    """ Appends the new version of every changed profile to its change history """
+    touched = session.info.get("touched_profiles")
+    if not touched:
+        return
+    created = session.info.get("created_profiles", ())
+    now = datetime.utcnow()
+    for profile in touched:
+        state = inspect(profile)
+        if state.deleted:
+            session.add(PatientHistory(pprofile_id=state.identity[0], version_id=state.dict["version_id"] + 1,
+                                       method="delete", lastUpdated=now))
+        elif state.persistent:
+            session.add(PatientHistory(
+                pprofile_id=profile.id, version_id=profile.version_id,
+                method="create" if profile in created else "update", lastUpdated=now,
+                resource=state.dict.get("resource_json") or dump_resource(profile.serialize())))
+
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_rollback")
+def reset_changed_profiles(session):
+    """ Forgets the changed profiles once the transaction is over """
+    session.info.pop("touched_profiles", None)
+    session.info.pop("versioned_profiles", None)
+    session.info.pop("created_profiles", None)
+
+
+######################################################################
+# CONDITIONAL CREATE LOCKS
+######################################################################
+
+def lock_id(key):
+    """ Returns the signed 64 bit PostgreSQL advisory lock id of a string """
+    return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big", signed=True)
+
+
+def lock_search_values(args):
+    """
+    Makes the conditional creates sharing a search value run one after the other
+
+    Every parameter=value gets a PostgreSQL advisory lock held until the end
+    of the transaction, in each database a new patient may be stored in, so
+    that a create only looks for matches once the creates it competes with
+    have committed. SQLite has no such locks, its writers already take turns.
+    """
+    pairs = args.items(multi=True) if hasattr(args, "getlist") else args.items()
+    keys = sorted(set("{}={}".format(param, value) for param, value in pairs if param not in ("_offset", "_count")))
+    for bind_key in sharding.shard_binds() or [None]:
+        connection = db.session.connection(bind=db.get_engine(current_app, bind=bind_key))
+        if connection.dialect.name != "postgresql":
+            continue
+        for key in keys:
+            connection.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), lock_id=lock_id(key))
+
+
+def parse_id_list(args):
+    """
+    Returns the ids of the _id search parameter, or None when it is not given
+
+    The ids keep their first order. More than MAX_ID_LIST distinct ids are
+    refused rather than sent to the database as one huge IN list.
+
+    Args:
+        args (dict): search parameters, _id may repeat and hold comma separated ids
+    """
+    values = args.getlist("_id") if hasattr(args, "getlist") else args.get("_id")
+    if not values:
+        return None
+    if isinstance(values, str):
+        values = [values]
+    limit = current_app.config.get("MAX_ID_LIST", 1000)
+    pat_ids = []
+    seen = set()
+    for value in values:
+        for item in value.split(","):
+            item = item.strip()
+            if not item.isdigit():
+                raise DataValidationError("Invalid patient id: " + item)
+            pat_id = int(item)
+            if pat_id not in seen:
+                seen.add(pat_id)
+                pat_ids.append(pat_id)
+                if len(pat_ids) > limit:
+                    raise DataValidationError("More than {} patient ids in _id".format(limit))
+    return pat_ids
+
+
+def page_params(args):
+    """ Returns the (offset, count) of the _offset and _count search parameters
+
+    The count is None when there is no _count, i.e. no limit
+    """
+    page = []
+    for name in ("_offset", "_count"):
+        value = args.get(name)
+        if value is None or value == "":
+            page.append(None)
+        elif not str(value).isdigit():
+            raise DataValidationError("Invalid {}: {}".format(name, value))
+        else:
+            page.append(int(value))
+    return page[0] or 0, page[1]
+
+
+def birthdate_bounds(value):
+    """
+    Returns the (prefix, lower, upper) of a FHIR date search value
+
+    A partial date stands for the whole range it covers, so "1980" is
+    [1980-01-01, 1981-01-01) and "1980-06" is [1980-06-01, 1980-07-01).
+
+    Args:
+        value (string): the search value, i.e. "ge1980", "lt1990-06", "1975-02-14"
+    """
+    match = dateParam.match(value or "")
+    if not match:
+        raise DataValidationError("Invalid birthdate search value: " + str(value))
+    prefix, year, month, day = match.groups()
+    try:
+        if day:
+            lower = datetime(int(year), int(month), int(day))
+            upper = datetime.fromordinal(lower.toordinal() + 1)
+        elif month:
+            lower = datetime(int(year), int(month), 1)
+            upper = datetime(int(year) + int(month) // 12, int(month) % 12 + 1, 1)
+        else:
+            lower = datetime(int(year), 1, 1)
+            upper = datetime(int(year) + 1, 1, 1)
+    except ValueError:
+        raise DataValidationError("Invalid birthdate search value: " + value)
+    return prefix or "eq", lower, upper
+
+
+def birthdate_clause(column, value):
+    """
+    Translates a FHIR date search value into a filter on a DateTime column
+
+    Each prefix is a comparison against the bounds of the range the value
+    covers (see birthdate_bounds), which keeps every criterion usable with
+    the index on the column.
+
+    Args:
+        column (Column): the column holding the date to match
+        value (string): the search value, i.e. "ge1980", "lt1990-06", "1975-02-14"
+    """
+    prefix, lower, upper = birthdate_bounds(value)
+    if prefix == "eq":
+        return and_(column >= lower, column < upper)
+    if prefix == "ne":
+        return or_(column < lower, column >= upper)
+    if prefix in ("lt", "eb"):
+        return column < lower
+    if prefix == "le":
+        return column < upper
+    if prefix in ("gt", "sa"):
+        return column >= upper
+    return column >= lower      # ge
 
 
 ######################################################################
@@ -380,8 +1235,7 @@ class Pname(db.Model, PatBase):
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    pprofile_id = db.Column(db.Integer, db.ForeignKey('pprofile.id'), nullable=False)
-    #pprofile_id = db.Column(db.Integer, db.ForeignKey('pprofile.id', ondelete='cascade'))
+    pprofile_id = db.Column(PatientId, db.ForeignKey('pprofile.id', ondelete='CASCADE'), nullable=False, index=True)
     #pprofile = db.relationship('Pprofile', db.backref('pnames', cascade="all, delete-orphan"), foreign_keys=[pprofile_id], lazy='joined')
     use = db.Column(db.String(20), nullable=True)
     family = db.Column(db.String(60), nullable=False)
@@ -390,6 +1244,13 @@ class Pname(db.Model, PatBase):
     prefix_1 = db.Column(db.String(60), nullable=True)
     prefix_2 = db.Column(db.String(60), nullable=True)
 
+    # optimistic concurrency: every UPDATE checks and raises the version
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version_id}
+
+    # the columns that hold the name itself, see content()
+    fields = ("use", "family", "given_1", "given_2", "prefix_1", "prefix_2")
+
     def __repr__(self):
         return "<Pat fname=%r lname=%r id=[%s] profile=[%s]>" % (self.given[0], self.family, self.id, self.pat_id)
 
@@ -432,17 +1293,17 @@ class Pname(db.Model, PatBase):
             #parse first name list
             fname_list = data["given"]
             self.given_1 = fname_list[0]
-            if len(fname_list) >1:
-                self.given_2 = fname_list[1]
+            self.given_2 = fname_list[1] if len(fname_list) > 1 else None
 
             #parse prefix list
             prefix_list = data["prefix"]
-            self.prefix_1 = prefix_list[0]
-            if len(prefix_list) > 1:
-                self.prefix_2 = prefix_list[1]
+            self.prefix_1 = prefix_list[0] if prefix_list else None
+            self.prefix_2 = prefix_list[1] if len(prefix_list) > 1 else None
 
         except KeyError as error:
             raise DataValidationError("Invalid patient: missing " + error.args[0])
+        except IndexError as error:
+            raise DataValidationError("Invalid patient: given name list is empty")
         except TypeError as error:
             raise DataValidationError("Invalid patient: body of request contained bad or no data")
         except ValueError as error:
@@ -510,7 +1371,7 @@ class Paddress(db.Model, PatBase):
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    pprofile_id = db.Column(db.Integer, db.ForeignKey('pprofile.id'), nullable=False)
+    pprofile_id = db.Column(PatientId, db.ForeignKey('pprofile.id', ondelete='CASCADE'), nullable=False, index=True)
     use = db.Column(db.String(20), nullable=False)
     Type = db.Column(db.String(20), nullable=True)
     text = db.Column(db.String(200), nullable=True)
@@ -523,6 +1384,13 @@ class Paddress(db.Model, PatBase):
     line_1 = db.Column(db.String(80), nullable=False)
     line_2 = db.Column(db.String(80), nullable=True)
 
+    # optimistic concurrency: every UPDATE checks and raises the version
+    version_id = db.Column(db.Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version_id}
+
+    # the columns that hold the address itself, see content()
+    fields = ("use", "Type", "text", "city", "state", "postalCode", "country", "line_1", "line_2")
+
     def __repr__(self):
         return "<Pat city=%r state=%r zip=%r id=[%s] profile=[%s]>" % (self.city, self.state, self.postalCode, self.id, self.pat_id)
 
@@ -572,14 +1440,518 @@ class Paddress(db.Model, PatBase):
             #parse line address
             line_list = data["line"]
             self.line_1 = line_list[0]
-            if len(line_list) > 1:
-                self.line_2 = line_list[1]
+            self.line_2 = line_list[1] if len(line_list) > 1 else None
 
         except KeyError as error:
             raise DataValidationError("Invalid patient: missing " + error.args[0])
+        except IndexError as error:
+            raise DataValidationError("Invalid patient: address line list is empty")
         except TypeError as error:
             raise DataValidationError("Invalid patient: body of request contained bad or no data")
         except ValueError as error:
             raise DataValidationError("Invalid date value or format")
         return self
 
+
+
+######################################################################
+# SEARCH PROJECTION MODEL
+######################################################################
+
+class PatientSearch(db.Model):
+    """
+    Class that represents a flattened, searchable row of a patient
+
+    A profile has one row per pair of its names and addresses, usually a
+    single row, holding the name, the postal code and the searchable profile
+    columns, so that any search runs on this table alone. The rows are kept
+    up to date on every commit (see sync_search_projection) and go with
+    their profile through ON DELETE CASCADE.
+    """
+
+    __tablename__ = "patient_search"
+
+    id = db.Column(db.Integer, primary_key=True)
+    pprofile_id = db.Column(PatientId, db.ForeignKey('pprofile.id', ondelete='CASCADE'), nullable=False, index=True)
+    family = db.Column(db.String(60), nullable=True)
+    given = db.Column(db.String(60), nullable=True)
+    postalCode = db.Column(db.String(10), nullable=True)
+    phone_home = db.Column(db.String(10), nullable=True)
+    email = db.Column(db.String(60), nullable=True)
+    DOB = db.Column(db.DateTime, nullable=False)
+    active = db.Column(db.Boolean(), nullable=False)
+    gender = db.Column(db.Enum(Gender), nullable=False)
+
+    # covering indexes: the name and zip searches read the ids off the index
+    __table_args__ = (
+        db.Index("ix_patient_search_family", "family", "pprofile_id"),
+        db.Index("ix_patient_search_given", "given", "family", "pprofile_id"),
+        db.Index("ix_patient_search_postal_code", "postalCode", "pprofile_id"),
+    )
+
+    # the columns of a row besides pprofile_id, see rows_of()
+    fields = ("family", "given", "postalCode", "phone_home", "email", "DOB", "active", "gender")
+
+    def __repr__(self):
+        return "<PatientSearch pprofile_id=[%s] family=%r postalCode=%r>" % (
+            self.pprofile_id, self.family, self.postalCode)
+
+    @staticmethod
+    def rows_of(profile):
+        """ Returns the set of the field values of the rows of a profile """
+        names = [(name.family, name.given_1) for name in profile.name] or [(None, None)]
+        postal_codes = [address.postalCode for address in profile.address] or [None]
+        return set((family, given, postal_code, profile.phone_home, profile.email, profile.DOB,
+                    profile.active, profile.gender)
+                   for family, given in names for postal_code in postal_codes)
+
+    @classmethod
+    def refresh(cls, profiles):
+        """ Rewrites the rows of the profiles that differ from the profiles themselves """
+        wanted = dict((profile.id, cls.rows_of(profile)) for profile in profiles)
+        stale = []
+        for row in db.session.query(cls.id, cls.pprofile_id, *[getattr(cls, field) for field in cls.fields]) \
+                .filter(cls.pprofile_id.in_(list(wanted))):
+            values = tuple(row[2:])
+            if values in wanted[row[1]]:
+                wanted[row[1]].discard(values)
+            else:
+                stale.append(row[0])
+        if stale:
+            db.session.query(cls).filter(cls.id.in_(stale)).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(cls, [
+            dict(zip(cls.fields, values), pprofile_id=pat_id)
+            for pat_id, rows in wanted.items() for values in rows])
+
+    @classmethod
+    def find_ids(cls, *clauses):
+        """ Returns the ids of the profiles having a row matching all of the clauses, in order """
+        return [row[0] for row in db.session.query(cls.pprofile_id).filter(*clauses)
+                .distinct().order_by(cls.pprofile_id)]
+
+
+######################################################################
+# IDEMPOTENCY KEY MODEL
+######################################################################
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents a client supplied Idempotency-Key
+
+    The key is claimed before the request runs, so that a concurrent retry
+    cannot run it a second time, and then keeps the response to replay it
+    to later retries. A claim still without a response after its lease was
+    left by a worker that died, and goes to the next retry. Keys live in the
+    main database even when the patients are sharded.
+    """
+
+    __sharded__ = False
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)  # NULL while the request runs
+    headers = db.Column(db.Text, nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    claimed_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)  # the start of the lease
+
+    def __repr__(self):
+        return "<IdempotencyKey key=%r status_code=%s>" % (self.key, self.status_code)
+
+    @staticmethod
+    def fingerprint_of(*parts):
+        """ Returns a digest identifying a request from its method, path and body """
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part if isinstance(part, bytes) else part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @classmethod
+    def claim(cls, key, fingerprint, ttl_seconds, lease_seconds):
+        """ Claims a key and returns None, or returns the earlier claim of it
+
+        Args:
+            key (string): the Idempotency-Key header
+            fingerprint (string): the fingerprint of the request
+            ttl_seconds (int): how long a key is remembered
+            lease_seconds (int): how long a claim without a response is kept
+        """
+        now = datetime.utcnow()
+        existing = cls.query.get(key)
+        if existing is not None and existing.created < now - timedelta(seconds=ttl_seconds):
+            logger.info("Idempotency key %s has expired", key)
+            db.session.delete(existing)
+            db.session.commit()
+            existing = None
+        if existing is not None and existing.status_code is None and existing.fingerprint == fingerprint:
+            #only one retry moves the lease on, keys claimed before leases use their creation
+            taken = cls.query.filter(
+                cls.key == key, cls.status_code.is_(None),
+                db.func.coalesce(cls.claimed_at, cls.created) < now - timedelta(seconds=lease_seconds)) \
+                .update({cls.claimed_at: now}, synchronize_session=False)
+            db.session.commit()
+            if taken:
+                logger.info("Idempotency key %s is claimed again, its request never finished", key)
+                return None
+        if existing is not None:
+            return existing
+        db.session.add(cls(key=key, fingerprint=fingerprint))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            #a concurrent request with the same key claimed it first
+            db.session.rollback()
+            return cls.query.get(key)
+        return None
+
+    def record(self, status_code, headers, body):
+        """ Keeps the response of the request that claimed the key """
+        self.status_code = status_code
+        self.headers = json.dumps(headers)
+        self.body = body
+        db.session.commit()
+
+    @classmethod
+    def release(cls, key):
+        """ Forgets a key whose request failed, so that it can be retried """
+        #rolls back the request too, however deep in subtransactions it failed
+        db.session.close()
+        cls.query.filter(cls.key == key).delete(synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def purge(cls, ttl_seconds):
+        """ Deletes the expired keys and returns their number """
+        count = cls.query.filter(cls.created < datetime.utcnow() - timedelta(seconds=ttl_seconds)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+
+######################################################################
+# DUPLICATE DETECTION MODELS
+######################################################################
+
+class DedupJob(db.Model):
+    """
+    Class that represents a run of the duplicate patient detection
+
+    The job runs in the background (see service/dedup.py) and records its
+    progress here as the number of scored chunks of candidate pairs
+    """
+
+    __sharded__ = False
+
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default="queued")  # queued, running, done, failed
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+    patients = db.Column(db.Integer, nullable=True)
+    pairs = db.Column(db.Integer, nullable=True)
+    chunks_total = db.Column(db.Integer, nullable=True)
+    chunks_done = db.Column(db.Integer, nullable=False, default=0)
+    candidate_count = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    candidates = db.relationship('MatchCandidate', backref='job', cascade="all, delete-orphan",
+                                 passive_deletes=True, lazy="dynamic")
+
+    def __repr__(self):
+        return "<DedupJob id=[%s] status=%r>" % (self.id, self.status)
+
+    def serialize(self):
+        """ Serializes a job and its progress into a dictionary """
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created": self.created.isoformat() if self.created else None,
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+            "patients": self.patients,
+            "pairs": self.pairs,
+            "progress": (float(self.chunks_done) / self.chunks_total) if self.chunks_total
+                        else (1.0 if self.status == "done" else 0.0),
+            "candidates": self.candidate_count,
+            "error": self.error,
+        }
+
+
+class MatchCandidate(db.Model):
+    """
+    Class that represents a pair of patients that are probably the same person
+
+    The scores are between 0 and 1, score being the weighted total of the
+    name, birth date and postal code similarities
+    """
+
+    __sharded__ = False
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('dedup_job.id', ondelete='CASCADE'), nullable=False)
+    pat_id_1 = db.Column(PatientId, nullable=False)
+    pat_id_2 = db.Column(PatientId, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    name_score = db.Column(db.Float, nullable=False)
+    birthdate_score = db.Column(db.Float, nullable=False)
+    postal_score = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.Index("ix_match_candidate_job_score", "job_id", "score"),)
+
+    def __repr__(self):
+        return "<MatchCandidate pats=[%s, %s] score=%.3f>" % (self.pat_id_1, self.pat_id_2, self.score)
+
+    def serialize(self):
+        """ Serializes a match candidate into a dictionary """
+        return {
+            "patients": [self.pat_id_1, self.pat_id_2],
+            "score": round(self.score, 4),
+            "name_score": round(self.name_score, 4),
+            "birthdate_score": round(self.birthdate_score, 4),
+            "postal_score": round(self.postal_score, 4),
+        }
+
+
+######################################################################
+# CHANGE HISTORY MODEL
+######################################################################
+
+# FHIR instant search value: a date, optionally with a time and a time zone
+instantParam = re.compile(
+    r"^([0-9]{4}-[0-9]{2}-[0-9]{2})(?:T([0-9]{2}:[0-9]{2}(?::[0-9]{2}(?:\.[0-9]{1,6})?)?)(Z|[+-][0-9]{2}:[0-9]{2})?)?$")
+
+
+class PatientHistory(db.Model):
+    """
+    Class that represents one version of a patient in its change history
+
+    A row is appended, never changed, for every create, update and delete
+    of a profile (see record_history), in the database of the patient
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    pprofile_id = db.Column(PatientId, nullable=False)
+    version_id = db.Column(db.Integer, nullable=False)
+    method = db.Column(db.String(6), nullable=False)  # create, update or delete
+    lastUpdated = db.Column(db.DateTime, nullable=False, index=True)
+    # the JSON text of the patient at this version, NULL for a delete
+    resource = db.Column(db.Text, nullable=True)
+    __table_args__ = (db.Index("ix_patient_history_pprofile_id", "pprofile_id", "id"),)
+
+    def __repr__(self):
+        return "<PatientHistory pprofile_id=[%s] version=%s %s>" % (self.pprofile_id, self.version_id, self.method)
+
+    @classmethod
+    def record_deletes(cls, clauses):
+        """
+        Appends the deletes of the profiles matching the clauses, RECORD_BATCH_SIZE per INSERT ... SELECT
+
+        The matching profiles are locked until the end of the transaction
+        first, so that their entries are dated once the lock is granted and
+        not before a wait that may outlast HISTORY_SETTLE_SECONDS. Returns
+        the ids recorded, which the DELETE must be limited to so that a
+        profile created meanwhile is not deleted unrecorded.
+        """
+        pat_ids = [row.id for row in db.session.query(Pprofile.id).filter(*clauses).with_for_update()]
+        now = datetime.utcnow()
+        for start in range(0, len(pat_ids), RECORD_BATCH_SIZE):
+            deleted = db.session.query(Pprofile.id, Pprofile.version_id + 1, literal("delete"),
+                                       literal(now, db.DateTime)) \
+                .filter(Pprofile.id.in_(pat_ids[start:start + RECORD_BATCH_SIZE]))
+            db.session.execute(cls.__table__.insert().from_select(
+                ["pprofile_id", "version_id", "method", "lastUpdated"], deleted.statement), mapper=cls.__mapper__)
+        return pat_ids
+
+    @classmethod
+    def page(cls, clauses, after_id, count):
+        """ Returns the (id, pprofile_id, version_id, method, lastUpdated, resource) of the next entries """
+        return db.session.query(cls.id, cls.pprofile_id, cls.version_id, cls.method, cls.lastUpdated,
+                                cls.resource).filter(cls.id > after_id, *clauses).order_by(cls.id).limit(count).all()
+
+    @classmethod
+    def head(cls):
+        """ Returns the cursor after the newest entry, where the changes to come will start """
+        def newest():
+            return db.session.query(db.func.max(cls.id)).scalar() or 0
+        if sharding.needs_scatter():
+            return ".".join(str(position) for position in sharding.scatter(newest))
+        return str(newest())
+
+    @classmethod
+    def settled(cls):
+        """
+        Returns the cursor after the newest entry at least HISTORY_SETTLE_SECONDS old
+
+        Unlike head(), no transaction still committing can have an entry
+        before it, so a scan of the patients followed by the changes from
+        this cursor misses none of them
+        """
+        def newest():
+            return db.session.query(db.func.max(cls.id)).filter(cls.lastUpdated <= datetime.utcnow() - timedelta(
+                seconds=current_app.config.get("HISTORY_SETTLE_SECONDS", 2))).scalar() or 0
+        if sharding.needs_scatter():
+            return ".".join(str(position) for position in sharding.scatter(newest))
+        return str(newest())
+
+    @classmethod
+    def find_resource(cls, pat_id, version_id):
+        """ Returns the JSON text of a version of a patient, or None """
+        routed = sharding.is_sharded() and g.get("shard_bind") is None
+        if routed:
+            sharding.use_shard(pat_id)
+        try:
+            row = db.session.query(cls.resource).filter(
+                cls.pprofile_id == pat_id, cls.version_id == version_id).first()
+        finally:
+            if routed:
+                g.pop("shard_bind", None)
+        return row[0] if row else None
+
+    @classmethod
+    def for_patient(cls, pat_id, cursor, count):
+        """
+        Returns the versions of one patient, oldest first, and the next cursor
+
+        The versions are (pprofile_id, version_id, method, lastUpdated, resource)
+
+        Args:
+            pat_id (int): the id of the patient
+            cursor (str): the cursor of the last page, None to start over
+            count (int): the most entries returned
+        """
+        logger.info("Processing history of patient %s ...", pat_id)
+        after_id = parse_cursor(cursor, 1)[0]
+        rows = cls.page([cls.pprofile_id == pat_id], after_id, count)
+        return [tuple(row[1:]) for row in rows], str(rows[-1][0] if rows else after_id)
+
+    @classmethod
+    def feed(cls, since, cursor, count):
+        """
+        Returns the versions of every patient, oldest first, and the next cursor
+
+        Entries only show up once they are HISTORY_SETTLE_SECONDS old, so that
+        a transaction still committing when a page is read cannot be passed
+        over. When the patients are sharded the cursor holds a position per
+        shard, and the pages of the shards are merged by lastUpdated.
+
+        Args:
+            since (datetime): only the changes made at or after this time, or None
+            cursor (str): the cursor of the last page, None to start over
+            count (int): the most entries returned
+        """
+        logger.info("Processing change feed since %s ...", since)
+        clauses = [cls.lastUpdated <= datetime.utcnow() - timedelta(
+            seconds=current_app.config.get("HISTORY_SETTLE_SECONDS", 2))]
+        if since is not None:
+            clauses.append(cls.lastUpdated >= since)
+        if not sharding.needs_scatter():
+            after_id = parse_cursor(cursor, 1)[0]
+            rows = cls.page(clauses, after_id, count)
+            return [tuple(row[1:]) for row in rows], str(rows[-1][0] if rows else after_id)
+
+        binds = sharding.shard_binds()
+        positions = parse_cursor(cursor, len(binds))
+
+        def shard_page():
+            shard = binds.index(g.shard_bind)
+            return [(shard,) + tuple(row) for row in cls.page(clauses, positions[shard], count)]
+
+        pages = sharding.scatter(shard_page)
+        merged = list(itertools.islice(heapq.merge(*pages, key=lambda row: (row[5], row[0], row[1])), count))
+        for row in merged:
+            positions[row[0]] = row[1]
+        return [row[2:] for row in merged], ".".join(str(position) for position in positions)
+
+
+def parse_cursor(cursor, size):
+    """ Returns the positions held by a change history cursor, one per database """
+    if not cursor:
+        return [0] * size
+    positions = cursor.split(".")
+    if len(positions) != size or not all(position.isdigit() for position in positions):
+        raise DataValidationError("Invalid _cursor: " + cursor)
+    return [int(position) for position in positions]
+
+
+def parse_instant(value):
+    """ Returns the UTC time of a FHIR instant or date search value """
+    #an unencoded + in a query string arrives as a space
+    match = instantParam.match(value.strip().replace(" ", "+"))
+    if not match:
+        raise DataValidationError("Invalid instant: " + value)
+    day, clock, zone = match.groups()
+    try:
+        instant = datetime.strptime(day + "T" + (clock or "00:00"), "%Y-%m-%dT%H:%M" + (
+            "" if clock is None or clock.count(":") == 1 else ":%S.%f" if "." in clock else ":%S"))
+    except ValueError:
+        raise DataValidationError("Invalid instant: " + value)
+    if zone and zone != "Z":
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[4:6]))
+        instant = instant - offset if zone[0] == "+" else instant + offset
+    return instant
+
+
+######################################################################
+# SUBSCRIPTION MODEL
+######################################################################
+
+class Subscription(db.Model):
+    """
+    Class that represents a subscription to the changes of the patients matching criteria
+
+    The criteria are FHIR search parameters, i.e. "Patient?postalCode=90210";
+    the changes are pushed by service/subscriptions.py
+    """
+
+    __sharded__ = False
+
+    id = db.Column(db.Integer, primary_key=True)
+    criteria = db.Column(db.String(2048), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default="active")
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<Subscription id=[%s] criteria=%r>" % (self.id, self.criteria)
+
+    def create(self):
+        """ Adds a new subscription to the database """
+        logger.info("Creating subscription to %s", self.criteria)
+        self.id = None
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        """ Removes a subscription from the database """
+        logger.info("Deleting subscription with id=%s", self.id)
+        db.session.delete(self)
+        db.session.commit()
+
+    def serialize(self):
+        """ Serializes a subscription into a dictionary """
+        return {
+            "resourceType": "Subscription",
+            "id": self.id,
+            "status": self.status,
+            "criteria": self.criteria,
+            "channel": {"type": "sse"},
+        }
+
+    def deserialize(self, data):
+        """
+        Deserializes a subscription from a dictionary
+
+        Args:
+            data (dict): A dictionary containing the criteria and an sse channel
+        """
+        try:
+            criteria = data["criteria"]
+            channel = data.get("channel") or {"type": "sse"}
+        except KeyError as error:
+            raise DataValidationError("Invalid subscription: missing " + error.args[0])
+        except (TypeError, AttributeError):
+            raise DataValidationError("Invalid subscription: body of request contained bad or no data")
+        if not isinstance(criteria, str) or not (criteria == "Patient" or criteria.startswith("Patient?")):
+            raise DataValidationError("Invalid subscription: the criteria must be a Patient search")
+        if not isinstance(channel, dict) or channel.get("type") != "sse":
+            raise DataValidationError("Invalid subscription: only the sse channel type is supported")
+        self.criteria = criteria
+        return self
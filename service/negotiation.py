@@ -0,0 +1,158 @@
+# Content Negotiation
+
+"""
+Content negotiation between JSON, MessagePack and CBOR
+
+Every response body can be sent as JSON, MessagePack or CBOR, as asked by
+the Accept header (JSON when the client does not say). The documents have
+the same structure in every format, the one of Pprofile.serialize(). POST
+and PUT bodies may be sent in any of these formats too.
+
+MessagePack needs the msgpack package and CBOR the cbor2 package; a format
+whose package is not installed is simply not offered.
+"""
+import json
+import logging
+from flask import Response, request, jsonify as flask_jsonify, stream_with_context
+from service.models import DataValidationError
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is optional
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # CBOR is optional
+    cbor2 = None
+
+logger = logging.getLogger("gunicorn.error")
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+# Other names clients use for MessagePack request bodies
+MSGPACK_ALIASES = ("application/x-msgpack", "application/vnd.msgpack")
+
+
+def response_types():
+    """ Returns the media types the responses can be sent in, preferred first """
+    types = [JSON]
+    if msgpack is not None:
+        types.append(MSGPACK)
+    if cbor2 is not None:
+        types.append(CBOR)
+    return types
+
+
+def body_types():
+    """ Returns the media types accepted for POST and PUT bodies """
+    types = response_types()
+    if msgpack is not None:
+        types.extend(MSGPACK_ALIASES)
+    return types
+
+
+def response_type():
+    """ Returns the media type to answer the request with """
+    return request.accept_mimetypes.best_match(response_types(), default=JSON)
+
+
+def encode(data, mimetype):
+    """ Encodes a document as MessagePack or CBOR """
+    if mimetype == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+    return cbor2.dumps(data)
+
+
+def decode(body, mimetype):
+    """ Decodes a MessagePack or CBOR document """
+    if mimetype == CBOR:
+        return cbor2.loads(body)
+    return msgpack.unpackb(body, raw=False)
+
+
+######################################################################
+#  R E S P O N S E S
+######################################################################
+
+def jsonify(*args, **kwargs):
+    """
+    Works like flask.jsonify, but in the negotiated media type
+
+    The arguments are the same: a single document, several documents
+    making a list, or keywords making a dictionary
+    """
+    mimetype = response_type()
+    if mimetype == JSON:
+        response = flask_jsonify(*args, **kwargs)
+    else:
+        if args and kwargs:
+            raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+        data = kwargs or (args[0] if len(args) == 1 else list(args))
+        response = Response(encode(data, mimetype), mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+
+def resource_response(resource, status_code, headers=None):
+    """
+    Returns a response for a document already rendered as JSON text
+
+    The text is sent as is when JSON is asked for, so the stored patient
+    JSON is never parsed in that case
+    """
+    mimetype = response_type()
+    if mimetype != JSON:
+        resource = encode(json.loads(resource), mimetype)
+    response = Response(resource, status_code, headers, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+
+def stream_resources(resources, status_code):
+    """
+    Returns a streamed response holding a list of JSON text documents
+
+    JSON and CBOR (an indefinite length array) are written as the documents
+    come; MessagePack needs the array length first, so it reads them all
+    """
+    mimetype = response_type()
+
+    def generate():
+        if mimetype == JSON:
+            yield "["
+            for count, resource in enumerate(resources):
+                yield "," + resource if count else resource
+            yield "]"
+        elif mimetype == CBOR:
+            yield b"\x9f"
+            for resource in resources:
+                yield cbor2.dumps(json.loads(resource))
+            yield b"\xff"
+        else:
+            documents = list(resources)
+            packer = msgpack.Packer(use_bin_type=True)
+            yield packer.pack_array_header(len(documents))
+            for resource in documents:
+                yield packer.pack(json.loads(resource))
+    response = Response(stream_with_context(generate()), status_code, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+
+######################################################################
+#  R E Q U E S T S
+######################################################################
+
+def request_data():
+    """ Returns the document in the request body, in whichever format it came """
+    mimetype = request.mimetype
+    if mimetype not in (MSGPACK, CBOR) + MSGPACK_ALIASES:
+        return request.get_json()
+    try:
+        return decode(request.get_data(), mimetype)
+    except Exception as error:  # the decoders raise many error types
+        logger.warning("Cannot decode a %s body: %s", mimetype, error)
+        raise DataValidationError("Invalid {} request body: {}".format(mimetype, error))
@@ -0,0 +1,247 @@
+# Request Profiling
+
+"""
+On-demand CPU profiling of single requests
+
+A request is profiled when it carries an X-Profile header holding the
+PROFILE_TOKEN, or when it is picked at random, one in 1 / PROFILE_SAMPLE_RATE.
+From its first before_request hook to the end of its (maybe streamed)
+response, a sampler thread records the stack of the thread running it
+every PROFILE_INTERVAL seconds, which costs the request next to nothing.
+The stacks are written to PROFILE_DIR in the collapsed format of flame
+graphs (one "frame;frame;frame count" line per distinct stack):
+
+    <endpoint>-<time>-<pid>-<n>.collapsed
+
+so that, i.e., the share of list_pats spent in Pprofile.serialize,
+SQLAlchemy and jsonify is the share of the lines going through them.
+With "pstats" in PROFILE_FORMATS the request is also run under cProfile
+(exact call counts, at a much higher cost) and its statistics written to
+a .pstats file, to be read with pstats or snakeviz.
+
+The name of the files is sent in the X-Profile-Id response header, and
+GET /admin/profiles lists them and GET /admin/profiles/<name> sends one.
+Only the newest PROFILE_MAX_FILES files are kept.
+
+Under gevent workers the requests are greenlets sharing one thread, so
+the sampler is a native thread, which runs whatever the hub does, and it
+records the stack of the greenlet of the request: its current frame while
+it runs, the frame it is suspended in otherwise. cProfile cannot tell the
+greenlets apart, so no .pstats file is written under gevent.
+
+Configuration
+-------------
+PROFILE_TOKEN - the X-Profile header value asking for a profile, none when empty
+PROFILE_SAMPLE_RATE - the share of the requests profiled at random
+PROFILE_INTERVAL - seconds between two samples
+PROFILE_FORMATS - the files written, "collapsed" and/or "pstats"
+PROFILE_DIR - the directory of the files
+PROFILE_MAX_FILES - the most files kept
+"""
+import os
+import re
+import sys
+import time
+import random
+import cProfile
+import logging
+import itertools
+from collections import Counter
+from flask import g, request, current_app
+
+try:
+    from gevent import monkey
+    import greenlet
+except ImportError:  # gevent workers are optional
+    monkey = greenlet = None
+
+logger = logging.getLogger("gunicorn.error")
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+# Endpoints never profiled
+EXEMPT_ENDPOINTS = ("static", "stream_subscription", "list_profiles", "get_profile")
+
+# The file names the admin endpoint sends
+profileName = re.compile(r"^[A-Za-z0-9_]+-\d+-\d+-\d+\.(collapsed|pstats)$")
+
+_sequence = itertools.count(1)
+
+
+def original(module, name):
+    """ Returns a function of the standard library as it was before gevent patched it """
+    if monkey is None:
+        return getattr(__import__(module), name)
+    return monkey.get_original(module, name)
+
+
+def under_gevent():
+    """ Returns True when gevent has made the threads greenlets """
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def current_task():
+    """ Returns the native thread id and the greenlet (None without gevent) running the request """
+    thread_id = original("_thread", "get_ident")()
+    return thread_id, greenlet.getcurrent() if under_gevent() else None
+
+
+class Sampler():
+    """ One native thread sampling the stacks of the profiled requests """
+
+    def __init__(self):
+        self.lock = original("_thread", "allocate_lock")()
+        self.stacks = {}        # (thread id, greenlet) -> Counter of collapsed stacks
+        self.running = False
+
+    def start(self, task, interval):
+        """ Starts recording the stacks of a task, see current_task() """
+        with self.lock:
+            self.stacks[task] = Counter()
+            if not self.running:
+                self.running = True
+                original("_thread", "start_new_thread")(self.run, (interval,))
+
+    def stop(self, task):
+        """ Stops recording a task and returns its stacks """
+        with self.lock:
+            return self.stacks.pop(task, Counter())
+
+    def run(self, interval):
+        """ Samples the recorded tasks until none is left """
+        me = original("_thread", "get_ident")()
+        sleep = original("time", "sleep")
+        while True:
+            sleep(interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.stacks:
+                    self.running = False
+                    return
+                for (thread_id, task), stacks in self.stacks.items():
+                    if task is None:
+                        frame = frames.get(thread_id) if thread_id != me else None
+                    elif task.gr_frame is not None:
+                        frame = task.gr_frame       # suspended, i.e. waiting for the database
+                    else:
+                        #the greenlet running on its thread, unless it is over
+                        frame = frames.get(thread_id) if task else None
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+
+def collapse(frame):
+    """ Returns a stack as "module:function;...", outermost first """
+    names = []
+    while frame is not None:
+        names.append("{}:{}".format(frame.f_globals.get("__name__", "?"), frame.f_code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def profile_dir(app):
+    """ Returns the directory of the profiles, creating it when missing """
+    directory = app.config.get("PROFILE_DIR") or "/tmp/profiles"
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def list_profiles(app, endpoint=None):
+    """ Returns the name, route, format, size and creation time of the profiles, newest first """
+    directory = profile_dir(app)
+    profiles = []
+    for name in os.listdir(directory):
+        if not profileName.match(name):
+            continue
+        info = os.stat(os.path.join(directory, name))
+        route = name.split("-", 1)[0]
+        if endpoint is None or route == endpoint:
+            profiles.append({"name": name, "route": route, "format": name.rsplit(".", 1)[1],
+                             "size": info.st_size, "created": info.st_mtime})
+    profiles.sort(key=lambda profile: (profile["created"], profile["name"]), reverse=True)
+    return profiles
+
+
+def prune(app):
+    """ Removes the oldest profiles past PROFILE_MAX_FILES """
+    for profile in list_profiles(app)[app.config.get("PROFILE_MAX_FILES", 200):]:
+        try:
+            os.remove(os.path.join(profile_dir(app), profile["name"]))
+        except OSError:  # removed by another worker
+            pass
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+def wants_profile():
+    """ Returns True when the request is to be profiled """
+    config = current_app.config
+    if request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS:
+        return False
+    token = config.get("PROFILE_TOKEN")
+    if token and request.headers.get(PROFILE_HEADER) == token:
+        return True
+    rate = config.get("PROFILE_SAMPLE_RATE", 0)
+    return rate > 0 and random.random() < rate
+
+
+def start_profile():
+    """ Starts profiling the request when asked to """
+    if not wants_profile():
+        return
+    config = current_app.config
+    name = "{}-{}-{}-{}".format(request.endpoint, int(time.time() * 1000), os.getpid(), next(_sequence))
+    task = current_task()
+    profiler = None
+    if "pstats" in (config.get("PROFILE_FORMATS") or ("collapsed",)):
+        if task[1] is not None:
+            logger.warning("Not profiling %s with cProfile, which mixes up the greenlets", name)
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+    sampler.start(task, config.get("PROFILE_INTERVAL", 0.005))
+    g.profile = (name, task, profiler, time.time())
+
+
+def name_profile(response):
+    """ Tells the client the name of the profile of its request """
+    profile = g.get("profile")
+    if profile is not None:
+        response.headers[PROFILE_ID_HEADER] = profile[0]
+    return response
+
+
+def finish_profile(exception=None):
+    """ Writes the profile of the request once its response is sent """
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    name, task, profiler, started = profile
+    stacks = sampler.stop(task)
+    if profiler is not None:
+        profiler.disable()
+    app = current_app._get_current_object()
+    directory = profile_dir(app)
+    if "collapsed" in (app.config.get("PROFILE_FORMATS") or ("collapsed",)):
+        with open(os.path.join(directory, name + ".collapsed"), "w") as collapsed:
+            for stack, count in sorted(stacks.items()):
+                collapsed.write("{} {}\n".format(stack, count))
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(directory, name + ".pstats"))
+    logger.info("Profiled %s %s in %.3fs: %d samples, %s", request.method, request.path,
+                time.time() - started, sum(stacks.values()), name)
+    prune(app)
+
+
+def init_app(app):
+    """ Registers the profiling hooks """
+    app.before_request(start_profile)
+    app.after_request(name_profile)
+    app.teardown_request(finish_profile)
+
+
+# the sampler of this process
+sampler = Sampler()
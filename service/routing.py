@@ -0,0 +1,116 @@
+# Database Engine Routing
+
+"""
+Engine routing for the patient database
+
+Reads of GET requests are sent to a pool of read replicas while every
+write, and every flush, goes to the primary. A client that has just
+written keeps reading from the primary for READ_YOUR_WRITES_SECONDS so
+that it sees its own changes even when the replicas lag behind.
+
+Configuration
+-------------
+SQLALCHEMY_REPLICA_URIS - list of read replica database URIs (may be empty)
+READ_YOUR_WRITES_SECONDS - how long a client reads from the primary after a write
+"""
+import time
+import random
+import logging
+from flask import g, request, current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+logger = logging.getLogger("gunicorn.error")
+
+# Cookie remembering until when a client reads from the primary
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+# Methods that only read and can be served by a replica
+READ_METHODS = ("GET", "HEAD")
+
+
+class RoutingSession(SignallingSession):
+    """ A session that runs the reads of GET requests on a read replica """
+
+    def get_bind(self, mapper=None, clause=None):
+        """ Returns the shard or replica picked for the request, or the primary """
+        if has_app_context():
+            # a patient shard takes both reads and writes, replicas only reads;
+            # models marked __sharded__ = False always live in the main database
+            bind_key = g.get("shard_bind")
+            if mapper is not None and not getattr(mapper.class_, "__sharded__", True):
+                bind_key = None
+            if bind_key is None and not self._flushing:
+                bind_key = g.get("replica_bind")
+            if bind_key is not None:
+                return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ The SQLAlchemy object of the service, creating RoutingSession sessions """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+def configure_replicas(app):
+    """ Registers the replica URIs as SQLAlchemy binds and returns their keys """
+    binds = dict((key, uri) for key, uri in (app.config.get("SQLALCHEMY_BINDS") or {}).items()
+                 if not key.startswith("replica_"))
+    keys = []
+    for index, uri in enumerate(app.config.get("SQLALCHEMY_REPLICA_URIS") or []):
+        key = "replica_{}".format(index)
+        binds[key] = uri
+        keys.append(key)
+    app.config["SQLALCHEMY_BINDS"] = binds
+    app.extensions["replica_binds"] = keys
+    return keys
+
+
+def route_reads():
+    """ Picks a replica for the reads of a GET request """
+    g.replica_bind = None
+    g.written_at = None
+    if request.method not in READ_METHODS:
+        return
+    try:
+        read_primary_until = float(request.cookies.get(READ_PRIMARY_COOKIE, 0))
+    except ValueError:
+        read_primary_until = 0
+    if read_primary_until > time.time():
+        # when the client wrote, which a read it shares must not have started before
+        g.written_at = read_primary_until - current_app.config.get("READ_YOUR_WRITES_SECONDS", 0)
+        logger.debug("Reading from the primary after a recent write")
+        return
+    replicas = current_app.extensions.get("replica_binds")
+    if replicas:
+        g.replica_bind = random.choice(replicas)
+
+
+def forget_replica(exception=None):
+    """ Stops routing reads once the request is over """
+    g.pop("replica_bind", None)
+    g.pop("written_at", None)
+
+
+def remember_writes(response):
+    """ Makes a client that has written read from the primary for a while """
+    window = current_app.config.get("READ_YOUR_WRITES_SECONDS", 0)
+    if request.method not in READ_METHODS and response.status_code < 400 and window > 0 \
+            and current_app.extensions.get("replica_binds"):
+        response.set_cookie(READ_PRIMARY_COOKIE, "{:.3f}".format(time.time() + window),
+                            max_age=window, httponly=True)
+    return response
+
+
+def init_app(app):
+    """ Sets up the replica binds and the request hooks that route to them """
+    configure_replicas(app)
+    app.before_request(route_reads)
+    app.after_request(remember_writes)
+    app.teardown_request(forget_replica)
@@ -6,23 +6,65 @@ Patient Membership Data Set
 Paths:
 ------
 GET /pats - Returns a list all of the patients
+GET /pats?birthdate=ge1980&birthdate=lt1990 - Returns the patients matching the search parameters
+GET /pats?_offset=20&_count=10 - Returns one page of the patients, in id order
+GET /pats?_id=1,2,3 - Returns a Bundle of the patients with the given ids, at most MAX_ID_LIST of them
+POST /pats/_search - Returns a Bundle of the patients matching the form encoded search parameters
+GET /pats/$stats?groupBy=gender,ageBand - Returns the number of patients per group
+GET /pats/$analytics?age=ge65&zip=902 - Returns the number of patients matching filters, from memory
 GET /pats/{id} - Returns the patient with a given id number
+GET /pats/_history?_since=2020-01-01T00:00:00Z - Returns a Bundle of the changes to every patient
+GET /pats/{id}/_history - Returns a Bundle of the versions of a patient
 POST /pats - creates a new patient record in the database
+POST /pats with If-None-Exist: email=a@b.com - creates a patient unless one matches the search
 PUT /pats/{id} - updates a patient record in the database
+PATCH /pats/{id} - applies a JSON Patch to a patient record in the database
 DELETE /pats/{id} - deletes a patient record in the database
+DELETE /pats?postalCode=90210 - deletes every patient matching the search parameters
+POST /pats/$dedup - starts a search for duplicate patients in the background
+GET /pats/$dedup/{id} - returns the progress of a duplicate search
+GET /pats/$dedup/{id}/candidates - returns the probable duplicates found, best match first
+POST /subscriptions - subscribes to the changes of the patients matching search criteria
+GET /subscriptions/{id} - returns a subscription
+GET /subscriptions/{id}/$events - streams the matching patient changes as Server-Sent Events
+DELETE /subscriptions/{id} - deletes a subscription and ends its event streams
+/admin/* - the admin routes below, which need an X-Admin-Token header holding ADMIN_TOKEN
+GET /admin/coalescing - returns the identical reads waiting on one another
+GET /admin/admission - returns the concurrency limits of the classes of routes
+GET /admin/profiles - lists the CPU profiles of the profiled requests
+GET /admin/profiles/{name} - returns a CPU profile file
+POST /admin/tracemalloc - starts tracing the memory allocations of sampled requests
+GET /admin/tracemalloc - returns the allocation sites growing the most per route
+DELETE /admin/tracemalloc - stops tracing the memory allocations
+GET /admin/traces - lists the last traced requests
+GET /admin/traces/{id} - returns the spans of a traced request as a waterfall
 """
 
-#import os
+import os
 #import sys
 #import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+import hmac
+import json
+from flask import Flask, request, url_for, make_response, abort, send_file
 from flask_api import status  # HTTP Status Codes
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 #from flask_sqlalchemy import SQLAlchemy
 from werkzeug.exceptions import NotFound
-from service.models import Pprofile, Pname, Paddress, DataValidationError, Gender
+from werkzeug.urls import url_decode
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import Pprofile, Pname, Paddress, PatientHistory, IdempotencyKey, DedupJob, MatchCandidate, \
+    Subscription, DataValidationError, DataConflictError, Gender, parse_id_list, page_params, parse_instant, \
+    dump_resource, db
+from service import dedup, subscriptions, stats, analytics, coalescing, admission, profiling, allocations, \
+    tracing
+from service.idempotency import idempotent
+from service.coalescing import coalesced
+from service.deadlines import DeadlineExceeded, is_timeout, until_first
+# jsonify() answers in JSON, MessagePack or CBOR, as negotiated with Accept
+from service.negotiation import jsonify, resource_response, stream_resources, request_data, body_types
 
 
 # Import Flask application
@@ -37,6 +79,45 @@ def request_validation_error(error):
     return bad_request(error)
 
 
+@app.errorhandler(DataConflictError)
+def request_conflict_error(error):
+    """ Handles changes that do not apply to the current data """
+    return resource_state_conflict(error)
+
+
+@app.errorhandler(StaleDataError)
+def request_stale_error(error):
+    """ Handles writes that lost a race with another writer """
+    return precondition_failed("The resource was changed by another request, reload it and retry")
+
+
+@app.errorhandler(DeadlineExceeded)
+def request_deadline_error(error):
+    """ Handles requests that ran out of time before reaching the database """
+    return deadline_exceeded(str(error))
+
+
+@app.errorhandler(OperationalError)
+def request_database_error(error):
+    """ Handles statements stopped by the request deadline, and other database failures """
+    if is_timeout(error):
+        return deadline_exceeded("The request ran out of time and its query was canceled")
+    return internal_server_error(error)
+
+
+def deadline_exceeded(message):
+    """ Answers a request that ran out of time with 503_SERVICE_UNAVAILABLE and an OperationOutcome """
+    app.logger.warning("%s: %s %s", message, request.method, request.path)
+    db.session.rollback()
+    return (
+        jsonify(
+            resourceType="OperationOutcome",
+            issue=[{"severity": "error", "code": "timeout", "diagnostics": message}],
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
@@ -110,6 +191,30 @@ def resource_state_conflict(error):
         status.HTTP_409_CONFLICT,
     )
 
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """ Handles stale If-Match versions with 412_PRECONDITION_FAILED """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED, error="Precondition Failed", message=message
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+@app.errorhandler(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+def request_entity_too_large(error):
+    """ Handles oversized request bodies with 413_REQUEST_ENTITY_TOO_LARGE """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, error="Request Entity Too Large", message=message
+        ),
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+    )
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -125,6 +230,22 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """ Handles requests shed under load with 503_SERVICE_UNAVAILABLE """
+    message = str(error.description)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": str(getattr(error, "retry_after", 1))},
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -163,51 +284,45 @@ def index():
 # LIST ALL PATIENTS
 ######################################################################
 @app.route("/pats", methods=["GET"])
+@coalesced
 def list_pats():
     """ Returns all of the Pats """
     app.logger.info("Request for patient list")
 
-    #create profile, name and address list
-    pats = []
+    #a list of known ids is answered with a Bundle that reports the missing ones
+    if request.args.get("_id"):
+        return resource_response(search_bundle(request.args), status.HTTP_200_OK)
 
-    phone_home = request.args.get("phone_home")
-    email = request.args.get("email")
-    active_str = request.args.get("active")
-    gender = request.args.get("gender")
+    #every search parameter given is combined with the others, including
+    #any number of birthdate criteria, i.e. birthdate=ge1980&birthdate=lt1990
+    #the query runs here, under the deadline of the request, which ends with it
+    rows = until_first(Pprofile.search_json(request.args))
 
-    family = request.args.get("family")
-    given_1 = request.args.get("given")
-    postalCode = request.args.get("postalCode")
+    #stream the stored patient JSON as one array without re-serializing it
+    return stream_resources((resource for _, resource in rows), status.HTTP_200_OK)
 
 
-    if phone_home:
-        pats = Pprofile.find_by_phone(phone_home)
-    elif email:
-        pats = Pprofile.find_by_email(email)
-    elif active_str:
-        pats = Pprofile.find_by_acive(bool(active_str))
-    elif gender:
-        pats = Pprofile.find_by_gender(getattr(Gender, gender))
-    elif postalCode:
-        pats = Pprofile.find_by_zip(postalCode)
-    elif family and (not given_1):
-        pats = Pprofile.find_by_lname(family)
-    elif given_1 and (not family):
-        pats = Pprofile.find_by_fname(given_1)
-    elif given_1 and family:
-        pats = Pprofile.find_by_name(given_1, family)
-    else:
-        pats = Pprofile.all()
-
-    #serialize the convert to json
-    results = [pat.serialize() for pat in pats]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+######################################################################
+# SEARCH PATIENTS WITH A FORM POST
+######################################################################
+@app.route("/pats/_search", methods=["POST"])
+def search_pats():
+    """
+    Search Pats with the parameters in a form encoded body
+
+    This endpoint takes the same parameters as GET /pats, so that long
+    _id lists do not have to fit in the query string
+    """
+    app.logger.info("Request to search patients")
+    check_content_type("application/x-www-form-urlencoded")
+    return resource_response(search_bundle(request.values), status.HTTP_200_OK)
 
 
 ######################################################################
 # RETRIEVE A PATIENT
 ######################################################################
 @app.route("/pats/<int:pat_id>", methods=["GET"])
+@coalesced
 def get_pats(pat_id):
     """
     Retrieve a single Pat
@@ -215,30 +330,117 @@ def get_pats(pat_id):
     This endpoint will return a Pat based on his id
     """
     app.logger.info("Request for patient with id: %s", pat_id)
-    pat = Pprofile.find(pat_id)
-    if not pat:
+    found = Pprofile.find_json(pat_id, with_version=True)
+    if found is None:
+        raise NotFound("Patient with id '{}' was not found.".format(pat_id))
+    resource, version_id = found
+    return resource_response(resource, status.HTTP_200_OK, {"ETag": etag_for(version_id)})
+
+
+######################################################################
+# COUNT THE PATIENTS PER GROUP
+######################################################################
+@app.route("/pats/$stats", methods=["GET"])
+@coalesced
+def get_stats():
+    """
+    Returns the number of Pats per group of the groupBy dimensions
+
+    The dimensions are gender, active, ageBand, state and postalCode, i.e.
+    groupBy=gender,ageBand; the other parameters select the Pats counted
+    the same way as GET /pats
+    """
+    app.logger.info("Request for patient statistics: %s", dict(request.args))
+    return make_response(jsonify(stats.statistics(request.args, app.config)), status.HTTP_200_OK)
+
+
+######################################################################
+# COUNT THE PATIENTS FROM THE ANALYTICS SNAPSHOT
+######################################################################
+@app.route("/pats/$analytics", methods=["GET"])
+@coalesced
+def get_analytics():
+    """
+    Returns the number of Pats matching filters, per group of the groupBy dimensions
+
+    The filters are gender (comma separated), active, family, given, zip
+    (a prefix), birthdate and age (which may repeat, i.e. age=ge18&age=lt65);
+    the dimensions are gender, active and ageBand. The counts come from the
+    in-memory snapshot of the Pats, kept when ANALYTICS_SNAPSHOT is set.
+    """
+    app.logger.info("Request for patient analytics: %s", dict(request.args))
+    if not app.config.get("ANALYTICS_SNAPSHOT"):
+        raise NotFound("The analytics snapshot is not enabled.")
+    return make_response(jsonify(analytics.analytics(request.args, app.config)), status.HTTP_200_OK)
+
+
+######################################################################
+# RETRIEVE THE CHANGES TO ALL PATIENTS
+######################################################################
+@app.route("/pats/_history", methods=["GET"])
+@coalesced
+def list_history():
+    """
+    Returns the changes to every patient, oldest first, as a history Bundle
+
+    _since only returns the changes made at or after an instant; the next
+    link of the Bundle carries on after the last change returned and is
+    also the link to poll for changes to come
+    """
+    app.logger.info("Request for the change history")
+    since = parse_instant(request.args["_since"]) if request.args.get("_since") else None
+    versions, cursor = PatientHistory.feed(since, request.args.get("_cursor"), history_count(request.args))
+    return resource_response(history_bundle(versions, cursor), status.HTTP_200_OK)
+
+
+######################################################################
+# RETRIEVE THE VERSIONS OF A PATIENT
+######################################################################
+@app.route("/pats/<int:pat_id>/_history", methods=["GET"])
+@coalesced
+def get_history(pat_id):
+    """ Returns every version of a Pat, oldest first, as a history Bundle """
+    app.logger.info("Request for the history of patient with id: %s", pat_id)
+    versions, cursor = PatientHistory.for_patient(pat_id, request.args.get("_cursor"), history_count(request.args))
+    if not versions and not request.args.get("_cursor"):
         raise NotFound("Patient with id '{}' was not found.".format(pat_id))
-    return make_response(jsonify(pat.serialize()), status.HTTP_200_OK)
+    return resource_response(history_bundle(versions, cursor, pat_id=pat_id), status.HTTP_200_OK)
 
 
 ######################################################################
 # ADD A NEW PATIENT
 ######################################################################
 @app.route("/pats", methods=["POST"])
+@idempotent
 def create_pats():
     """
     Creates a Pat
     This endpoint will create a Pat based the data in the body that is posted
+
+    With an If-None-Exist header holding search parameters, i.e.
+    "phone_home=5551234567", the Pat is only created when none matches:
+    a single match is returned with 200_OK and several are an error
     """
     app.logger.info("Request to create a patient")
-    check_content_type("application/json")
+    check_content_type(*body_types())
     pat = Pprofile()
-    pat.deserialize(request.get_json())
+    pat.deserialize(request_data())
+    if request.headers.get("If-None-Exist"):
+        existing = Pprofile.find_existing(url_decode(request.headers["If-None-Exist"]))
+        if len(existing) > 1:
+            abort(412, "More than one patient matches If-None-Exist")
+        if existing:
+            pat_id, resource = existing[0]
+            app.logger.info("Patient %s already exists", pat_id)
+            version_id = Pprofile.find_json(pat_id, with_version=True)[1]
+            location_url = url_for("get_pats", pat_id=pat_id, _external=True)
+            return resource_response(resource, status.HTTP_200_OK,
+                                     {"Location": location_url, "ETag": etag_for(version_id)})
     pat.create()
     message = pat.serialize()
     location_url = url_for("get_pats", pat_id=pat.id, _external=True)
     return make_response(
-        jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+        jsonify(message), status.HTTP_201_CREATED, {"Location": location_url, "ETag": etag_for(pat.version_id)}
     )
 
 
@@ -253,14 +455,38 @@ def update_pats(pat_id):
     This endpoint will update a Pat based the body that is posted
     """
     app.logger.info("Request to update patient with id: %s", pat_id)
-    check_content_type("application/json")
+    check_content_type(*body_types())
     pat = Pprofile.find(pat_id)
     if not pat:
         raise NotFound("Patient with id '{}' was not found.".format(pat_id))
-    pat.deserialize(request.get_json())
+    check_if_match(pat.version_id)
+    pat.deserialize(request_data())
     pat.id = pat_id
     pat.save()
-    return make_response(jsonify(pat.serialize()), status.HTTP_200_OK)
+    return make_response(jsonify(pat.serialize()), status.HTTP_200_OK, {"ETag": etag_for(pat.version_id)})
+
+
+######################################################################
+# PATCH AN EXISTING PATIENT
+######################################################################
+@app.route("/pats/<int:pat_id>", methods=["PATCH"])
+def patch_pats(pat_id):
+    """
+    Patch a Pat
+
+    This endpoint will apply the JSON Patch in the body to a Pat, writing
+    only the fields it changes
+    """
+    app.logger.info("Request to patch patient with id: %s", pat_id)
+    check_content_type("application/json-patch+json")
+    pat = Pprofile.find(pat_id)
+    if not pat:
+        raise NotFound("Patient with id '{}' was not found.".format(pat_id))
+    check_if_match(pat.version_id)
+    pat.patch(request.get_json())
+    pat.save()
+    resource, version_id = Pprofile.find_json(pat_id, with_version=True)
+    return resource_response(resource, status.HTTP_200_OK, {"ETag": etag_for(version_id)})
 
 
 ######################################################################
@@ -274,11 +500,336 @@ def delete_pats(pat_id):
     This endpoint will delete a Pat based the id specified in the path
     """
     app.logger.info("Request to delete the patient with id: %s", pat_id)
-    pat = Pprofile.find(pat_id)
-    if pat:
-        pat.delete()
+    clauses = [Pprofile.id == pat_id]
+    versions = if_match_versions()
+    if versions is not None:
+        clauses.append(Pprofile.version_id.in_(versions))
+    if not Pprofile.delete_matching(clauses) and versions is not None and Pprofile.find(pat_id):
+        abort(412, "The resource has changed since version {}".format(versions[-1]))
+    return make_response("", status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+# DELETE ALL MATCHING PATIENTS
+######################################################################
+@app.route("/pats", methods=["DELETE"])
+def delete_matching_pats():
+    """
+    Delete all Pats matching the search parameters
+
+    This endpoint runs a single set-based DELETE for the same parameters as
+    GET /pats. At least one parameter is required.
+    """
+    app.logger.info("Request to delete patients matching: %s", dict(request.args))
+    clauses = Pprofile.search_clauses(request.args)
+    if not clauses:
+        raise DataValidationError("A conditional delete needs at least one search parameter")
+    count = Pprofile.delete_matching(clauses)
+    app.logger.info("Deleted %d patients", count)
+    return make_response("", status.HTTP_204_NO_CONTENT)
+
+######################################################################
+# START A DUPLICATE PATIENT SEARCH
+######################################################################
+@app.route("/pats/$dedup", methods=["POST"])
+def start_dedup():
+    """
+    Start a search for duplicate patients
+
+    The search runs in the background; follow the Location header to see
+    its progress and then its match candidates. Only one search runs at a
+    time, another one is refused with 409_CONFLICT
+    """
+    app.logger.info("Request to find duplicate patients")
+    job = dedup.start_job(app)
+    location_url = url_for("get_dedup", job_id=job.id, _external=True)
+    return make_response(jsonify(job.serialize()), status.HTTP_202_ACCEPTED, {"Location": location_url})
+
+
+######################################################################
+# RETRIEVE THE PROGRESS OF A DUPLICATE PATIENT SEARCH
+######################################################################
+@app.route("/pats/$dedup/<int:job_id>", methods=["GET"])
+def get_dedup(job_id):
+    """ Returns the status and progress of a duplicate patient search """
+    app.logger.info("Request for duplicate search %s", job_id)
+    job = DedupJob.query.get_or_404(job_id)
+    return make_response(jsonify(job.serialize()), status.HTTP_200_OK)
+
+
+######################################################################
+# LIST THE MATCH CANDIDATES OF A DUPLICATE PATIENT SEARCH
+######################################################################
+@app.route("/pats/$dedup/<int:job_id>/candidates", methods=["GET"])
+def list_dedup_candidates(job_id):
+    """
+    Returns the probable duplicate patients found by a search, best match first
+
+    Takes _offset and _count to page through them and min_score to only
+    get the closest matches
+    """
+    app.logger.info("Request for the candidates of duplicate search %s", job_id)
+    job = DedupJob.query.get_or_404(job_id)
+    offset, count = page_params(request.args)
+    candidates = job.candidates
+    if request.args.get("min_score"):
+        try:
+            candidates = candidates.filter(MatchCandidate.score >= float(request.args.get("min_score")))
+        except ValueError:
+            raise DataValidationError("Invalid min_score: " + request.args.get("min_score"))
+    candidates = candidates.order_by(MatchCandidate.score.desc(), MatchCandidate.id).offset(offset).limit(count)
+    return make_response(jsonify([candidate.serialize() for candidate in candidates]), status.HTTP_200_OK)
+
+#---------------------------------------------------------------------
+# SUBSCRIPTION METHODS
+#---------------------------------------------------------------------
+
+######################################################################
+# ADD A NEW SUBSCRIPTION
+######################################################################
+@app.route("/subscriptions", methods=["POST"])
+def create_subscription():
+    """
+    Creates a Subscription to the changes of the Pats matching its criteria
+
+    The body holds the criteria as a search, i.e.
+    {"criteria": "Patient?postalCode=90210&active=true", "channel": {"type": "sse"}}
+    """
+    app.logger.info("Request to create a subscription")
+    check_content_type(*body_types())
+    subscription = Subscription().deserialize(request_data())
+    subscriptions.parse_criteria(subscription.criteria)
+    subscription.create()
+    message = subscription.serialize()
+    location_url = url_for("get_subscription", subscription_id=subscription.id, _external=True)
+    return make_response(jsonify(message), status.HTTP_201_CREATED, {"Location": location_url})
+
+
+######################################################################
+# RETRIEVE A SUBSCRIPTION
+######################################################################
+@app.route("/subscriptions/<int:subscription_id>", methods=["GET"])
+def get_subscription(subscription_id):
+    """ Retrieve a single Subscription """
+    app.logger.info("Request for subscription with id: %s", subscription_id)
+    subscription = Subscription.query.get_or_404(subscription_id)
+    return make_response(jsonify(subscription.serialize()), status.HTTP_200_OK)
+
+
+######################################################################
+# STREAM THE CHANGES OF A SUBSCRIPTION
+######################################################################
+@app.route("/subscriptions/<int:subscription_id>/$events", methods=["GET"])
+def stream_subscription(subscription_id):
+    """
+    Streams the changes of the Pats matching a Subscription as Server-Sent Events
+
+    Each event is named after the change (create, update or delete) and its
+    data holds the id, version and, unless deleted, the patient itself
+    """
+    app.logger.info("Request for the events of subscription with id: %s", subscription_id)
+    subscription = Subscription.query.get_or_404(subscription_id)
+    stream = subscriptions.dispatcher.subscribe(app, subscription)
+    #the stream can stay open for hours, it must not hold a connection
+    db.session.remove()
+    response = app.response_class(
+        subscriptions.event_stream(stream, app.config.get("SUBSCRIPTION_HEARTBEAT_SECONDS", 15)),
+        status.HTTP_200_OK, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+######################################################################
+# DELETE A SUBSCRIPTION
+######################################################################
+@app.route("/subscriptions/<int:subscription_id>", methods=["DELETE"])
+def delete_subscription(subscription_id):
+    """
+    Delete a Subscription
+
+    Its open event streams end within SUBSCRIPTION_HEARTBEAT_SECONDS
+    """
+    app.logger.info("Request to delete the subscription with id: %s", subscription_id)
+    subscription = Subscription.query.get(subscription_id)
+    if subscription:
+        subscription.delete()
+    return make_response("", status.HTTP_204_NO_CONTENT)
+
+#---------------------------------------------------------------------
+# ADMIN METHODS
+#---------------------------------------------------------------------
+
+# Header holding the token of the admin routes
+ADMIN_HEADER = "X-Admin-Token"
+
+######################################################################
+# CHECK THE ADMIN TOKEN
+######################################################################
+@app.before_request
+def check_admin_token():
+    """
+    Lets only the requests holding ADMIN_TOKEN use the /admin routes
+
+    Registered before the hooks of the other modules, so that a refused
+    request costs nothing more; with no token configured the routes are off
+    """
+    if request.url_rule is None or not request.url_rule.rule.startswith("/admin/"):
+        return
+    token = app.config.get("ADMIN_TOKEN")
+    if not token:
+        abort(status.HTTP_403_FORBIDDEN, "The admin routes are off, set ADMIN_TOKEN to use them")
+    given = request.headers.get(ADMIN_HEADER)
+    if not given:
+        abort(status.HTTP_401_UNAUTHORIZED, "The {} header is missing".format(ADMIN_HEADER))
+    if not hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+        abort(status.HTTP_403_FORBIDDEN, "Invalid {}".format(ADMIN_HEADER))
+
+######################################################################
+# SHOW THE COALESCED READS
+######################################################################
+@app.route("/admin/coalescing", methods=["GET"])
+def get_coalescing():
+    """
+    Returns the identical reads of this process waiting on one another
+
+    The keys in flight with their waiting requests, the waiters per key of
+    the last reads and the totals since the process started
+    """
+    return make_response(jsonify(coalescing.metrics()), status.HTTP_200_OK)
+
+######################################################################
+# SHOW THE ADMISSION LIMITS
+######################################################################
+@app.route("/admin/admission", methods=["GET"])
+def get_admission():
+    """
+    Returns the concurrency limit of each class of routes in this process
+
+    With the requests running and waiting, those admitted and shed, and the
+    average and lowest latency the limit adapts to
+    """
+    return make_response(jsonify(admission.metrics(app)), status.HTTP_200_OK)
+
+######################################################################
+# LIST THE REQUEST PROFILES
+######################################################################
+@app.route("/admin/profiles", methods=["GET"])
+def list_profiles():
+    """
+    Returns the CPU profiles written by this host, newest first
+
+    A route parameter, i.e. route=list_pats, only returns the profiles of
+    that endpoint
+    """
+    return make_response(jsonify(profiling.list_profiles(app, request.args.get("route"))), status.HTTP_200_OK)
+
+
+######################################################################
+# DOWNLOAD A REQUEST PROFILE
+######################################################################
+@app.route("/admin/profiles/<name>", methods=["GET"])
+def get_profile(name):
+    """
+    Returns a CPU profile file
+
+    A .collapsed file is text for flame graph tools, a .pstats file is
+    binary data for the pstats module
+    """
+    path = os.path.join(profiling.profile_dir(app), name)
+    if not profiling.profileName.match(name) or not os.path.exists(path):
+        raise NotFound("Profile '{}' was not found.".format(name))
+    return send_file(path, mimetype="text/plain" if name.endswith(".collapsed") else "application/octet-stream",
+                     as_attachment=True, attachment_filename=name)
+
+######################################################################
+# START TRACING THE MEMORY ALLOCATIONS
+######################################################################
+@app.route("/admin/tracemalloc", methods=["POST"])
+def start_tracemalloc():
+    """
+    Starts tracing the memory allocations of this worker
+
+    The optional JSON body sets the share of the requests sampled and the
+    frames of the allocation tracebacks, i.e. {"sampleRate": 0.1, "frames": 10};
+    the allocations added up so far are forgotten
+    """
+    options = request.get_json(silent=True) or {}
+    try:
+        sample_rate = float(options.get("sampleRate", app.config.get("TRACEMALLOC_SAMPLE_RATE", 0.1)))
+        frames = int(options.get("frames", app.config.get("TRACEMALLOC_FRAMES", 10)))
+    except (TypeError, ValueError):
+        raise DataValidationError("Invalid tracemalloc options: sampleRate and frames must be numbers")
+    allocations.tracer.start(sample_rate, frames)
+    return make_response(jsonify(allocations.tracer.report(0)), status.HTTP_200_OK)
+
+
+######################################################################
+# SHOW THE MEMORY ALLOCATIONS PER ROUTE
+######################################################################
+@app.route("/admin/tracemalloc", methods=["GET"])
+def get_tracemalloc():
+    """
+    Returns the allocation sites that grew the most per route template
+
+    A route parameter, i.e. route=GET /pats, only returns that route and a
+    top parameter sets the number of sites (TRACEMALLOC_TOP by default)
+    """
+    top = request.args.get("top", str(app.config.get("TRACEMALLOC_TOP", 20)))
+    if not top.isdigit():
+        raise DataValidationError("Invalid top: " + top)
+    return make_response(jsonify(allocations.tracer.report(int(top), request.args.get("route"))),
+                         status.HTTP_200_OK)
+
+
+######################################################################
+# STOP TRACING THE MEMORY ALLOCATIONS
+######################################################################
+@app.route("/admin/tracemalloc", methods=["DELETE"])
+def stop_tracemalloc():
+    """ Stops tracing the memory allocations of this worker and forgets them """
+    allocations.tracer.stop()
     return make_response("", status.HTTP_204_NO_CONTENT)
 
+
+######################################################################
+# LIST THE TRACED REQUESTS
+######################################################################
+@app.route("/admin/traces", methods=["GET"])
+def list_traces():
+    """
+    Returns the last requests traced by this process, newest first
+
+    The trace and span ids, the route, the status and the duration of each
+    request; a route parameter, i.e. route=GET /pats, only returns that route
+    """
+    exporter = tracing.exporters(app).get("memory")
+    traces = [tracing.summary(trace) for trace in exporter.list()] if exporter else []
+    route = request.args.get("route")
+    if route is not None:
+        traces = [trace for trace in traces if trace["name"] == route]
+    return make_response(jsonify(traces), status.HTTP_200_OK)
+
+
+######################################################################
+# SHOW A TRACED REQUEST
+######################################################################
+@app.route("/admin/traces/<trace_id>", methods=["GET"])
+def get_trace(trace_id):
+    """
+    Returns the spans of a traced request as a waterfall
+
+    Every span with its depth in the tree, its offset from the start of
+    the request and its duration in milliseconds, in start order; the
+    requests of one trace, i.e. retries, are all returned
+    """
+    exporter = tracing.exporters(app).get("memory")
+    traces = [tracing.waterfall(trace) for trace in (exporter.list() if exporter else [])
+              if trace["traceId"] == trace_id]
+    if not traces:
+        raise NotFound("Trace '{}' was not found.".format(trace_id))
+    return make_response(jsonify(traces), status.HTTP_200_OK)
+
 #---------------------------------------------------------------------
 # ADDRESS METHODS
 #---------------------------------------------------------------------
@@ -287,6 +838,7 @@ def delete_pats(pat_id):
 # LIST ADDRESSES
 ######################################################################
 @app.route("/pats/<int:pat_id>/address", methods=["GET"])
+@coalesced
 def list_address(pat_id):
     """ Returns all of the Addresses for a patient """
     app.logger.info("Request for Patient's Addresses...")
@@ -298,25 +850,28 @@ def list_address(pat_id):
 # ADD AN ADDRESS TO A PATIENT
 ######################################################################
 @app.route('/pats/<int:pat_id>/address', methods=['POST'])
+@idempotent
 def create_address(pat_id):
     """
     Create an Address on a patient
     This endpoint will add an address to a patient
     """
     app.logger.info("Request to add an address to a patient")
-    check_content_type("application/json")
+    check_content_type(*body_types())
     pat = Pprofile.find_or_404(pat_id)
+    check_if_match(pat.version_id)
     addr = Paddress()
-    addr.deserialize(request.get_json())
+    addr.deserialize(request_data())
     pat.address.append(addr)
     pat.save()
     message = addr.serialize()
-    return make_response(jsonify(message), status.HTTP_201_CREATED)
+    return make_response(jsonify(message), status.HTTP_201_CREATED, {"ETag": etag_for(addr.version_id)})
 
 ######################################################################
 # RETRIEVE AN ADDRESS FROM PATIENT
 ######################################################################
 @app.route('/pats/<int:pat_id>/address/<int:address_id>', methods=['GET'])
+@coalesced
 def get_address(pat_id, address_id):
     """
     Get an Address
@@ -327,7 +882,8 @@ def get_address(pat_id, address_id):
     pat = Pprofile.find_or_404(pat_id)
     #look for the address of the patient found
     addr = Paddress.find_or_404(address_id)
-    return make_response(jsonify(addr.serialize()), status.HTTP_200_OK)
+    resource = dump_resource(addr.serialize())
+    return resource_response(resource, status.HTTP_200_OK, {"ETag": etag_for(addr.version_id)})
 
 ######################################################################
 # UPDATE AN ADDRESS
@@ -339,15 +895,36 @@ def update_address(pat_id, address_id):
     This endpoint will update an Address based the body that is posted
     """
     app.logger.info("Request to update address with id: %s", address_id)
-    check_content_type("application/json")
+    check_content_type(*body_types())
     #look for a patient
     pat = Pprofile.find_or_404(pat_id)
     #look for the address to be updated
     addr = Paddress.find_or_404(address_id)
-    addr.deserialize(request.get_json())
+    check_if_match(addr.version_id)
+    addr.deserialize(request_data())
     addr.id = address_id
     addr.save()
-    return make_response(jsonify(addr.serialize()), status.HTTP_200_OK)
+    return make_response(jsonify(addr.serialize()), status.HTTP_200_OK, {"ETag": etag_for(addr.version_id)})
+
+######################################################################
+# PATCH AN ADDRESS
+######################################################################
+@app.route("/pats/<int:pat_id>/address/<int:address_id>", methods=["PATCH"])
+def patch_address(pat_id, address_id):
+    """
+    Patch an Address
+    This endpoint will apply the JSON Patch in the body to an Address
+    """
+    app.logger.info("Request to patch address with id: %s", address_id)
+    check_content_type("application/json-patch+json")
+    addr = Paddress.find(address_id)
+    if not addr or addr.pprofile_id != pat_id:
+        raise NotFound("Address with id '{}' was not found.".format(address_id))
+    check_if_match(addr.version_id)
+    addr.patch(request.get_json())
+    addr.save()
+    resource = dump_resource(addr.serialize())
+    return resource_response(resource, status.HTTP_200_OK, {"ETag": etag_for(addr.version_id)})
 
 ######################################################################
 # DELETE AN ADDRESS
@@ -364,6 +941,7 @@ def delete_address(pat_id, address_id):
     #look for the address to be updated
     addr = Paddress.find(address_id)
     if addr:
+        check_if_match(addr.version_id)
         addr.delete()
     return make_response("", status.HTTP_204_NO_CONTENT)
 
@@ -377,6 +955,7 @@ def delete_address(pat_id, address_id):
 # LIST NAMES
 ######################################################################
 @app.route("/pats/<int:pat_id>/name", methods=["GET"])
+@coalesced
 def list_name(pat_id):
     """ Returns all of the Names for a patient """
     app.logger.info("Request for Patient's Names...")
@@ -388,25 +967,28 @@ def list_name(pat_id):
 # ADD A NAME TO A PATIENT
 ######################################################################
 @app.route('/pats/<int:pat_id>/name', methods=['POST'])
+@idempotent
 def create_name(pat_id):
     """
     Create a name on a patient
     This endpoint will add a name to a patient
     """
     app.logger.info("Request to add a name to a patient")
-    check_content_type("application/json")
+    check_content_type(*body_types())
     pat = Pprofile.find_or_404(pat_id)
+    check_if_match(pat.version_id)
     name_new = Pname()
-    name_new.deserialize(request.get_json())
+    name_new.deserialize(request_data())
     pat.name.append(name_new)
     pat.save()
     message = name_new.serialize()
-    return make_response(jsonify(message), status.HTTP_201_CREATED)
+    return make_response(jsonify(message), status.HTTP_201_CREATED, {"ETag": etag_for(name_new.version_id)})
 
 ######################################################################
 # RETRIEVE A NAME FROM PATIENT
 ######################################################################
 @app.route('/pats/<int:pat_id>/name/<int:name_id>', methods=['GET'])
+@coalesced
 def get_name(pat_id, name_id):
     """
     Get a name
@@ -417,7 +999,8 @@ def get_name(pat_id, name_id):
     pat = Pprofile.find_or_404(pat_id)
     #look for the name of the patient found
     name = Pname.find_or_404(name_id)
-    return make_response(jsonify(name.serialize()), status.HTTP_200_OK)
+    resource = dump_resource(name.serialize())
+    return resource_response(resource, status.HTTP_200_OK, {"ETag": etag_for(name.version_id)})
 
 ######################################################################
 # UPDATE A NAME
@@ -429,15 +1012,36 @@ def update_name(pat_id, name_id):
     This endpoint will update a name based the body that is posted
     """
     app.logger.info("Request to update name with id: %s", name_id)
-    check_content_type("application/json")
+    check_content_type(*body_types())
     #look for a patient
     pat = Pprofile.find_or_404(pat_id)
     #look for the name to be updated
     name = Pname.find_or_404(name_id)
-    name.deserialize(request.get_json())
+    check_if_match(name.version_id)
+    name.deserialize(request_data())
     name.id = name_id
     name.save()
-    return make_response(jsonify(name.serialize()), status.HTTP_200_OK)
+    return make_response(jsonify(name.serialize()), status.HTTP_200_OK, {"ETag": etag_for(name.version_id)})
+
+######################################################################
+# PATCH A NAME
+######################################################################
+@app.route("/pats/<int:pat_id>/name/<int:name_id>", methods=["PATCH"])
+def patch_name(pat_id, name_id):
+    """
+    Patch a name
+    This endpoint will apply the JSON Patch in the body to a name
+    """
+    app.logger.info("Request to patch name with id: %s", name_id)
+    check_content_type("application/json-patch+json")
+    name = Pname.find(name_id)
+    if not name or name.pprofile_id != pat_id:
+        raise NotFound("Name with id '{}' was not found.".format(name_id))
+    check_if_match(name.version_id)
+    name.patch(request.get_json())
+    name.save()
+    resource = dump_resource(name.serialize())
+    return resource_response(resource, status.HTTP_200_OK, {"ETag": etag_for(name.version_id)})
 
 ######################################################################
 # UPDATE THE LATEST NAME OF THE PATIENT 
@@ -449,17 +1053,18 @@ def update_latest_name(pat_id):
     This endpoint will update a name based the body that is posted
     """
     app.logger.info("Request to update latest name of patient with id: %s", pat_id)
-    check_content_type("application/json")
+    check_content_type(*body_types())
     #look for a patient
     pat = Pprofile.find_or_404(pat_id)
     #look for the latest name to be updated
     latest_name = Pname()
     latest_name = pat.name[len(pat.name)-1]
-    latest_name.deserialize(request.get_json())
+    check_if_match(latest_name.version_id)
+    latest_name.deserialize(request_data())
     latest_name.save()
     #db.session.commit()
 
-    return make_response(jsonify(latest_name.serialize()), status.HTTP_200_OK)
+    return make_response(jsonify(latest_name.serialize()), status.HTTP_200_OK, {"ETag": etag_for(latest_name.version_id)})
 
 ######################################################################
 # DELETE A NAME
@@ -476,6 +1081,7 @@ def delete_name(pat_id, name_id):
     #look for the name to be updated
     name = Pname.find(name_id)
     if name:
+        check_if_match(name.version_id)
         name.delete()
     return make_response("", status.HTTP_204_NO_CONTENT)
 
@@ -492,13 +1098,155 @@ def init_db():
     Pprofile.init_db(app)
 
 
-def check_content_type(content_type):
-    """ Checks that the media type is correct """
-    if request.headers["Content-Type"] == content_type:
+@app.cli.command("bootstrap-db")
+def bootstrap_db():
+    """ Creates the tables, or adds the missing columns and indexes """
+    Pprofile.bootstrap_db(app)
+    app.logger.info("Database schema is up to date")
+    print("Database schema is up to date")
+
+
+@app.cli.command("rebuild-resources")
+def rebuild_resources():
+    """ Re-renders the stored JSON of every patient """
+    count = Pprofile.rebuild_resources()
+    app.logger.info("Rebuilt the stored JSON of %d patients", count)
+    print("Rebuilt the stored JSON of {} patients".format(count))
+
+
+@app.cli.command("find-duplicates")
+def find_duplicates():
+    """ Searches for duplicate patients and waits for the result """
+    job = dedup.start_job(app, background=False)
+    print("Duplicate search {} {}: {} candidates among {} patients".format(
+        job.id, job.status, job.candidate_count, job.patients))
+
+
+@app.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys():
+    """ Deletes the expired idempotency keys """
+    count = IdempotencyKey.purge(app.config.get("IDEMPOTENCY_KEY_TTL", 86400))
+    app.logger.info("Purged %d idempotency keys", count)
+    print("Purged {} idempotency keys".format(count))
+
+
+def search_bundle(args):
+    """
+    Runs a search and wraps the results in a FHIR searchset Bundle
+
+    The Bundle is returned as JSON text so that the stored patient JSON
+    can be placed in it as is
+    """
+    pat_ids = parse_id_list(args)
+    rows = list(Pprofile.search_json(args, pat_ids))
+    entries = [
+        '{"fullUrl":%s,"resource":%s,"search":{"mode":"match"}}' % (
+            json.dumps(url_for("get_pats", pat_id=pat_id, _external=True)), resource)
+        for pat_id, resource in rows
+    ]
+
+    #report the requested ids that were not found
+    found = set(pat_id for pat_id, _ in rows)
+    missing = [pat_id for pat_id in pat_ids or [] if pat_id not in found]
+    if missing:
+        entries.append(json.dumps({
+            "resource": {
+                "resourceType": "OperationOutcome",
+                "issue": [
+                    {
+                        "severity": "warning",
+                        "code": "not-found",
+                        "diagnostics": "Patient with id '{}' was not found.".format(pat_id),
+                    }
+                    for pat_id in missing
+                ],
+            },
+            "search": {"mode": "outcome"},
+        }))
+
+    return '{"resourceType":"Bundle","type":"searchset","total":%d,"entry":[%s]}' % (
+        len(rows), ",".join(entries))
+
+
+def history_count(args):
+    """ Returns the number of history entries of a page, HISTORY_PAGE_SIZE unless _count is given """
+    count = page_params(args)[1]
+    return count if count else app.config.get("HISTORY_PAGE_SIZE", 100)
+
+
+def history_bundle(versions, cursor, **view_args):
+    """
+    Wraps patient versions in a FHIR history Bundle, as JSON text
+
+    The next link repeats the request from the cursor after the last entry
+
+    Args:
+        versions (list): (pat_id, version_id, method, lastUpdated, resource) tuples
+        cursor (str): the cursor after the last version
+        view_args: the path parameters of the request
+    """
+    methods = {"create": ("POST", "201 Created"), "update": ("PUT", "200 OK"), "delete": ("DELETE", "204 No Content")}
+    entries = []
+    for pat_id, version_id, method, last_updated, resource in versions:
+        full_url = url_for("get_pats", pat_id=pat_id, _external=True)
+        entry = json.dumps({
+            "fullUrl": full_url,
+            "request": {"method": methods[method][0], "url": full_url if method != "create" else
+                        url_for("create_pats", _external=True)},
+            "response": {"status": methods[method][1], "etag": etag_for(version_id),
+                         "lastModified": last_updated.isoformat() + "Z"},
+        })
+        #the stored patient JSON is placed in the entry as is
+        entries.append(entry[:-1] + ',"resource":' + resource + "}" if resource is not None else entry)
+
+    args = request.args.to_dict()
+    args["_cursor"] = cursor
+    next_url = url_for(request.endpoint, _external=True, **dict(view_args, **args))
+    return '{"resourceType":"Bundle","type":"history","link":[%s],"entry":[%s]}' % (
+        json.dumps({"relation": "next", "url": next_url}), ",".join(entries))
+
+
+def etag_for(version_id):
+    """ Returns the entity tag of a resource version """
+    return 'W/"{}"'.format(version_id)
+
+
+def if_match_versions():
+    """ Returns the versions named by the If-Match header, or None when it is not sent or "*"
+
+    The header is a list of entity tags, i.e. 'W/"1", W/"2"', compared
+    weakly as the ETags of the service are weak
+    """
+    if request.headers.get("If-Match") is None or request.if_match.star_tag:
+        return None
+    versions = request.if_match.as_set(include_weak=True)
+    if not versions or not all(version and version.isdigit() for version in versions):
+        raise DataValidationError("Invalid If-Match version: " + request.headers["If-Match"])
+    return sorted(int(version) for version in versions)
+
+
+def check_if_match(version_id):
+    """
+    Checks that the If-Match header, when sent, names the current version in any of its entity tags
+
+    A writer that changes the row after this check still loses, because the
+    UPDATE itself is conditional on the version (see request_stale_error)
+    """
+    expected = if_match_versions()
+    if expected is None or version_id in expected:
+        return
+    app.logger.error("Stale If-Match: %s", request.headers.get("If-Match"))
+    #HTTP 412 Precondition Failed
+    abort(412, "The resource has changed since version {}".format(expected[-1]))
+
+
+def check_content_type(*content_types):
+    """ Checks that the media type is one of the correct ones """
+    if request.headers["Content-Type"] in content_types:
         return
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     #HTTP 415 Unsupported Media Type
-    abort(415, "Content-Type must be {}".format(content_type))
+    abort(415, "Content-Type must be {}".format(" or ".join(content_types)))
 
 
 '''
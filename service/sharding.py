@@ -0,0 +1,200 @@
+# Horizontal Sharding of Patients
+
+"""
+Sharded storage of patients across several databases
+
+When SQLALCHEMY_SHARD_URIS lists databases, each patient gets a globally
+unique 63 bit id when it is created, and the shard holding the patient,
+its names and its addresses is chosen from a jump consistent hash of that
+id. Requests about one patient (any route with a pat_id) only touch its
+shard; searches run on every shard in parallel and their results are
+merged in id order.
+
+Configuration
+-------------
+SQLALCHEMY_SHARD_URIS - list of shard database URIs, empty when not sharded
+SHARD_NODE_ID - 0-1023, keeps the ids of concurrent processes apart (random if unset)
+"""
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, request, current_app
+from flask_sqlalchemy import get_state
+from service import tracing
+
+logger = logging.getLogger("gunicorn.error")
+
+# Ids count milliseconds from 2020-01-01 in their top 41 bits
+ID_EPOCH_MS = 1577836800000
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+_id_lock = threading.Lock()
+_id_state = {"ms": 0, "sequence": 0, "node": None}
+_executor = {"pool": None}
+
+
+######################################################################
+#  S H A R D   P L A C E M E N T
+######################################################################
+
+def jump_hash(key, buckets):
+    """
+    Maps a 64 bit key to one of the buckets with a jump consistent hash
+
+    The result only depends on the key and the number of buckets, and
+    adding a bucket only moves 1/buckets of the keys (Lamping & Veach)
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def shard_binds(app=None):
+    """ Returns the bind keys of the shards, empty when not sharded """
+    app = app or current_app
+    return app.extensions.get("shard_binds") or []
+
+
+def is_sharded(app=None):
+    """ Returns True when patients are spread across shards """
+    return bool(shard_binds(app))
+
+
+def shard_for(pat_id, app=None):
+    """ Returns the bind key of the shard holding a patient """
+    binds = shard_binds(app)
+    return binds[jump_hash(int(pat_id), len(binds))]
+
+
+def needs_scatter():
+    """ Returns True when a query must run on every shard """
+    return is_sharded() and g.get("shard_bind") is None
+
+
+def use_shard(pat_id):
+    """ Sends the statements of this context to the shard of a patient """
+    if is_sharded():
+        g.shard_bind = shard_for(pat_id)
+
+
+def new_patient_id():
+    """
+    Returns a new globally unique patient id, or None when not sharded
+
+    Ids are built like Twitter snowflakes: milliseconds since ID_EPOCH_MS,
+    then the node id of the process, then a per millisecond sequence
+    """
+    if not is_sharded():
+        return None
+    with _id_lock:
+        if _id_state["node"] is None:
+            node = current_app.config.get("SHARD_NODE_ID")
+            _id_state["node"] = (int(node) if node is not None else random.getrandbits(NODE_BITS)) \
+                % (1 << NODE_BITS)
+        now = int(time.time() * 1000)
+        if now <= _id_state["ms"]:
+            now = _id_state["ms"]
+            _id_state["sequence"] = (_id_state["sequence"] + 1) % (1 << SEQUENCE_BITS)
+            if _id_state["sequence"] == 0:
+                #the sequence of this millisecond is used up, borrow the next one
+                now += 1
+        else:
+            _id_state["sequence"] = 0
+        _id_state["ms"] = now
+        return ((now - ID_EPOCH_MS) << (NODE_BITS + SEQUENCE_BITS)) \
+            | (_id_state["node"] << SEQUENCE_BITS) | _id_state["sequence"]
+
+
+def assign_patient_id():
+    """ Returns the id for a new patient and sends its writes to its shard """
+    pat_id = new_patient_id()
+    if pat_id is not None:
+        use_shard(pat_id)
+    return pat_id
+
+
+######################################################################
+#  S C A T T E R   /   G A T H E R
+######################################################################
+
+def scatter(func, binds=None):
+    """
+    Runs func() once per shard in parallel and returns the list of results
+
+    Each call runs in its own thread with its own app context and session
+    bound to one shard, so func must not use the request; the deadline of
+    the request (see deadlines) still limits its statements, and its spans
+    are added to the trace of the request (see tracing)
+
+    Args:
+        func (callable): the work to do on a shard, called without arguments
+        binds (list): the shards to run on, all of them by default
+    """
+    app = current_app._get_current_object()
+    binds = shard_binds(app) if binds is None else binds
+    deadline = g.get("request_deadline")
+    trace = tracing.current_trace()
+
+    def run(bind_key):
+        with app.app_context():
+            g.shard_bind = bind_key
+            if deadline is not None:
+                g.request_deadline = deadline
+            if trace is not None:
+                g.trace = trace.branch()
+            try:
+                with tracing.span("scatter " + bind_key):
+                    return func()
+            finally:
+                get_state(app).db.session.remove()
+
+    if _executor["pool"] is None:
+        with _id_lock:
+            if _executor["pool"] is None:
+                _executor["pool"] = ThreadPoolExecutor(
+                    max_workers=app.config.get("SHARD_SCATTER_THREADS") or 4 * max(len(binds), 1))
+    return list(_executor["pool"].map(run, binds))
+
+
+######################################################################
+#  S E T U P
+######################################################################
+
+def configure_shards(app):
+    """ Registers the shard URIs as SQLAlchemy binds and returns their keys """
+    binds = dict((key, uri) for key, uri in (app.config.get("SQLALCHEMY_BINDS") or {}).items()
+                 if not key.startswith("shard_"))
+    keys = []
+    for index, uri in enumerate(app.config.get("SQLALCHEMY_SHARD_URIS") or []):
+        key = "shard_{}".format(index)
+        binds[key] = uri
+        keys.append(key)
+    app.config["SQLALCHEMY_BINDS"] = binds
+    app.extensions["shard_binds"] = keys
+    return keys
+
+
+def route_patient():
+    """ Sends the statements of a request about one patient to its shard """
+    g.shard_bind = None
+    if request.view_args and "pat_id" in request.view_args:
+        use_shard(request.view_args["pat_id"])
+
+
+def forget_shard(exception=None):
+    """ Stops routing to a shard once the request is over """
+    g.pop("shard_bind", None)
+
+
+def init_app(app):
+    """ Sets up the shard binds and the request hooks that route to them """
+    configure_shards(app)
+    app.before_request(route_patient)
+    app.teardown_request(forget_shard)
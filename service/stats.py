@@ -0,0 +1,174 @@
+# Population Statistics
+
+"""
+Patient counts grouped by dimensions, computed in SQL and cached
+
+GET /pats/$stats?groupBy=gender,ageBand counts the patients matching the
+search parameters (the same ones as GET /pats) per combination of the
+dimensions:
+  gender     - Pprofile.gender
+  active     - Pprofile.active
+  ageBand    - the age band of Pprofile.DOB today, i.e. "18-34"
+  state      - Paddress.state
+  postalCode - Paddress.postalCode
+A patient with several addresses is counted once in each of their states
+or postal codes, and once in the total.
+
+The counts are grouped by the database, on every shard when sharded, and
+kept in a cache of this process until the next write: an entry is only
+reused while the newest change history entry is still the same one, and
+for at most STATS_CACHE_SECONDS in case a commit was overtaken by a later
+one.
+
+Configuration
+-------------
+STATS_AGE_BANDS - the ages starting a band, i.e. [18, 35, 50, 65]
+STATS_CACHE_SIZE - the number of results kept
+STATS_CACHE_SECONDS - the longest a result is kept
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from sqlalchemy import case, distinct, literal
+from service import sharding
+from service.models import db, Pprofile, Paddress, PatientHistory, DataValidationError
+
+logger = logging.getLogger("gunicorn.error")
+
+DIMENSIONS = ("gender", "active", "ageBand", "state", "postalCode")
+ADDRESS_DIMENSIONS = ("state", "postalCode")
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+
+
+def parse_dimensions(args, dimensions=DIMENSIONS):
+    """ Returns the dimensions of the groupBy parameter, which is comma separated and may repeat
+
+    Args:
+        args (dict): the request parameters
+        dimensions (tuple): the dimensions that may be grouped by
+    """
+    values = args.getlist("groupBy") if hasattr(args, "getlist") else [args.get("groupBy") or ""]
+    grouped = []
+    for value in values:
+        for item in value.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            if item not in dimensions:
+                raise DataValidationError("Invalid groupBy dimension: " + item)
+            if item not in grouped:
+                grouped.append(item)
+    return grouped
+
+
+def age_bands(bands):
+    """ Returns the labels of the age bands starting at the given ages, i.e. ["0-17", "18-34", "35+"] """
+    starts = [0] + sorted(bands)
+    return ["{}-{}".format(start, end - 1) for start, end in zip(starts, starts[1:])] + ["{}+".format(starts[-1])]
+
+
+def born_before(today, age):
+    """ Returns the first birth date of the people younger than age today """
+    try:
+        birthday = today.replace(year=today.year - age)
+    except ValueError:  # February 29
+        birthday = today.replace(year=today.year - age, day=28)
+    return datetime.combine(birthday + timedelta(days=1), datetime.min.time())
+
+
+def aggregate(args, dimensions, today, bands):
+    """
+    Returns (total, {group values: count}) for the patients of the current database
+
+    Args:
+        args (dict): search parameters, see Pprofile.search_clauses()
+        dimensions (list): the dimensions to group by
+        today (date): the day the ages are computed on
+        bands (list): the ages starting an age band
+    """
+    clauses = Pprofile.search_clauses(args)
+    total = db.session.query(Pprofile.id).filter(*clauses).count()
+    if not dimensions:
+        return total, {}
+
+    labels = age_bands(bands)
+    columns = {
+        "gender": Pprofile.gender,
+        "active": Pprofile.active,
+        #the youngest band is tested first
+        "ageBand": case([(Pprofile.DOB >= born_before(today, age), label)
+                         for age, label in zip(sorted(bands), labels)],
+                        else_=labels[-1]) if bands else literal(labels[0]),
+        "state": Paddress.state,
+        "postalCode": Paddress.postalCode,
+    }
+    #the grouped expressions are computed in a sub-select and grouped by name
+    inner = db.session.query(Pprofile.id.label("pat_id"),
+                             *[columns[name].label(name) for name in dimensions])
+    if any(name in ADDRESS_DIMENSIONS for name in dimensions):
+        inner = inner.outerjoin(Paddress, Paddress.pprofile_id == Pprofile.id)
+    inner = inner.filter(*clauses).subquery()
+    grouped = [inner.c[name] for name in dimensions]
+    rows = db.session.query(*(grouped + [db.func.count(distinct(inner.c.pat_id))])).group_by(*grouped)
+    counts = {}
+    for row in rows:
+        key = tuple(value.name if hasattr(value, "name") else value for value in row[:-1])
+        counts[key] = row[-1]
+    return total, counts
+
+
+def compute(args, dimensions, today, bands):
+    """ Aggregates on every shard when sharded and adds the results up """
+    if not sharding.needs_scatter():
+        return aggregate(args, dimensions, today, bands)
+    total, counts = 0, {}
+    for shard_total, shard_counts in sharding.scatter(lambda: aggregate(args, dimensions, today, bands)):
+        total += shard_total
+        for key, count in shard_counts.items():
+            counts[key] = counts.get(key, 0) + count
+    return total, counts
+
+
+def statistics(args, config):
+    """
+    Returns the patient counts per group of the groupBy dimensions
+
+    Args:
+        args (MultiDict): the request parameters, groupBy and the search parameters
+        config (dict): the app configuration
+    """
+    dimensions = parse_dimensions(args)
+    bands = list(config.get("STATS_AGE_BANDS") or [])
+    today = date.today()
+    key = (tuple(sorted((name, tuple(args.getlist(name)) if hasattr(args, "getlist") else args[name])
+                        for name in args if name != "groupBy")), tuple(dimensions), tuple(bands), today)
+    generation = PatientHistory.head()
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] == generation \
+                and time.time() - entry[2] < config.get("STATS_CACHE_SECONDS", 300):
+            _cache.move_to_end(key)
+            return entry[1]
+
+    logger.info("Computing patient statistics by %s", dimensions)
+    computed = time.time()
+    total, counts = compute(args, dimensions, today, bands)
+    groups = [dict(zip(dimensions, values), count=count)
+              for values, count in sorted(counts.items(), key=lambda item: [str(value) for value in item[0]])]
+    result = {"total": total, "groupBy": dimensions, "groups": groups}
+    with _lock:
+        _cache[key] = (generation, result, computed)
+        _cache.move_to_end(key)
+        while len(_cache) > config.get("STATS_CACHE_SIZE", 256):
+            _cache.popitem(last=False)
+    return result
+
+
+def clear_cache():
+    """ Forgets every cached result """
+    with _lock:
+        _cache.clear()
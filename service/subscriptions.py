@@ -0,0 +1,321 @@
+# Change Subscriptions
+
+"""
+FHIR style subscriptions to patient changes, pushed as Server-Sent Events
+
+A client registers search criteria (POST /subscriptions with a criteria
+such as "Patient?postalCode=90210&active=true") and keeps
+GET /subscriptions/{id}/$events open: every change to a patient matching
+the criteria is then sent to it as an event.
+
+The changes are read from the change history (see PatientHistory) by one
+dispatcher thread per process, for all the streams of the process. A
+change is matched once against each distinct criteria, and only against
+the criteria that can match its id, postal codes, family names, email or
+phone, then queued to the streams of every matching criteria. A stream
+only waits on its queue and holds no database connection, so under
+gevent workers (gunicorn -k gevent) an idle stream costs a greenlet
+rather than a worker.
+
+Configuration
+-------------
+SUBSCRIPTION_POLL_SECONDS - how often the dispatcher reads the change history
+SUBSCRIPTION_HEARTBEAT_SECONDS - how often an idle stream sends a comment to stay open
+SUBSCRIPTION_QUEUE_SIZE - events waiting for a slow stream before it is closed
+"""
+import json
+import time
+import queue
+import logging
+import threading
+from werkzeug.urls import url_decode
+from service.models import db, Pprofile, PatientHistory, Subscription, DataValidationError, \
+    parse_id_list, dump_resource
+
+logger = logging.getLogger("gunicorn.error")
+
+# Search parameters a subscription can use, and those a change is looked up by
+SUBSCRIPTION_PARAMS = ("_id", "active", "gender", "family", "given", "postalCode", "phone_home", "email")
+INDEXED_PARAMS = ("_id", "email", "phone_home", "postalCode", "family")
+
+# Change history entries read at a time
+BATCH_SIZE = 500
+
+
+######################################################################
+#  C R I T E R I A
+######################################################################
+
+class Criteria():
+    """ The search parameters of a subscription, matched against patient JSON """
+
+    def __init__(self, params):
+        self.params = params
+        self.key = "&".join("{}={}".format(name, params[name]) for name in sorted(params))
+        self.ids = set(parse_id_list(params)) if "_id" in params else None
+
+    def index_keys(self):
+        """ Returns the (parameter, value) keys a matching patient must have, or None """
+        for name in INDEXED_PARAMS:
+            if name == "_id" and self.ids is not None:
+                return [("_id", pat_id) for pat_id in self.ids]
+            if name in self.params and name != "_id":
+                return [(name, self.params[name])]
+        return None
+
+    def matches(self, resource):
+        """ Returns True when a serialized patient matches the parameters """
+        params = self.params
+        if self.ids is not None and resource["id"] not in self.ids:
+            return False
+        if "active" in params and resource["active"] != (params["active"].lower() == "true"):
+            return False
+        for name in ("gender", "phone_home", "email"):
+            if name in params and resource.get(name) != params[name]:
+                return False
+        #the family and given names must be those of the same name, like the search
+        if "family" in params or "given" in params:
+            if not any(params.get("family", name.get("family")) == name.get("family")
+                       and params.get("given", (name.get("given") or [None])[0]) == (name.get("given") or [None])[0]
+                       for name in resource.get("name") or []):
+                return False
+        if "postalCode" in params and not any(
+                address.get("postalCode") == params["postalCode"] for address in resource.get("address") or []):
+            return False
+        return True
+
+
+def parse_criteria(criteria):
+    """
+    Returns the Criteria of a subscription criteria string
+
+    Args:
+        criteria (str): "Patient" or "Patient?" followed by search parameters
+    """
+    args = url_decode(criteria.partition("?")[2])
+    for name in args:
+        if name not in SUBSCRIPTION_PARAMS:
+            raise DataValidationError("Invalid subscription criteria: unsupported parameter " + name)
+        if len(args.getlist(name)) > 1:
+            raise DataValidationError("Invalid subscription criteria: repeated parameter " + name)
+    #the values are checked the same way as a search
+    Pprofile.search_clauses(args)
+    return Criteria(dict((name, value) for name, value in args.items() if value))
+
+
+def resource_keys(resource):
+    """ Returns the (parameter, value) keys of a serialized patient, see INDEXED_PARAMS """
+    keys = set([("_id", resource["id"]), ("email", resource.get("email")),
+                ("phone_home", resource.get("phone_home"))])
+    keys.update(("postalCode", address.get("postalCode")) for address in resource.get("address") or [])
+    keys.update(("family", name.get("family")) for name in resource.get("name") or [])
+    return keys
+
+
+######################################################################
+#  D I S P A T C H E R
+######################################################################
+
+class Stream():
+    """ The queue of events of one open event stream """
+
+    def __init__(self, subscription_id, criteria):
+        self.subscription_id = subscription_id
+        self.criteria = criteria
+        self.events = queue.Queue()
+        self.closed = False
+
+    def send(self, event, limit):
+        """ Queues an event, closing a stream that has fallen too far behind """
+        if self.closed:
+            return
+        if self.events.qsize() >= limit:
+            logger.warning("Closing the event stream of subscription %s: too slow", self.subscription_id)
+            self.close()
+            return
+        self.events.put(event)
+
+    def close(self):
+        """ Ends the stream once the queued events are sent """
+        self.closed = True
+        self.events.put(None)
+
+
+class Dispatcher():
+    """
+    Reads the changes to the patients and queues them to the matching streams
+
+    Streams with the same criteria share one group, which is matched once
+    per change. Groups are indexed by their most selective parameter so that
+    a change only is matched against the groups it can match.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}        # criteria key -> (criteria, set of streams)
+        self.index = {}         # (parameter, value) -> set of criteria keys
+        self.unindexed = set()  # criteria keys without an indexed parameter
+        self.cursor = None
+        self.thread = None
+        self.evaluations = 0
+
+    def subscribe(self, app, subscription):
+        """ Opens a stream of the changes matching a subscription and returns it """
+        criteria = parse_criteria(subscription.criteria)
+        stream = Stream(subscription.id, criteria)
+        head = None
+        while True:
+            with self.lock:
+                if self.cursor is None and head is not None:
+                    self.cursor = head
+                if self.cursor is not None:
+                    self.join(app, stream)
+                    break
+            #the changes made from now on, read without holding the lock
+            head = PatientHistory.head()
+        logger.info("Subscription %s streaming %r", subscription.id, criteria.key)
+        return stream
+
+    def join(self, app, stream):
+        """ Adds a stream to the group of its criteria and starts polling, with the lock held """
+        criteria = stream.criteria
+        group = self.groups.get(criteria.key)
+        if group is None:
+            group = self.groups[criteria.key] = (criteria, set())
+            keys = criteria.index_keys()
+            if keys is None:
+                self.unindexed.add(criteria.key)
+            for key in keys or []:
+                self.index.setdefault(key, set()).add(criteria.key)
+        group[1].add(stream)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, args=(app,), name="subscriptions", daemon=True)
+            self.thread.start()
+
+    def unsubscribe(self, stream):
+        """ Forgets a stream, and its group when it was the last one """
+        with self.lock:
+            group = self.groups.get(stream.criteria.key)
+            if group is None:
+                return
+            group[1].discard(stream)
+            if group[1]:
+                return
+            del self.groups[stream.criteria.key]
+            self.unindexed.discard(stream.criteria.key)
+            for key in stream.criteria.index_keys() or []:
+                self.index.get(key, set()).discard(stream.criteria.key)
+                if not self.index.get(key):
+                    self.index.pop(key, None)
+            if not self.groups:
+                #with nobody listening there is no need to follow the changes
+                self.cursor = None
+
+    def dispatch(self, versions, queue_size):
+        """ Queues the events of changes to the streams of the criteria they match
+
+        Args:
+            versions (list): (pat_id, version_id, method, lastUpdated, resource) tuples
+            queue_size (int): the most events waiting for one stream
+        """
+        for pat_id, version_id, method, last_updated, resource in versions:
+            if resource is None:
+                #a deleted patient is matched as it was before
+                resource = PatientHistory.find_resource(pat_id, version_id - 1)
+                if resource is None:
+                    continue
+            document = json.loads(resource)
+            with self.lock:
+                keys = set(self.unindexed)
+                for key in resource_keys(document):
+                    keys.update(self.index.get(key, ()))
+                groups = [self.groups[key] for key in keys if key in self.groups]
+            event = None
+            for criteria, streams in groups:
+                self.evaluations += 1
+                if not criteria.matches(document):
+                    continue
+                if event is None:
+                    event = render_event(pat_id, version_id, method, last_updated,
+                                         resource if method != "delete" else None)
+                for stream in list(streams):
+                    stream.send(event, queue_size)
+
+    def poll(self, app):
+        """ Reads the changes since the last poll and dispatches them """
+        while True:
+            with self.lock:
+                cursor = self.cursor
+            if cursor is None:
+                return
+            versions, next_cursor = PatientHistory.feed(None, cursor, BATCH_SIZE)
+            self.dispatch(versions, app.config.get("SUBSCRIPTION_QUEUE_SIZE", 1000))
+            with self.lock:
+                if self.cursor == cursor:
+                    self.cursor = next_cursor
+            if len(versions) < BATCH_SIZE:
+                return
+
+    def close_removed(self):
+        """ Ends the streams of the subscriptions that were deleted """
+        with self.lock:
+            streams = [stream for _, group in self.groups.values() for stream in group]
+        if not streams:
+            return
+        active = set(row[0] for row in db.session.query(Subscription.id).filter(
+            Subscription.id.in_(set(stream.subscription_id for stream in streams))))
+        for stream in streams:
+            if stream.subscription_id not in active:
+                stream.close()
+
+    def run(self, app):
+        """ Polls the change history for as long as the process runs """
+        with app.app_context():
+            polls = 0
+            while True:
+                poll_seconds = app.config.get("SUBSCRIPTION_POLL_SECONDS", 1)
+                time.sleep(poll_seconds)
+                try:
+                    self.poll(app)
+                    polls += 1
+                    if polls * poll_seconds >= app.config.get("SUBSCRIPTION_HEARTBEAT_SECONDS", 15):
+                        polls = 0
+                        self.close_removed()
+                except Exception:  # the dispatcher must outlive a database outage
+                    logger.exception("Cannot dispatch the patient changes")
+                finally:
+                    db.session.remove()
+
+
+def render_event(pat_id, version_id, method, last_updated, resource):
+    """ Renders a change as a Server-Sent Event, placing the stored patient JSON in it as is """
+    data = dump_resource({
+        "id": pat_id,
+        "versionId": version_id,
+        "method": method,
+        "lastUpdated": last_updated.isoformat() + "Z",
+    })
+    if resource is not None:
+        data = data[:-1] + ',"resource":' + resource + "}"
+    return "id: {}/_history/{}\nevent: {}\ndata: {}\n\n".format(pat_id, version_id, method, data)
+
+
+def event_stream(stream, heartbeat_seconds):
+    """ Yields the events of a stream, with a comment when idle, until it is closed """
+    try:
+        yield "retry: 5000\n: subscribed\n\n"
+        while True:
+            try:
+                event = stream.events.get(timeout=heartbeat_seconds)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if event is None:
+                break
+            yield event
+    finally:
+        dispatcher.unsubscribe(stream)
+
+
+# the dispatcher of this process
+dispatcher = Dispatcher()
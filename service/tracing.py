@@ -0,0 +1,375 @@
+# Request Tracing
+
+"""
+Tracing spans of the requests, from the HTTP layer down to SQL
+
+With TRACING on, a sampled request records a tree of spans:
+  GET /pats/<int:pat_id>   - the request, until its response is sent
+    handler get_pats       - the route function
+      Pprofile.serialize   - the model layer (serialize, deserialize)
+      email.validate       - the validation of an email address
+      sql SELECT           - every statement sent to the database
+      scatter shard_0      - the work of sharding.scatter() on one shard
+and its trace is handed to the exporters once the response is sent:
+  memory - the last TRACING_MEMORY_TRACES traces of the process, shown as
+           waterfalls by GET /admin/traces and GET /admin/traces/<id>
+  file   - one JSON line per trace appended to TRACING_FILE
+No collector or agent is needed.
+
+A request joins the trace of its caller when it carries a W3C Trace
+Context traceparent header, and follows the sampling decision made there;
+the others are sampled at TRACING_SAMPLE_RATE. The response names its
+span in a traceresponse header, in the traceparent format.
+
+Configuration
+-------------
+TRACING - trace the requests
+TRACING_SAMPLE_RATE - the share of the requests without a traceparent traced
+TRACING_EXPORTERS - where the traces go, "memory" and/or "file"
+TRACING_MEMORY_TRACES - the traces kept in memory
+TRACING_FILE - the file the traces are appended to
+TRACING_MAX_SPANS - the most spans of one trace, the others are counted as dropped
+"""
+import re
+import json
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, request, current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("gunicorn.error")
+
+TRACEPARENT_HEADER = "traceparent"
+TRACERESPONSE_HEADER = "traceresponse"
+
+# version-trace id-parent id-flags, see https://www.w3.org/TR/trace-context/
+traceParent = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# Endpoints never traced
+EXEMPT_ENDPOINTS = ("static", "stream_subscription", "list_traces", "get_trace")
+
+# Longest SQL statement kept in a span
+MAX_STATEMENT = 1000
+
+
+######################################################################
+#  S P A N S
+######################################################################
+
+def new_id(bits):
+    """ Returns a random non zero id of the given size as hex digits """
+    value = 0
+    while not value:
+        value = random.getrandbits(bits)
+    return "{:0{}x}".format(value, bits // 4)
+
+
+class Span():
+    """ One timed operation of a trace """
+
+    def __init__(self, trace_id, parent_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.status = "ok"
+        self.start = time.time()
+        self.end = None
+
+    def serialize(self):
+        """ Serializes a span into a dictionary """
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": int(self.start * 1e9),
+            "endTimeUnixNano": int((self.end or self.start) * 1e9),
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+class Trace():
+    """ The spans of one request, and the stack of those still open """
+
+    def __init__(self, trace_id, parent_id, max_spans):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.max_spans = max_spans
+        self.spans = []
+        self.stack = []
+        self.dropped = 0
+        self.root = self
+
+    def start(self, name, attributes):
+        """ Opens a span under the innermost open one; returns None past max_spans """
+        if len(self.spans) >= self.max_spans:
+            self.root.dropped += 1
+            return None
+        parent_id = self.stack[-1].span_id if self.stack else self.parent_id
+        opened = Span(self.trace_id, parent_id, name, attributes)
+        self.spans.append(opened)
+        self.stack.append(opened)
+        return opened
+
+    def branch(self):
+        """
+        Returns a trace adding its spans to this one from another thread
+
+        Its spans go under the innermost span open here, i.e. the span of the
+        sharding.scatter() call, but it keeps its own stack of open spans
+        """
+        parent_id = self.stack[-1].span_id if self.stack else self.parent_id
+        branched = Trace(self.trace_id, parent_id, self.max_spans)
+        branched.spans = self.spans
+        branched.root = self.root
+        return branched
+
+    def finish(self, opened, error=None):
+        """ Closes a span and the spans left open inside it """
+        if opened is None:
+            return
+        opened.end = time.time()
+        if error is not None:
+            opened.status = "error"
+            opened.attributes["error"] = "{}: {}".format(type(error).__name__, error)
+        while self.stack:
+            if self.stack.pop() is opened:
+                break
+
+    def serialize(self):
+        """ Serializes a trace into a dictionary """
+        return {"traceId": self.trace_id, "dropped": self.dropped,
+                "spans": [opened.serialize() for opened in self.spans]}
+
+
+def current_trace():
+    """ Returns the trace of the request, or None when it is not traced """
+    return g.get("trace") if has_app_context() else None
+
+
+@contextmanager
+def span(name, **attributes):
+    """ Times the enclosed code as a span of the trace of the request, if any """
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    opened = trace.start(name, attributes)
+    try:
+        yield opened
+    except Exception as error:
+        trace.finish(opened, error)
+        raise
+    trace.finish(opened)
+
+
+def traced(name):
+    """ Makes a function a span of the trace of the request, if any """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if current_trace() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+######################################################################
+#  E X P O R T E R S
+######################################################################
+
+class MemoryExporter():
+    """ Keeps the last traces of the process """
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.size = size
+        self.traces = OrderedDict()
+
+    def export(self, trace):
+        """ Keeps a serialized trace, forgetting the oldest one when full """
+        with self.lock:
+            self.traces[trace["traceId"] + trace["spans"][0]["spanId"]] = trace
+            while len(self.traces) > self.size:
+                self.traces.popitem(last=False)
+
+    def list(self):
+        """ Returns the kept traces, newest first """
+        with self.lock:
+            return list(reversed(self.traces.values()))
+
+
+class FileExporter():
+    """ Appends the traces to a file, one JSON document per line """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+
+    def export(self, trace):
+        """ Appends a serialized trace """
+        line = json.dumps(trace, separators=(",", ":")) + "\n"
+        with self.lock:
+            with open(self.path, "a") as traces:
+                traces.write(line)
+
+
+def exporters(app):
+    """ Returns the exporters of an app, created from TRACING_EXPORTERS on first use """
+    found = app.extensions.get("tracing")
+    if found is None:
+        found = {}
+        for name in app.config.get("TRACING_EXPORTERS") or ("memory",):
+            if name == "memory":
+                found[name] = MemoryExporter(app.config.get("TRACING_MEMORY_TRACES", 100))
+            elif name == "file":
+                found[name] = FileExporter(app.config.get("TRACING_FILE") or "traces.jsonl")
+            else:
+                logger.warning("Unknown tracing exporter %s", name)
+        app.extensions["tracing"] = found
+    return found
+
+
+def waterfall(trace):
+    """ Returns the spans of a serialized trace with their depth, offset and duration in ms """
+    spans = sorted(trace["spans"], key=lambda item: item["startTimeUnixNano"])
+    start = spans[0]["startTimeUnixNano"] if spans else 0
+    depths = {}
+    rows = []
+    for item in spans:
+        depth = depths.get(item["parentSpanId"], -1) + 1
+        depths[item["spanId"]] = depth
+        rows.append({
+            "spanId": item["spanId"],
+            "parentSpanId": item["parentSpanId"],
+            "name": item["name"],
+            "depth": depth,
+            "offsetMs": round((item["startTimeUnixNano"] - start) / 1e6, 3),
+            "durationMs": round((item["endTimeUnixNano"] - item["startTimeUnixNano"]) / 1e6, 3),
+            "attributes": item["attributes"],
+            "status": item["status"],
+        })
+    return {"traceId": trace["traceId"], "dropped": trace["dropped"], "spans": rows}
+
+
+def summary(trace):
+    """ Returns the trace id, request, start and duration of a serialized trace """
+    root = trace["spans"][0]
+    return {"traceId": trace["traceId"], "spanId": root["spanId"], "name": root["name"],
+            "status": root["attributes"].get("http.status_code"),
+            "startTimeUnixNano": root["startTimeUnixNano"],
+            "durationMs": round((root["endTimeUnixNano"] - root["startTimeUnixNano"]) / 1e6, 3),
+            "spans": len(trace["spans"])}
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+
+def start_trace():
+    """ Opens the span of the request when it is traced """
+    config = current_app.config
+    if not config.get("TRACING") or request.endpoint in EXEMPT_ENDPOINTS:
+        return
+    match = traceParent.match(request.headers.get(TRACEPARENT_HEADER, "").strip().lower())
+    if match and match.group(1) != "0" * 32 and match.group(2) != "0" * 16:
+        trace_id, parent_id, sampled = match.group(1), match.group(2), int(match.group(3), 16) & 1
+    else:
+        trace_id, parent_id = new_id(128), None
+        sampled = random.random() < config.get("TRACING_SAMPLE_RATE", 1.0)
+    if not sampled:
+        return
+    g.trace = Trace(trace_id, parent_id, config.get("TRACING_MAX_SPANS", 1000))
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    g.trace.start("{} {}".format(request.method, route), {
+        "http.method": request.method,
+        "http.route": route,
+        "http.target": request.full_path.rstrip("?"),
+    })
+
+
+def name_trace(response):
+    """ Records the status of the response and tells the client its span """
+    trace = g.get("trace")
+    if trace is not None and trace.spans:
+        root = trace.spans[0]
+        root.attributes["http.status_code"] = response.status_code
+        response.headers[TRACERESPONSE_HEADER] = "00-{}-{}-01".format(trace.trace_id, root.span_id)
+    return response
+
+
+def finish_trace(exception=None):
+    """ Closes the span of the request once its response is sent and exports the trace """
+    trace = g.pop("trace", None)
+    if trace is None or not trace.spans:
+        return
+    trace.finish(trace.spans[0], exception)
+    serialized = trace.serialize()
+    for exporter in exporters(current_app).values():
+        try:
+            exporter.export(serialized)
+        except Exception:  # a failing exporter must not fail the request
+            logger.exception("Cannot export trace %s", trace.trace_id)
+
+
+def traced_view(endpoint, view):
+    """ Wraps a route function in a span """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_trace() is None:
+            return view(*args, **kwargs)
+        with span("handler " + endpoint, **{"code.function": view.__name__}):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Opens the span of a SQL statement """
+    trace = current_trace()
+    if trace is None or context is None:
+        return
+    context.trace_span = trace.start("sql " + statement.lstrip().split(None, 1)[0].upper(), {
+        "db.system": conn.dialect.name,
+        "db.statement": statement[:MAX_STATEMENT],
+    })
+
+
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Closes the span of a SQL statement """
+    opened = getattr(context, "trace_span", None)
+    trace = current_trace()
+    if opened is not None and trace is not None:
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            opened.attributes["db.rowcount"] = cursor.rowcount
+        trace.finish(opened)
+
+
+def fail_statement(exception_context):
+    """ Closes the span of a SQL statement that failed """
+    opened = getattr(exception_context.execution_context, "trace_span", None)
+    trace = current_trace()
+    if opened is not None and trace is not None:
+        trace.finish(opened, exception_context.original_exception)
+
+
+def init_app(app):
+    """ Registers the tracing hooks and wraps the route functions in spans """
+    app.before_request(start_trace)
+    app.after_request(name_trace)
+    app.teardown_request(finish_trace)
+    for endpoint, view in list(app.view_functions.items()):
+        app.view_functions[endpoint] = traced_view(endpoint, view)
+    event.listen(Engine, "before_cursor_execute", start_statement)
+    event.listen(Engine, "after_cursor_execute", finish_statement)
+    event.listen(Engine, "handle_error", fail_statement)
@@ -3,12 +3,51 @@
 """
 Test Factory to make fake objects for testing
 """
+import copy
+import json
 import factory
 #from basefactory import BaseFactory
 
 from factory.fuzzy import FuzzyChoice
+from flask_api import status  # HTTP Status Codes
 from service.models import Pprofile, Pname, Paddress, Gender
 
+# The X-Admin-Token the tests send to the /admin routes
+ADMIN_TOKEN = "admin-secret"
+
+with open('tests/fhir-patient-post.json') as jsonfile:
+    sample_data = json.load(jsonfile)
+
+
+def admin_client(app):
+    """ Turns the admin routes on and returns a test client sending their token """
+    app.config["ADMIN_TOKEN"] = ADMIN_TOKEN
+    client = app.test_client()
+    client.environ_base["HTTP_X_ADMIN_TOKEN"] = ADMIN_TOKEN
+    return client
+
+
+class PatsMixin():
+    """ Creates patients through the API, for test cases whose test client is self.app """
+
+    def _create_pats(self, count, family=None):
+        """ Factory method to create patients in bulk, returns their JSON
+
+        Args:
+            count (int): the number of patients
+            family (string): the family name of each, formatted with its index, i.e. "Family{}"
+        """
+        pats = []
+        for index in range(count):
+            data = copy.deepcopy(sample_data)
+            if family is not None:
+                data["name"][0]["family"] = family.format(index)
+            resp = self.app.post("/pats", json=data, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            pats.append(resp.get_json())
+        return pats
+
+
 class NameFactory(factory.Factory):
     """ Creates fake personal name """
     class Meta:
@@ -16,9 +16,14 @@ import logging
 import unittest
 from datetime import datetime
 import json
+from unittest.mock import MagicMock
 from werkzeug.exceptions import NotFound
-from service.models import Pprofile, Pname, Paddress, Gender, DataValidationError, db
+from sqlalchemy.orm.exc import StaleDataError
+from service.models import Pprofile, Pname, Paddress, PatientSearch, Gender, DataValidationError, \
+    DataConflictError, apply_json_patch, migrate_schema, cascade_foreign_keys, db
 from service import app
+from sqlalchemy import inspect, event
+from sqlalchemy.dialects import postgresql
 import copy
 #from .factories import PatFactory
 
@@ -153,6 +158,9 @@ class TestPatModel(unittest.TestCase):
         logging.debug(pat)
         pats = Pprofile.all()
         self.assertEqual(len(Pprofile.all()), 0)
+        # the database removed the names and addresses
+        self.assertEqual(Pname.query.count(), 0)
+        self.assertEqual(Paddress.query.count(), 0)
 
 
     def test_serialize_a_pat(self):
@@ -347,6 +355,254 @@ class TestPatModel(unittest.TestCase):
         self.assertEqual(pats[0].name[0].family, "Flanders")
         self.assertEqual(pats[0].address[0].postalCode, "90210")
 
+    def test_search_projection(self):
+        """ Keep one search row per name and address pair of a patient """
+        data = copy.deepcopy(sample_data)
+        data["name"].append(dict(sample_data["name"][0], family="Flandres", given=["Ned"]))
+        data["address"].append(dict(sample_data["address"][0], postalCode="10001"))
+        pat = Pprofile().deserialize(data)
+        pat.create()
+        other = Pprofile().deserialize(sample_data)
+        other.create()
+        self.assertEqual(PatientSearch.query.filter_by(pprofile_id=pat.id).count(), 4)
+
+        self.assertEqual([p.id for p in Pprofile.find_by_lname("Flandres")], [pat.id])
+        self.assertEqual([p.id for p in Pprofile.find_by_name("Ned", "Flandres")], [pat.id])
+        self.assertEqual(Pprofile.find_by_name("Ned", "Flanders"), [])
+        self.assertEqual([p.id for p in Pprofile.find_by_zip("90210")], [pat.id, other.id])
+        args = {"family": "Flandres", "postalCode": "10001", "birthdate": "1989"}
+        self.assertEqual([p.id for p in Pprofile.search(args)], [pat.id])
+
+        # the name and zip searches read one table, then load the patients found
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            db.session.expire_all()
+            pats = Pprofile.find_by_zip("10001")
+            self.assertEqual([addr.postalCode for addr in pats[0].address], ["90210", "10001"])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(len(statements), 4)
+        self.assertNotIn("JOIN", statements[0])
+        self.assertIn("FROM patient_search", statements[0])
+
+        # the rows follow the changes and go with the patient
+        pat = Pprofile.find(pat.id)
+        pat.deserialize(sample_data)
+        pat.save()
+        self.assertEqual(PatientSearch.query.filter_by(pprofile_id=pat.id).count(), 1)
+        self.assertEqual(Pprofile.find_by_lname("Flandres"), [])
+        pat_id = pat.id
+        Pprofile.delete_matching([Pprofile.id == pat_id])
+        self.assertEqual(PatientSearch.query.filter_by(pprofile_id=pat_id).count(), 0)
+
+        # a lost projection is rebuilt
+        PatientSearch.query.delete()
+        db.session.commit()
+        self.assertEqual(Pprofile.rebuild_resources(), 1)
+        self.assertEqual([p.id for p in Pprofile.find_by_fname("Nedward")], [other.id])
+
+    def test_find_by_birthdate(self):
+        """ Find patients by birth date ranges and partial dates """
+        for dob in ["1975-02-14", "1989-12-17", "1990-01-01"]:
+            pat = Pprofile()
+            s1 = copy.deepcopy(sample_data)
+            s1["birthDate"] = dob
+            pat = pat.deserialize(s1)
+            pat.create()
+
+        self.assertEqual(Pprofile.find_by_birthdate("1989").count(), 1)
+        self.assertEqual(Pprofile.find_by_birthdate("eq1989-12").count(), 1)
+        self.assertEqual(Pprofile.find_by_birthdate("1989-12-17").count(), 1)
+        self.assertEqual(Pprofile.find_by_birthdate("ne1989").count(), 2)
+        self.assertEqual(Pprofile.find_by_birthdate("lt1989").count(), 1)
+        self.assertEqual(Pprofile.find_by_birthdate("le1989").count(), 2)
+        self.assertEqual(Pprofile.find_by_birthdate("gt1989").count(), 1)
+        self.assertEqual(Pprofile.find_by_birthdate("ge1989-12-17").count(), 2)
+        self.assertEqual(Pprofile.find_by_birthdate("sa1989-12").count(), 1)
+        self.assertEqual(Pprofile.find_by_birthdate("eb1990").count(), 2)
+        self.assertEqual(Pprofile.find_by_birthdate("ge1980", "lt1990").count(), 1)
+        self.assertRaises(DataValidationError, Pprofile.find_by_birthdate, "ge1989-13")
+        self.assertRaises(DataValidationError, Pprofile.find_by_birthdate, "after1989")
+
+    def test_find_by_ids(self):
+        """ Find several patients by their ids """
+        for i in range(3):
+            pat = Pprofile()
+            pat = pat.deserialize(sample_data)
+            pat.create()
+
+        pats = Pprofile.find_by_ids([3, 1, 7])
+        self.assertEqual([pat.id for pat in pats], [1, 3])
+        self.assertEqual(pats[1].name[0].family, "Flanders")
+        self.assertEqual(pats[1].address[0].postalCode, "90210")
+        self.assertEqual(Pprofile.search({"_id": "2,3", "family": "Flanders"}).count(), 2)
+
+    def test_search_combined(self):
+        """ Search patients with several parameters at once """
+        for i in range(2):
+            pat = Pprofile()
+            pat = pat.deserialize(sample_data)
+            pat.create()
+
+        pats = Pprofile.search({"family": "Flanders", "gender": "male", "birthdate": "1989"}).all()
+        self.assertEqual(len(pats), 2)
+        pats = Pprofile.search({"family": "Flanders", "birthdate": "gt1989"}).all()
+        self.assertEqual(len(pats), 0)
+        pats = Pprofile.search({"postalCode": "90210", "active": "false"}).all()
+        self.assertEqual(len(pats), 0)
+        self.assertRaises(DataValidationError, Pprofile.search, {"gender": "other"})
+
+    def test_stored_resource_json(self):
+        """ Keep the pre-rendered JSON of a patient in sync with its rows """
+        pat = Pprofile()
+        pat = pat.deserialize(sample_data)
+        pat.create()
+        stored = json.loads(Pprofile.find_json(pat.id))
+        self.assertEqual(stored, pat.serialize())
+        self.assertEqual(stored["name"][0]["id"], pat.name[0].id)
+
+        # a change to a child row re-renders the parent
+        pat.address[0].postalCode = "97600"
+        pat.save()
+        name = Pname(given_1="Maude", family="Flanders", use="old")
+        pat.name.append(name)
+        pat.save()
+        stored = json.loads(Pprofile.find_json(pat.id))
+        self.assertEqual(stored["address"][0]["postalCode"], "97600")
+        self.assertEqual(stored["name"][1]["given"], ["Maude"])
+
+        name.delete()
+        stored = json.loads(Pprofile.find_json(pat.id))
+        self.assertEqual(len(stored["name"]), 1)
+        self.assertEqual([resource for _, resource in Pprofile.search_json({})], [Pprofile.find_json(pat.id)])
+        self.assertIsNone(Pprofile.find_json(0))
+
+    def test_rebuild_resources(self):
+        """ Rebuild the pre-rendered JSON of existing patients """
+        for i in range(3):
+            pat = Pprofile()
+            pat = pat.deserialize(sample_data)
+            pat.create()
+        Pprofile.query.update({Pprofile.resource_json: None})
+        db.session.commit()
+        # rows without stored JSON are still served
+        self.assertEqual(json.loads(Pprofile.find_json(2))["id"], 2)
+
+        self.assertEqual(Pprofile.rebuild_resources(batch_size=2), 3)
+        stored = db.session.query(Pprofile.resource_json).order_by(Pprofile.id).all()
+        self.assertEqual([json.loads(row.resource_json)["id"] for row in stored], [1, 2, 3])
+
+        app.config["STORE_RESOURCE_JSON"] = False
+        try:
+            pat = Pprofile.find(1)
+            pat.active = False
+            pat.save()
+            self.assertIsNone(db.session.query(Pprofile.resource_json).filter(Pprofile.id == 1).scalar())
+            self.assertEqual(json.loads(Pprofile.find_json(1))["active"], False)
+        finally:
+            app.config["STORE_RESOURCE_JSON"] = True
+
+    def test_migrate_schema(self):
+        """ Bring an old database schema up to date """
+        db.drop_all()
+        db.engine.execute(
+            'CREATE TABLE pprofile (id INTEGER PRIMARY KEY, "resourceType" VARCHAR(20), '
+            'active BOOLEAN NOT NULL, phone_home VARCHAR(10), phone_office VARCHAR(10), '
+            'phone_cell VARCHAR(10), email VARCHAR(60), "DOB" TIMESTAMP NOT NULL, gender VARCHAR(7))')
+        migrate_schema(db.engine)
+        inspector = inspect(db.engine)
+        columns = [column["name"] for column in inspector.get_columns("pprofile")]
+        self.assertIn("resource_json", columns)
+        self.assertIn("version_id", columns)
+        self.assertIn("ix_pprofile_DOB", [index["name"] for index in inspector.get_indexes("pprofile")])
+        self.assertIn("pname", inspector.get_table_names())
+        # running it again changes nothing
+        migrate_schema(db.engine)
+        self.assertEqual(len(inspect(db.engine).get_columns("pprofile")), len(columns))
+
+    def test_cascade_foreign_keys(self):
+        """ Recreate the foreign keys of an old PostgreSQL schema with ON DELETE CASCADE """
+        engine = MagicMock()
+        engine.dialect = postgresql.dialect()
+        connection = engine.begin.return_value.__enter__.return_value
+        inspector = MagicMock()
+        inspector.get_foreign_keys.return_value = [{
+            "name": "pname_pprofile_id_fkey", "constrained_columns": ["pprofile_id"],
+            "referred_table": "pprofile", "referred_columns": ["id"], "options": {}}]
+        cascade_foreign_keys(engine, inspector, Pname.__table__)
+        drop, add = [call[0][0] for call in connection.execute.call_args_list]
+        self.assertEqual(drop, "ALTER TABLE pname DROP CONSTRAINT pname_pprofile_id_fkey")
+        self.assertEqual(add, "ALTER TABLE pname ADD CONSTRAINT pname_pprofile_id_fkey "
+                              "FOREIGN KEY (pprofile_id) REFERENCES pprofile (id) ON DELETE CASCADE")
+
+        # up to date, or on SQLite, nothing is altered
+        connection.reset_mock()
+        inspector.get_foreign_keys.return_value[0]["options"] = {"ondelete": "CASCADE"}
+        cascade_foreign_keys(engine, inspector, Pname.__table__)
+        self.assertFalse(connection.execute.called)
+        cascade_foreign_keys(db.engine, inspect(db.engine), Pname.__table__)
+
+    def test_apply_json_patch(self):
+        """ Apply JSON Patch operations to a document """
+        document = {"a": {"b": [1, 2]}, "c~d": "e", "f/g": None}
+        patched = apply_json_patch(document, [
+            {"op": "add", "path": "/a/b/1", "value": 5},
+            {"op": "remove", "path": "/a/b/0"},
+            {"op": "replace", "path": "/c~0d", "value": "x"},
+            {"op": "move", "from": "/f~1g", "path": "/h"},
+            {"op": "copy", "from": "/a/b", "path": "/i"},
+            {"op": "test", "path": "/i", "value": [5, 2]},
+        ])
+        self.assertEqual(patched, {"a": {"b": [5, 2]}, "c~d": "x", "h": None, "i": [5, 2]})
+        self.assertEqual(document["a"]["b"], [1, 2])
+        self.assertRaises(DataConflictError, apply_json_patch, document, [{"op": "test", "path": "/c~0d", "value": "x"}])
+        self.assertRaises(DataValidationError, apply_json_patch, document, [{"op": "replace", "path": "/z", "value": 1}])
+        self.assertRaises(DataValidationError, apply_json_patch, document, [{"op": "remove", "path": "/a/b/2"}])
+        self.assertRaises(DataValidationError, apply_json_patch, document, [{"op": "jump", "path": "/a"}])
+        self.assertRaises(DataValidationError, apply_json_patch, document, {"op": "remove", "path": "/a"})
+
+    def test_patch_a_pat(self):
+        """ Patch a patient without touching its names and addresses """
+        pat = Pprofile()
+        pat = pat.deserialize(sample_data)
+        pat.create()
+        pat = Pprofile.find(pat.id)
+        pat.patch([{"op": "replace", "path": "/birthDate", "value": "1990-01-02"},
+                   {"op": "remove", "path": "/email"}])
+        self.assertNotIn("name", pat.__dict__)
+        self.assertNotIn("address", pat.__dict__)
+        pat.save()
+        pat = Pprofile.find(pat.id)
+        self.assertEqual(pat.DOB, datetime(1990, 1, 2))
+        self.assertIsNone(pat.email)
+        self.assertRaises(DataValidationError, pat.patch, [{"op": "replace", "path": "/gender", "value": "other"}])
+        self.assertRaises(DataValidationError, pat.patch, [{"op": "replace", "path": "/id", "value": 5}])
+        self.assertRaises(DataValidationError, pat.patch, [{"op": "remove", "path": "/active"}])
+
+    def test_version_a_pat(self):
+        """ Raise the version on every change and detect concurrent writers """
+        pat = Pprofile()
+        pat = pat.deserialize(sample_data)
+        pat.create()
+        self.assertEqual(pat.version_id, 1)
+        self.assertEqual(pat.name[0].version_id, 1)
+        pat.name[0].family = "Simpson"
+        pat.save()
+        self.assertEqual(pat.version_id, 2)
+        self.assertEqual(pat.name[0].version_id, 2)
+        self.assertEqual(pat.address[0].version_id, 1)
+        pat.save()
+        self.assertEqual(pat.version_id, 2)
+
+        # another writer gets in between the read and the write
+        pat = Pprofile.find(pat.id)
+        pat.active = False
+        db.session.execute("UPDATE pprofile SET version_id = version_id + 1")
+        self.assertRaises(StaleDataError, pat.save)
+        db.session.rollback()
 
     def test_find_or_404_found(self):
         """ Find or return 404 found """
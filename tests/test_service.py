@@ -20,9 +20,11 @@ import copy
 from unittest.mock import MagicMock, patch
 from urllib.parse import quote_plus
 from flask_api import status  # HTTP Status Codes
+from sqlalchemy import event
 from service.models import Pprofile, Pname, Paddress, db
 from service.service import app, init_db
 #from .factories import PatFactory
+from .factories import ADMIN_TOKEN
 
 
 # DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
@@ -93,13 +95,20 @@ class TestPatServer(unittest.TestCase):
             #root: DEBUG: <Pat fname='Nedward' lname='Flanders' id=[1] pprofile_id=[None]>
             #id is assigned from new_pat["id"], profile_id is None
             logging.debug(pat)
-            self.assertEqual(new_pat["address"][0]["pat_id"], 1)
+            self.assertEqual(new_pat["address"][0]["pat_id"], new_pat["id"])
             self.assertEqual(pat.address[0].postalCode, "90210")
             pats.append(pat)
 
         return pats
 
 
+    def test_create_app(self):
+        """ Set up the app only once """
+        import service
+        hooks = len(app.before_request_funcs[None])
+        self.assertIs(service.create_app(), app)
+        self.assertEqual(len(app.before_request_funcs[None]), hooks)
+
     def test_index(self):
         """ Test the Home Page """
         resp = self.app.get("/")
@@ -152,6 +161,20 @@ class TestPatServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(data[0]["phone_home"], test_pat.phone_home)
 
+    def test_get_pat_after_name_update(self):
+        """ Get a patient after one of its names was changed """
+        test_pat = self._create_pats(1)[0]
+        name_json = copy.deepcopy(sample_data["name"][0])
+        name_json["family"] = "Simpson"
+        resp = self.app.put("/pats/{}/name/{}".format(test_pat.id, 1),
+                            json=name_json, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/pats/{}".format(test_pat.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["name"][0]["family"], "Simpson")
+        resp = self.app.get("/pats", query_string="family=Simpson")
+        self.assertEqual(resp.get_json()[0]["name"][0]["family"], "Simpson")
+
     def test_get_pat_not_found(self):
         """ Get a patient whos not found """
         resp = self.app.get("/pats/0")
@@ -216,11 +239,182 @@ class TestPatServer(unittest.TestCase):
         logging.debug(updated_pat)
         #updated the pprofile entry
         self.assertEqual(updated_pat["email"], "daisy.cao@email.com")
-        #added a new first name
-        self.assertEqual(updated_pat["name"][1]["given"][0], "Daisy")
-        self.assertEqual(updated_pat["name"][0]["given"][0], "Nedward")
+        #replaced the first name in place
+        self.assertEqual(len(updated_pat["name"]), 1)
+        self.assertEqual(updated_pat["name"][0]["given"][0], "Daisy")
+        self.assertEqual(updated_pat["name"][0]["id"], new_pat["name"][0]["id"])
+    
+    def test_update_pat_diff(self):
+        """ Update an existing patient with only the changed rows written """
+        resp = self.app.post("/pats", json=sample_data, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        new_pat = resp.get_json()
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.split()[0])
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            # an identical PUT writes nothing
+            resp = self.app.put("/pats/{}".format(new_pat["id"]), json=sample_data, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json(), new_pat)
+            self.assertNotIn("UPDATE", statements)
+            self.assertNotIn("INSERT", statements)
+            self.assertNotIn("DELETE", statements)
+
+            # add an address and drop the name's second given name
+            new_json = copy.deepcopy(sample_data)
+            new_json["name"][0]["given"] = ["Nedward"]
+            new_json["address"].append(dict(sample_data["address"][0], line=["1 Main St"], use="work"))
+            del statements[:]
+            resp = self.app.put("/pats/{}".format(new_pat["id"]), json=new_json, content_type="application/json")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            # the new address and the new version in the change history
+            self.assertEqual(statements.count("INSERT"), 2)
+            self.assertNotIn("DELETE", statements)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        updated_pat = resp.get_json()
+        self.assertEqual(updated_pat["name"][0]["given"], ["Nedward"])
+        self.assertEqual([addr["line"][0] for addr in updated_pat["address"]], ["744 Evergreen Terrace", "1 Main St"])
+        self.assertEqual(updated_pat["address"][0]["id"], new_pat["address"][0]["id"])
+
+        # remove the first address, the second one is matched by its id
+        new_json["address"] = [dict(updated_pat["address"][1], type="postal")]
+        resp = self.app.put("/pats/{}".format(new_pat["id"]), json=new_json, content_type="application/json")
+        updated_pat = resp.get_json()
+        self.assertEqual(len(updated_pat["address"]), 1)
+        self.assertEqual(updated_pat["address"][0]["line"], ["1 Main St"])
+        self.assertEqual(Paddress.query.count(), 1)
     
 
+    def test_patch_pat(self):
+        """ Patch fields of an existing patient """
+        test_pat = self._create_pats(1)[0]
+        resp = self.app.get("/pats/{}".format(test_pat.id))
+        etag = resp.headers["ETag"]
+        patch = [
+            {"op": "test", "path": "/phone_home", "value": "5555551112"},
+            {"op": "replace", "path": "/phone_cell", "value": "5555550000"},
+            {"op": "replace", "path": "/address/0/line/0", "value": "740 Evergreen Terrace"},
+            {"op": "add", "path": "/name/0/prefix/-", "value": "Dr"},
+        ]
+        resp = self.app.patch("/pats/{}".format(test_pat.id), json=patch,
+                              content_type="application/json-patch+json", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["phone_cell"], "5555550000")
+        self.assertEqual(data["address"][0]["line"], ["740 Evergreen Terrace"])
+        self.assertEqual(data["name"][0]["prefix"], ["Mr", "Dr"])
+        self.assertEqual(data["name"][0]["id"], 1)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+        # the old version can no longer be patched
+        resp = self.app.patch("/pats/{}".format(test_pat.id), json=patch,
+                              content_type="application/json-patch+json", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+        resp = self.app.patch("/pats/{}".format(test_pat.id), json=[{"op": "test", "path": "/active", "value": False}],
+                              content_type="application/json-patch+json")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.patch("/pats/{}".format(test_pat.id), json=[{"op": "replace", "path": "/email", "value": "nope"}],
+                              content_type="application/json-patch+json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("/pats/{}".format(test_pat.id), json=[{"op": "add", "path": "/color", "value": "red"}],
+                              content_type="application/json-patch+json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch("/pats/{}".format(test_pat.id), json=patch, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        resp = self.app.patch("/pats/0", json=patch, content_type="application/json-patch+json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_patch_name_and_address(self):
+        """ Patch a name and an address of an existing patient """
+        test_pat = self._create_pats(1)[0]
+        resp = self.app.get("/pats/{}/name/1".format(test_pat.id))
+        resp = self.app.patch("/pats/{}/name/1".format(test_pat.id),
+                              json=[{"op": "replace", "path": "/family", "value": "Simpson"},
+                                    {"op": "remove", "path": "/given/1"}],
+                              content_type="application/json-patch+json", headers={"If-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["family"], "Simpson")
+        self.assertEqual(resp.get_json()["given"], ["Nedward"])
+
+        resp = self.app.patch("/pats/{}/address/1".format(test_pat.id),
+                              json=[{"op": "replace", "path": "/postalCode", "value": "97600"}],
+                              content_type="application/json-patch+json")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["postalCode"], "97600")
+        resp = self.app.patch("/pats/{}/address/1".format(test_pat.id),
+                              json=[{"op": "replace", "path": "/postalCode", "value": "976"}],
+                              content_type="application/json-patch+json")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        data = self.app.get("/pats/{}".format(test_pat.id)).get_json()
+        self.assertEqual(data["name"][0]["family"], "Simpson")
+        self.assertEqual(data["address"][0]["postalCode"], "97600")
+        resp = self.app.patch("/pats/{}/name/9".format(test_pat.id), json=[],
+                              content_type="application/json-patch+json")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_update_pat_if_match(self):
+        """ Update patients and names only from their current version """
+        test_pat = self._create_pats(1)[0]
+        resp = self.app.get("/pats/{}".format(test_pat.id))
+        self.assertEqual(resp.headers["ETag"], 'W/"1"')
+
+        new_json = copy.deepcopy(sample_data)
+        new_json["active"] = False
+        resp = self.app.put("/pats/{}".format(test_pat.id), json=new_json,
+                            content_type="application/json", headers={"If-Match": 'W/"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], 'W/"2"')
+        resp = self.app.put("/pats/{}".format(test_pat.id), json=sample_data,
+                            content_type="application/json", headers={"If-Match": 'W/"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get("/pats/{}".format(test_pat.id)).get_json()["active"], False)
+
+        # a changed name is a new version of the patient too
+        name_json = copy.deepcopy(sample_data["name"][0])
+        name_json["family"] = "Simpson"
+        resp = self.app.put("/pats/{}/name/1".format(test_pat.id), json=name_json,
+                            content_type="application/json", headers={"If-Match": 'W/"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["ETag"], 'W/"2"')
+        resp = self.app.put("/pats/{}/name/1".format(test_pat.id), json=name_json,
+                            content_type="application/json", headers={"If-Match": 'W/"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get("/pats/{}".format(test_pat.id)).headers["ETag"], 'W/"3"')
+
+        resp = self.app.post("/pats/{}/address".format(test_pat.id), json=sample_data["address"][0],
+                             content_type="application/json", headers={"If-Match": 'W/"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put("/pats/{}".format(test_pat.id), json=sample_data,
+                            content_type="application/json", headers={"If-Match": "three"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # any entity tag of a list may name the current version
+        resp = self.app.put("/pats/{}".format(test_pat.id), json=sample_data,
+                            content_type="application/json", headers={"If-Match": 'W/"1", W/"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put("/pats/{}".format(test_pat.id), json=sample_data,
+                            content_type="application/json", headers={"If-Match": 'W/"2", "3"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put("/pats/{}".format(test_pat.id), json=sample_data,
+                            content_type="application/json", headers={"If-Match": 'W/"4", W/""'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_pat_if_match(self):
+        """ Delete a patient only from its current version """
+        test_pat = self._create_pats(1)[0]
+        resp = self.app.delete("/pats/{}".format(test_pat.id), headers={"If-Match": 'W/"5"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete("/pats/{}".format(test_pat.id), headers={"If-Match": 'W/"5", W/"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get("/pats/{}".format(test_pat.id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_update_pat_latest_name(self):
         """ Update the latest name of an existing patient """
         # create a patient to update
@@ -263,6 +457,40 @@ class TestPatServer(unittest.TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_delete_matching_pats(self):
+        """ Delete every patient matching search parameters """
+        pats = self._create_pats(3)
+        new_json = copy.deepcopy(sample_data)
+        new_json["address"][0]["postalCode"] = "10001"
+        resp = self.app.post("/pats", json=new_json, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement.split()[0])
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            resp = self.app.delete("/pats", query_string="postalCode=90210&family=Flanders")
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(statements.count("DELETE"), 1)
+        # only the ids are locked and read, the rows are never loaded
+        self.assertEqual(statements.count("SELECT"), 1)
+
+        data = self.app.get("/pats").get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["address"][0]["postalCode"], "10001")
+        # names and addresses went with their profiles
+        self.assertEqual(Pname.query.count(), 1)
+        self.assertEqual(Paddress.query.count(), 1)
+
+        resp = self.app.delete("/pats")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.delete("/pats", query_string="birthdate=gt2100")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.app.get("/pats").get_json()), 1)
+
     def test_query_pat_list_by_gender(self):
         """ Query patients by gender """
         pats = self._create_pats(1)
@@ -277,6 +505,64 @@ class TestPatServer(unittest.TestCase):
             self.assertEqual(_dd["gender"], test_gender.name)
         app.logger.info("run a test for testing query patients with the same gender")
 
+    def test_query_pat_list_by_birthdate(self):
+        """ Query patients by a birth date range combined with other parameters """
+        self._create_pats(1)
+        resp = self.app.get("/pats", query_string="birthdate=ge1989-12&birthdate=lt1990&gender=male")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["birthDate"], "1989-12-17")
+
+        resp = self.app.get("/pats", query_string="birthdate=ge1989-12&family=Simpson")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 0)
+
+        resp = self.app.get("/pats", query_string="birthdate=1989-12-32")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_pat_id_list(self):
+        """ Get several patients by id in one Bundle """
+        pats = self._create_pats(3)
+        ids = ",".join(str(pat.id) for pat in pats[:2])
+        resp = self.app.get("/pats", query_string="_id={},99".format(ids))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["resourceType"], "Bundle")
+        self.assertEqual(data["total"], 2)
+        matches = [entry for entry in data["entry"] if entry["search"]["mode"] == "match"]
+        self.assertEqual([entry["resource"]["id"] for entry in matches], [pats[0].id, pats[1].id])
+        self.assertEqual(matches[0]["resource"]["name"][0]["family"], "Flanders")
+        outcome = data["entry"][-1]["resource"]
+        self.assertEqual(outcome["resourceType"], "OperationOutcome")
+        self.assertEqual(len(outcome["issue"]), 1)
+        self.assertIn("'99'", outcome["issue"][0]["diagnostics"])
+
+        resp = self.app.get("/pats", query_string="_id=1,abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # repeated ids count once towards MAX_ID_LIST
+        app.config["MAX_ID_LIST"] = 2
+        try:
+            resp = self.app.get("/pats", query_string="_id={0},{0}&_id={1}".format(pats[0].id, pats[1].id))
+            self.assertEqual(resp.get_json()["total"], 2)
+            resp = self.app.get("/pats", query_string="_id=1,2,3")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            app.config["MAX_ID_LIST"] = 1000
+
+    def test_search_pats_form(self):
+        """ Search patients with a form encoded POST """
+        pats = self._create_pats(2)
+        resp = self.app.post("/pats/_search", data={"_id": "{},{}".format(pats[1].id, pats[0].id), "family": "Flanders"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["total"], 2)
+        self.assertEqual(len(data["entry"]), 2)
+
+        resp = self.app.post("/pats/_search", json={"_id": "1"}, content_type="application/json")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_bad_request(self):
         """ Send wrong media type """
         pat = Pprofile()
@@ -300,6 +586,24 @@ class TestPatServer(unittest.TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def test_admin_token(self):
+        """ Refuse the admin routes without the admin token """
+        token = app.config.get("ADMIN_TOKEN")
+        app.config["ADMIN_TOKEN"] = ""
+        try:
+            self.assertEqual(self.app.get("/admin/coalescing").status_code, status.HTTP_403_FORBIDDEN)
+            app.config["ADMIN_TOKEN"] = ADMIN_TOKEN
+            resp = self.app.get("/admin/coalescing")
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+            resp = self.app.get("/admin/coalescing", headers={"X-Admin-Token": "wrong"})
+            self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+            resp = self.app.get("/admin/coalescing", headers={"X-Admin-Token": ADMIN_TOKEN})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            # the other routes need no token
+            self.assertEqual(self.app.get("/pats").status_code, status.HTTP_200_OK)
+        finally:
+            app.config["ADMIN_TOKEN"] = token
+
 
     # @patch('service.models.Pet.find_by_name')
     # def test_bad_request(self, bad_request_mock):